@@ -0,0 +1,289 @@
+"""
+Micro-benchmarks of the gradient-update hot paths of the learner, on CPU and without any datasets.
+
+The gradient updates are synthetic: random parameter lists with the shapes of the models in utils/models.py.
+For each model and each number of participants P (and theta, for the masking), a benchmark times the work of
+one communication round, e.g. clipping the updates of the P participants, or the assignment of the aggregated
+update to the P participants, and reports the median (and best) seconds over the repeats, the throughput in
+parameters per second and the number and size of the tensor allocations (from the profiler, torch 1.6+).
+
+Run from the pytorch directory:
+	python -m benchmarks.bench_grad_updates --models MLP CNNCifar_TF --P 5 20 --save-baseline baseline.json
+	python -m benchmarks.bench_grad_updates --models MLP CNNCifar_TF --P 5 20 --baseline baseline.json
+With --baseline, the results are compared to a stored baseline (of the same benchmarks) and the benchmarks
+that are slower by more than --tolerance are reported as regressions, with a non-zero exit status.
+"""
+import sys
+import json
+import time
+import argparse
+from argparse import Namespace
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+
+from utils import models
+from utils.utils import aggregate_gradient_updates
+from utils.Participant import Participant
+from utils.Federated_Learner import allocate_download, clip_gradient_update, mask_grad_update_by_order, \
+	mask_grad_update_by_magnitude, mask_grad_update_by_indices, compute_reputations_sinh
+
+
+# the models to take the parameter shapes from, the text models with the sizes in utils/arguments.py
+MODELS = OrderedDict([
+	('LogisticRegression', lambda: models.LogisticRegression()),
+	('MLP', lambda: models.MLP()),
+	('MLP_Net', lambda: models.MLP_Net()),
+	('CNN_Net', lambda: models.CNN_Net()),
+	('CNNCifar', lambda: models.CNNCifar()),
+	('CNNCifar_TF', lambda: models.CNNCifar_TF()),
+	('CNN_Text', lambda: models.CNN_Text(args=Namespace(embed_num=20000, embed_dim=300, class_num=2, kernel_num=128, kernel_sizes=[3, 3, 3]))),
+	('AlexNet', lambda: models.AlexNet()),
+	('ResNet18', lambda: models.ResNet18()),
+	('VGG11', lambda: models.VGG11()),
+])
+
+GRAD_CLIP = 0.01
+
+TRACKS = ['cffl', 'pretrain']
+
+
+def get_shapes(model_name):
+	return [param.shape for param in MODELS[model_name]().parameters()]
+
+
+def make_update(shapes):
+	# the magnitudes of gradient updates, much smaller than the parameters
+	return [torch.randn(shape) * 1e-2 for shape in shapes]
+
+
+class Parameter_Model(nn.Module):
+	# a model with only the parameters, for the downloads of bench_assign
+	def __init__(self, shapes):
+		super(Parameter_Model, self).__init__()
+		self.params = nn.ParameterList([nn.Parameter(torch.randn(shape) * 1e-1) for shape in shapes])
+
+
+def get_magnitude_threshold(update, theta):
+	# the magnitude of the largest <theta> fraction of the update, as in mask_grad_update_by_order
+	magnitudes = torch.cat([param.view(-1).abs() for param in update])
+	return torch.topk(magnitudes, max(1, int(len(magnitudes) * theta)))[0][-1]
+
+
+def get_reputations(P):
+	reputations = torch.rand(P)
+	return reputations / reputations.sum()
+
+
+def get_download_count(reputations, shard_sizes, i, n_params):
+	# the number of values of the aggregate downloaded by participant i, as in Federated_Learner.download_count
+	return int(reputations[i] * 1. / reputations.max() * shard_sizes[i] * 1. / shard_sizes.max() * n_params)
+
+
+def bench_clip(shapes, P, theta):
+	updates = [make_update(shapes) for _ in range(P)]
+	return lambda: [clip_gradient_update(update, GRAD_CLIP) for update in updates]
+
+
+def bench_mask_by_order(mode):
+	def bench(shapes, P, theta):
+		updates = [make_update(shapes) for _ in range(P)]
+		return lambda: [mask_grad_update_by_order(update, mask_order=None, mask_percentile=theta, mode=mode) for update in updates]
+	return bench
+
+
+def bench_mask_by_magnitude(shapes, P, theta):
+	updates = [make_update(shapes) for _ in range(P)]
+	thresholds = [get_magnitude_threshold(update, theta) for update in updates]
+	return lambda: [mask_grad_update_by_magnitude(update, threshold) for update, threshold in zip(updates, thresholds)]
+
+
+def bench_mask_by_indices(shapes, P, theta):
+	updates = [make_update(shapes) for _ in range(P)]
+	n_params = sum(int(np.prod(shape)) for shape in shapes)
+	indices = torch.randperm(n_params)[:max(1, int(n_params * theta))]
+	return lambda: [mask_grad_update_by_indices(update, indices=indices) for update in updates]
+
+
+def bench_aggregate(mode):
+	def bench(shapes, P, theta):
+		updates = [make_update(shapes) for _ in range(P)]
+		shard_sizes = torch.randint(100, 1000, (P,)).float()
+		return lambda: aggregate_gradient_updates(updates, R=list(range(P)), mode=mode, shard_sizes=shard_sizes)
+	return bench
+
+
+def bench_reputations(shapes, P, theta):
+	reputations = get_reputations(P)
+	val_accs = (torch.rand(P) * 0.4 + 0.5).tolist()
+	# compute_reputations_sinh updates the reputations in place
+	return lambda: compute_reputations_sinh(reputations.clone(), torch.tensor(1.0 / (3 * P)), list(range(P)), val_accs)
+
+
+def bench_assign(largest_criterion):
+	"""
+	The downloads of one round of Federated_Learner.assign_updates_with_filter, for both tracks: the allocations from the
+	aggregated update (for 'all', the magnitude thresholds from its sorted values), then allocate_download() and
+	Participant.apply_download() for each participant.
+	"""
+	def bench(shapes, P, theta):
+		n_params = sum(int(np.prod(shape)) for shape in shapes)
+		shard_sizes = torch.randint(100, 1000, (P,)).float()
+		weights = torch.ones(P)
+		participants = [Participant(train_loader=None, model=Parameter_Model(shapes), model_pretrain=Parameter_Model(shapes)) for _ in range(P)]
+		reputations = {track: get_reputations(P) for track in TRACKS}
+		aggregated_updates = {track: make_update(shapes) for track in TRACKS}
+		filtered_updates = {track: [make_update(shapes) for _ in range(P)] for track in TRACKS}
+
+		def work():
+			for track in TRACKS:
+				if largest_criterion == 'all':
+					mode = 'topk'
+					topk, _ = torch.topk(torch.cat([update.data.view(-1).abs() for update in aggregated_updates[track]]), n_params)
+					allocations = [topk[get_download_count(reputations[track], shard_sizes, i, n_params) - 1] for i in range(P)]
+				else:
+					mode = 'layer'
+					allocations = reputations[track]
+				for i, participant in enumerate(participants):
+					allocated_grad = allocate_download(aggregated_updates[track], mode, allocations[i])
+					participant.apply_download(track, allocated_grad, filtered_updates[track][i], weights[i])
+		return work
+	return bench
+
+
+# name: (setup(shapes, P, theta) -> the work of one round, whether it depends on theta, the number of copies of the updates it holds per participant)
+BENCHMARKS = OrderedDict([
+	('clip_gradient_update', (bench_clip, False, 2)),
+	('mask_grad_update_by_order all', (bench_mask_by_order('all'), True, 3)),
+	('mask_grad_update_by_order layer', (bench_mask_by_order('layer'), True, 3)),
+	('mask_grad_update_by_magnitude', (bench_mask_by_magnitude, True, 2)),
+	('mask_grad_update_by_indices', (bench_mask_by_indices, True, 3)),
+	('aggregate_gradient_updates sum', (bench_aggregate('sum'), False, 3)),
+	('aggregate_gradient_updates mean', (bench_aggregate('mean'), False, 4)),
+	('compute_reputations_sinh', (bench_reputations, False, 0)),
+	('assign_updates_with_filter all', (bench_assign('all'), False, 4)),
+	('assign_updates_with_filter layer', (bench_assign('layer'), False, 4)),
+])
+
+
+def count_allocations(work):
+	"""
+	The number and total bytes of the CPU allocations of one call of <work>, None before torch 1.6:
+	the operators that allocate (by their own memory, not their children's) and the allocations outside any operator.
+	"""
+	try:
+		profile = torch.autograd.profiler.profile(profile_memory=True)
+	except TypeError:
+		return None, None
+	with profile:
+		work()
+	allocations = [getattr(event, 'self_cpu_memory_usage', event.cpu_memory_usage) for event in profile.function_events]
+	allocations = [n_bytes for n_bytes in allocations if n_bytes > 0]
+	return len(allocations), sum(allocations)
+
+
+def time_work(work, repeats):
+	work()
+	seconds = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		work()
+		seconds.append(time.perf_counter() - start)
+	return float(np.median(seconds)), float(np.min(seconds))
+
+
+def run_benchmarks(model_names, Ps, thetas, benchmarks=None, repeats=5, max_mb=4096):
+	records = []
+	for model_name in model_names:
+		shapes = get_shapes(model_name)
+		n_params = sum(int(np.prod(shape)) for shape in shapes)
+		for name in benchmarks or BENCHMARKS:
+			setup, uses_theta, copies = BENCHMARKS[name]
+			for P in Ps:
+				if P * copies * n_params * 4 / 2**20 > max_mb:
+					print("Skipping {} on {} with P={}: more than {} MB.".format(name, model_name, P, max_mb))
+					continue
+				for theta in (thetas if uses_theta else [None]):
+					torch.manual_seed(1234)
+					work = setup(shapes, P, theta)
+					seconds, best_seconds = time_work(work, repeats)
+					n_allocations, allocated_bytes = count_allocations(work)
+					records.append(OrderedDict([('benchmark', name), ('model', model_name), ('n_params', n_params), ('P', P), ('theta', theta),
+						('seconds', seconds), ('best_seconds', best_seconds), ('params_per_second', P * n_params / seconds if seconds > 0 else float('inf')),
+						('allocations', n_allocations), ('allocated_MB', None if allocated_bytes is None else allocated_bytes / 2**20)]))
+					del work
+					print("{} on {} with P={}, theta={}: {:.6f} seconds.".format(name, model_name, P, theta, seconds))
+	return records
+
+
+def get_key(record):
+	return (record['benchmark'], record['model'], record['P'], record['theta'])
+
+
+def compare_to_baseline(records, baseline, tolerance=0.2, min_delta=5e-4):
+	"""
+	The records with the baseline seconds and the ratio to it, and whether each is a regression:
+	slower than the baseline by more than <tolerance>, and by more than <min_delta> seconds, below which the timings are noise.
+	The best of the repeats are compared, as they are the least noisy.
+	"""
+	baseline = {get_key(record): record for record in baseline}
+	comparisons = []
+	for record in records:
+		if get_key(record) not in baseline:
+			continue
+		baseline_seconds = baseline[get_key(record)]['best_seconds']
+		ratio = record['best_seconds'] / baseline_seconds if baseline_seconds > 0 else float('inf')
+		comparisons.append(OrderedDict([('benchmark', record['benchmark']), ('model', record['model']), ('P', record['P']), ('theta', record['theta']),
+			('best_seconds', record['best_seconds']), ('baseline_best_seconds', baseline_seconds), ('ratio', ratio), ('regression', ratio > 1 + tolerance and record['best_seconds'] - baseline_seconds > min_delta)]))
+	return comparisons
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Micro-benchmarks of the gradient-update hot paths.')
+	parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+	parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=list(BENCHMARKS))
+	parser.add_argument('--P', nargs='+', type=int, default=[5, 10, 20])
+	parser.add_argument('--theta', nargs='+', type=float, default=[0.1, 1.0])
+	parser.add_argument('--repeats', type=int, default=5)
+	parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+	parser.add_argument('--max-mb', type=float, default=4096, help='skip the configurations whose updates need more memory')
+	parser.add_argument('--output', default=None, help='csv of the results')
+	parser.add_argument('--save-baseline', default=None, help='json to store the results as the baseline')
+	parser.add_argument('--baseline', default=None, help='json of the baseline to compare the results to')
+	parser.add_argument('--tolerance', type=float, default=0.2, help='the slowdown relative to the baseline that is a regression')
+	parser.add_argument('--min-delta', type=float, default=5e-4, help='the slowdown in seconds below which it is not a regression')
+	args = parser.parse_args(argv)
+
+	if args.threads:
+		torch.set_num_threads(args.threads)
+	records = run_benchmarks(args.models, args.P, args.theta, args.benchmarks, repeats=args.repeats, max_mb=args.max_mb)
+
+	df = pd.DataFrame(records)
+	pd.set_option('display.width', 200)
+	print(df.to_string(index=False))
+	if args.output:
+		df.to_csv(args.output, index=False)
+	if args.save_baseline:
+		with open(args.save_baseline, 'w') as file:
+			file.write(json.dumps({'torch': torch.__version__, 'threads': torch.get_num_threads(), 'records': records}, indent=1))
+
+	if args.baseline:
+		with open(args.baseline) as file:
+			baseline = json.loads(file.read())
+		comparisons = compare_to_baseline(records, baseline['records'], args.tolerance, args.min_delta)
+		print()
+		print("Compared to the baseline {} (torch {}, {} threads):".format(args.baseline, baseline['torch'], baseline['threads']))
+		print(pd.DataFrame(comparisons).to_string(index=False))
+		regressions = [comparison for comparison in comparisons if comparison['regression']]
+		if regressions:
+			print("{} regressions, slower than the baseline by more than {:.0%}.".format(len(regressions), args.tolerance))
+			return 1
+		print("No regressions.")
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+End-to-end benchmark of the communication rounds of the learner, on synthetic data, to measure how a round scales
+with the number of participants, the model and theta.
+
+For each configuration, a Federated_Learner is built on the synthetic dataset shaped for the model (see utils/Synthetic_Dataset.py,
+the classes are structured so that the accuracies are meaningful) and trained for a few rounds, and the benchmark records:
+the seconds per round in total and by the time_dict phases, the peak RSS and live tensor bytes (see Memory_Tracker),
+and the samples per second of the local training (each sample trains the five models of a participant,
+and the samples are generated as they are streamed to the participants).
+With --runtime, the participants run in worker processes (see utils/Federated_Runtime.py, or utils/Distributed_Runtime.py for gloo)
+and the benchmark also records the communication seconds and the MB to and from the participants per round.
+With --participation-fraction, only that fraction of the participants is sampled each round (see Federated_Learner.sample_participants).
+With --edge-groups, the participants are aggregated by that many edge aggregators (see utils/Edge_Aggregator.py), and the time_dict phases
+and the live tensors by owner show the work and the memory of the root apart from those of the edge aggregators.
+With --participant-store, the states of the participants are kept in a memory-mapped arena in a temporary directory and only --live-participants
+of them are in memory at a time (see utils/Participant_Store.py), in --store-dtype precision.
+With --participant-arena, the parameters of the participant models are the rows of one tensor, and the downloads are applied to them at once
+(see utils/Participant_Arena.py).
+With --fused-step, the five models of a participant take each step of the local training together, with one backward and one multi-tensor
+update of their parameters (see Participant.step_fused).
+With --fast-math, every configuration runs both in float32 and in the fast math mode of the participants on the CPU (bfloat16 autocast and
+channels last images, see utils.fast_math_context), and the summary shows the speed-up of the local training and the drift of the final
+test accuracies of each mode (cffl, pretrain, standalone, dssgd, fedavg), to decide by dataset whether to use it.
+Every configuration runs in its own process, so that the memory of one does not carry over to the next,
+and a configuration that fails (e.g. out of memory) is recorded as failed and the sweep continues.
+
+The results are written to <output_dir>/rounds.csv and a summary, the seconds per round by the number of participants
+and the seconds per participant relative to the fewest participants, to <output_dir>/summary.txt.
+
+Run from the pytorch directory, e.g.
+	python -m benchmarks.bench_rounds --models MLP CNN_Net --P 5 50 500 --theta 0.1 1 --rounds 2
+"""
+import os
+import sys
+import copy
+import time
+import argparse
+import traceback
+import contextlib
+from functools import partial
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+
+# model: (the args in utils/arguments.py to start from, the synthetic dataset, see utils/Synthetic_Dataset.py),
+# the dimensionality and classes of the tabular models are set by --dim and --classes
+MODELS = OrderedDict([
+	('LogisticRegression', ('adult_args', 'synthetic_adult')),
+	('MLP', ('adult_args', 'synthetic_adult')),
+	('MLP_Net', ('mnist_args', 'synthetic_mnist')),
+	('CNN_Net', ('mnist_args', 'synthetic_mnist')),
+	('CNNCifar', ('cifar_cnn_args', 'synthetic_cifar10')),
+	('CNNCifar_TF', ('cifar_cnn_args', 'synthetic_cifar10')),
+	('ResNet18', ('cifar_cnn_args', 'synthetic_cifar10')),
+	('VGG11', ('cifar_cnn_args', 'synthetic_cifar10')),
+	('CNN_Text', ('sst_args', 'synthetic_text')),
+])
+
+
+def get_args(model_name, P, theta, options):
+	from utils import arguments, models
+	base, dataset = MODELS[model_name]
+	args = copy.deepcopy(getattr(arguments, base))
+	n_train = options['size'] or P * options['samples_per_participant']
+	synthetic = {'n_samples': n_train, 'n_valid': options['valid_size'], 'n_test': options['test_size']}
+	args['model_fn'] = getattr(models, model_name)
+	if dataset == 'synthetic_adult':
+		synthetic.update({'shape': (options['dim'],), 'n_classes': options['classes']})
+		args['model_fn'] = partial(args['model_fn'], input_dim=options['dim'], output_dim=options['classes'])
+	args.update({'dataset': dataset, 'synthetic': synthetic, 'sample_size_cap': n_train, 'n_participants': P, 'theta': theta, 'n_freeriders': 0,
+		'split': options['split'], 'batch_size': options['batch_size'], 'pretrain_epochs': options['pretrain_epochs'], 'fl_epochs': options['rounds'],
+		'fl_individual_epochs': options['local_epochs'], 'device': torch.device('cpu'), 'device_ids': [], 'save_gpu': False,
+		'partitions_dir': None, 'lock_initializations': False, 'track_memory': True})
+	if options['runtime']:
+		args.update({'runtime': options['runtime'], 'runtime_workers': options['runtime_workers']})
+	if options['participation_fraction'] < 1:
+		args['participation_fraction'] = options['participation_fraction']
+	if options['edge_groups']:
+		args['edge_groups'] = options['edge_groups']
+	if options['participant_arena']:
+		args['participant_arena'] = True
+	if options['fused_step']:
+		args['fused_step'] = True
+	if options['fast_math']:
+		args['fast_math'] = True
+	if options['participant_store']:
+		args.update({'participant_store': True, 'live_participants': options['live_participants'], 'store_dtype': options['store_dtype']})
+	return args
+
+
+def run_config(config):
+	"""
+	Build the learner of one configuration and time its rounds, in a worker process.
+	"""
+	model_name, P, theta, options = config
+	record = OrderedDict([('model', model_name), ('P', P), ('theta', theta), ('fast_math', options['fast_math'])])
+	try:
+		from utils.Data_Prepper import Data_Prepper
+		from utils.Federated_Learner import Federated_Learner, EVALUATION_MODES
+		torch.set_num_threads(options['threads'] or torch.get_num_threads())
+		torch.manual_seed(1234)
+		args = get_args(model_name, P, theta, options)
+		record.update([('dataset', args['dataset']), ('n_train', args['sample_size_cap'])])
+
+		with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+			start = time.time()
+			data_prepper = Data_Prepper(args['dataset'], train_batch_size=args['batch_size'], n_participants=P, sample_size_cap=args['sample_size_cap'],
+				device=args['device'], args_dict=args)
+			federated_learner = Federated_Learner(args, data_prepper)
+			record['setup_seconds'] = time.time() - start
+
+			start = time.time()
+			federated_learner.start_training()
+			record['pretraining_seconds'] = time.time() - start
+
+			time_dict_before = dict(federated_learner.time_dict)
+			runtime_before = federated_learner.runtime.summary() if federated_learner.runtime is not None else None
+			start = time.time()
+			for epoch in range(args['fl_epochs']):
+				federated_learner.train_round(epoch)
+			seconds = time.time() - start
+
+		rounds = args['fl_epochs']
+		record['seconds_per_round'] = seconds / rounds
+		phase_seconds = {key: (value - time_dict_before.get(key, 0)) / rounds for key, value in federated_learner.time_dict.items()
+			if key not in ['pretraining', 'evaluation after pretraining']}
+		n_samples = int(federated_learner.shard_sizes.sum()) * args['fl_individual_epochs']
+		record['samples_per_second'] = n_samples / phase_seconds['participants local training']
+
+		memory = federated_learner.memory_tracker.summary()
+		record['peak_rss_MB'] = max(phase['peak rss'] for phase in memory.values())
+		tensors = [phase['tensors'] for phase in memory.values() if 'tensors' in phase]
+		record['peak_tensors_MB'] = max(sum(owners.values()) for owners in tensors)
+		for owner in tensors[0]:
+			record['{}_MB'.format(owner)] = max(owners[owner] for owners in tensors)
+		for mode in EVALUATION_MODES:
+			record['final_{}_test_acc'.format(mode)] = float(np.mean(federated_learner.metrics.last('test_accs', mode)))
+		if federated_learner.runtime is not None:
+			runtime = federated_learner.runtime.summary()
+			for key in ['MB to participants', 'MB from participants', 'serialization seconds']:
+				record['{} per round'.format(key)] = (runtime[key] - runtime_before[key]) / rounds
+			federated_learner.runtime.close()
+		if federated_learner.participant_store is not None:
+			record['arena_MB'] = federated_learner.participant_store.summary()['arena MB']
+			federated_learner.participant_store.close()
+		for key, value in phase_seconds.items():
+			record['{} seconds'.format(key)] = value
+		record['status'] = 'complete'
+	except Exception:
+		record['status'] = 'failed'
+		record['error'] = traceback.format_exc().strip().splitlines()[-1]
+	return record
+
+
+def summarize(df):
+	"""
+	The seconds per round by the number of participants, and the seconds per participant relative to the fewest participants:
+	1 is linear scaling in P, above 1 is worse than linear.
+	"""
+	complete = df[df['status'] == 'complete']
+	if complete.empty:
+		return "No configuration completed."
+	columns = ['model', 'theta'] + (['fast_math'] if complete['fast_math'].nunique() > 1 else [])
+	seconds = complete.pivot_table(index='P', columns=columns, values='seconds_per_round')
+	per_participant = seconds.div(seconds.index.values, axis=0)
+	relative = per_participant / per_participant.iloc[0]
+	memory = complete.pivot_table(index='P', columns=columns, values='peak_rss_MB')
+	lines = ['Seconds per round:', seconds.to_string(), '',
+		'Seconds per round per participant, relative to P={}:'.format(seconds.index[0]), relative.round(3).to_string(), '',
+		'Peak RSS (MB):', memory.to_string()]
+	if complete['fast_math'].nunique() > 1:
+		lines += ['', fast_math_summary(complete)]
+	failed = df[df['status'] != 'complete']
+	if not failed.empty:
+		lines += ['', 'Failed:', failed[['model', 'P', 'theta', 'error']].to_string(index=False)]
+	return '\n'.join(lines)
+
+
+def fast_math_summary(complete):
+	"""
+	The samples per second of the local training in the fast math mode relative to float32, and the drift of the mean final test accuracies
+	of each mode (fast math - float32), by configuration.
+	"""
+	index = ['model', 'P', 'theta']
+	by_mode = complete.set_index(index + ['fast_math'])
+	fast, exact = by_mode.xs(True, level='fast_math'), by_mode.xs(False, level='fast_math')
+	drift = pd.DataFrame({'local training speed-up': fast['samples_per_second'] / exact['samples_per_second']})
+	for column in [column for column in complete.columns if column.startswith('final_') and column.endswith('_test_acc')]:
+		drift['{} drift'.format(column[len('final_'):-len('_test_acc')])] = fast[column] - exact[column]
+	return '\n'.join(['Fast math relative to float32, the test accuracy drift by mode:', drift.dropna().round(4).to_string()])
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='End-to-end benchmark of the communication rounds on synthetic data.')
+	parser.add_argument('--models', nargs='+', default=['MLP', 'CNN_Net'], choices=list(MODELS))
+	parser.add_argument('--P', nargs='+', type=int, default=[5, 10, 20, 50, 100, 200, 500, 1000])
+	parser.add_argument('--theta', nargs='+', type=float, default=[0.1, 1.0])
+	parser.add_argument('--rounds', type=int, default=2)
+	parser.add_argument('--pretrain-epochs', type=int, default=1)
+	parser.add_argument('--local-epochs', type=int, default=1)
+	parser.add_argument('--batch-size', type=int, default=16)
+	parser.add_argument('--split', default='powerlaw')
+	parser.add_argument('--samples-per-participant', type=int, default=64)
+	parser.add_argument('--size', type=int, default=None, help='the number of train samples, instead of per participant')
+	parser.add_argument('--valid-size', type=int, default=500)
+	parser.add_argument('--test-size', type=int, default=500)
+	parser.add_argument('--dim', type=int, default=86, help='the dimensionality of the samples of the tabular models')
+	parser.add_argument('--classes', type=int, default=2, help='the number of classes of the tabular models')
+	parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+	parser.add_argument('--runtime', default=None, choices=['loopback', 'unix', 'tcp', 'gloo'],
+		help='run the participants in worker processes, see utils/Federated_Runtime.py and utils/Distributed_Runtime.py, to measure the communication')
+	parser.add_argument('--runtime-workers', type=int, default=1)
+	parser.add_argument('--participation-fraction', type=float, default=1.0, help='the fraction of the participants sampled in each round')
+	parser.add_argument('--edge-groups', type=int, default=None, help='the number of edge aggregators of the two-level topology')
+	parser.add_argument('--participant-store', action='store_true', help='keep the states of the participants in a memory-mapped arena')
+	parser.add_argument('--live-participants', type=int, default=2)
+	parser.add_argument('--store-dtype', default='float32', choices=['float32', 'float16', 'bfloat16'])
+	parser.add_argument('--participant-arena', action='store_true', help='keep the parameters of the participant models in one tensor')
+	parser.add_argument('--fused-step', action='store_true', help='step the five models of a participant together in the local training')
+	parser.add_argument('--fast-math', action='store_true', help='run every configuration in float32 and in the fast math mode, to compare them')
+	parser.add_argument('--output-dir', default='benchmark_rounds')
+	args = parser.parse_args(argv)
+
+	options = {key: getattr(args, key) for key in ['rounds', 'pretrain_epochs', 'local_epochs', 'batch_size', 'split', 'samples_per_participant',
+		'size', 'valid_size', 'test_size', 'dim', 'classes', 'threads', 'runtime', 'runtime_workers', 'participation_fraction', 'edge_groups',
+		'participant_store', 'live_participants', 'store_dtype', 'participant_arena', 'fused_step']}
+	configs = [(model_name, P, theta, dict(options, fast_math=fast_math)) for model_name in args.models for theta in args.theta for P in sorted(args.P)
+		for fast_math in ([False, True] if args.fast_math else [False])]
+
+	os.makedirs(args.output_dir, exist_ok=True)
+	records = []
+	ctx = mp.get_context('spawn')
+	# a fresh process for each configuration
+	with ctx.Pool(1, maxtasksperchild=1) as pool:
+		for record in pool.imap(run_config, configs):
+			records.append(record)
+			print("{} with P={}, theta={}{}: {}".format(record['model'], record['P'], record['theta'], ', fast math' if record['fast_math'] else '',
+				'{:.3f} seconds per round'.format(record['seconds_per_round']) if record['status'] == 'complete' else record['error']))
+			pd.DataFrame(records).to_csv(os.path.join(args.output_dir, 'rounds.csv'), index=False)
+
+	summary = summarize(pd.DataFrame(records))
+	with open(os.path.join(args.output_dir, 'summary.txt'), 'w') as file:
+		file.write(summary + '\n')
+	print()
+	print(summary)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
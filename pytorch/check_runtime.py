@@ -0,0 +1,46 @@
+"""
+Checks that the participants give the same results in worker processes (args['runtime'], see utils/Federated_Runtime.py)
+as in the process of the learner: a small adult experiment is run in process and with each transport, and the
+performance dicts and the per-round metrics must be exactly the same.
+
+Run from the pytorch directory:
+	python check_runtime.py
+	python check_runtime.py loopback unix
+"""
+import sys
+import copy
+import json
+
+from utils.Data_Prepper import Data_Prepper
+from utils.Federated_Learner import Federated_Learner
+from utils.Federated_Runtime import TRANSPORTS
+from utils.arguments import adult_args, update_gpu
+from main import init_deterministic
+
+
+def run(args):
+	update_gpu(args)
+	init_deterministic()
+	data_prep = Data_Prepper(args['dataset'],
+		train_batch_size=args['batch_size'], n_participants=args['n_participants'], sample_size_cap=args['sample_size_cap'],
+		train_val_split_ratio=args['train_val_split_ratio'], device=args['device'], args_dict=args)
+	federated_learner = Federated_Learner(args, data_prep)
+	federated_learner.train()
+	federated_learner.get_fairness_analysis()
+	metrics = {'.'.join(key): values for key, values in federated_learner.metrics.state_dict().items()}
+	return json.dumps([federated_learner.performance_dict, federated_learner.performance_dict_pretrain, metrics], default=str)
+
+
+if __name__ == '__main__':
+	args = copy.deepcopy(adult_args)
+	args.update({'fl_epochs': 3, 'n_participants': 4, 'sample_size_cap': 2000, 'n_freeriders': 1})
+
+	expected = run(copy.deepcopy(args))
+	mismatches = []
+	for transport in sys.argv[1:] or TRANSPORTS:
+		runtime_args = dict(copy.deepcopy(args), runtime=transport, runtime_workers=2)
+		same = run(runtime_args) == expected
+		print("{}: {}".format(transport, 'same' if same else 'DIFFERENT'))
+		if not same:
+			mismatches.append(transport)
+	sys.exit(1 if mismatches else 0)
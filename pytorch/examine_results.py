@@ -6,6 +6,7 @@ import ast
 import numpy as np
 
 from utils.read_convergence import plot_convergence, parse, get_cffl_best
+from utils.Results_Catalog import Results_Catalog
 
 fairness_keys = [
 		'standalone_vs_fedavg_mean',
@@ -13,25 +14,21 @@ fairness_keys = [
 		'standalone_vs_final_mean',
 		]
 
-def collect_and_compile_performance(dirname):
-
+def compile_tables(runs):
+	"""
+	The fairness and performance tables of the runs from Results_Catalog.query().
+	"""
 	fairness_rows = []
 	performance_rows = []
-	for folder in os.listdir(dirname):
-		if os.path.isfile(os.path.join(dirname, folder)) or not 'complete.txt' in os.listdir(os.path.join(dirname, folder)):
-			continue
-
-		setup = parse(dirname, folder)
+	for run in runs:
+		setup = run['setup']
 		n_participants = setup['P']
 		fl_epochs = setup['Communication Rounds']
 		theta = setup['theta']
 
 		try:
-			with open(os.path.join(dirname, folder, 'aggregate_dict.txt')) as dict_log:
-				aggregate_dict = json.loads(dict_log.read())
-
-			with open(os.path.join(dirname, folder, 'aggregate_dict_pretrain.txt')) as dict_log:
-				aggregate_dict_pretrain = json.loads(dict_log.read())
+			aggregate_dict = run['aggregate_dict']
+			aggregate_dict_pretrain = run['aggregate_dict_pretrain']
 
 			f_data_row = ['P' + str(n_participants) + '_' + str(theta)] + [aggregate_dict[f_key][0] for f_key in fairness_keys]
 			f_data_row.append(aggregate_dict_pretrain['standalone_vs_final_mean'][0])
@@ -53,31 +50,45 @@ def collect_and_compile_performance(dirname):
 	fair_df = pd.DataFrame(fairness_rows, columns=[' '] + shorthand_f_keys).set_index(' ')
 	fair_df = fair_df.sort_values(' ')
 	print(fair_df.to_markdown())
-	
-	print(os.path.join(dirname, 'fairness.csv'))
-	fair_df.to_csv( os.path.join(dirname, 'fairness.csv'))
 
 	shorthand_p_keys = ['Fedavg', 'DSSGD', 'Standalone', 'CFFL', 'CFFL pretrain']
 	pd.options.display.float_format = '{:,.2f}'.format
 	perf_df = pd.DataFrame(performance_rows, columns=[' '] + shorthand_p_keys).set_index(' ').T
 	perf_df = perf_df[sorted(perf_df.columns)]
 	print(perf_df.to_markdown())
+
+	return fair_df, perf_df
+
+
+def collect_and_compile_performance(dirname, catalog=None, **filters):
+	"""
+	filters: to compile the tables of only some of the runs, e.g. theta=0.1, see Results_Catalog.query()
+	"""
+	if catalog is None:
+		catalog = Results_Catalog()
+		catalog.ingest(dirname)
+
+	fair_df, perf_df = compile_tables(catalog.query(dirname, **filters))
+
+	print(os.path.join(dirname, 'fairness.csv'))
+	fair_df.to_csv( os.path.join(dirname, 'fairness.csv'))
 	perf_df.to_csv( os.path.join(dirname, 'performance.csv'))
 
 	return fair_df, perf_df
 
 
-def collate_pngs(dirname):
+def collate_pngs(dirname, catalog=None):
 	os.makedirs(os.path.join(dirname, 'figures'), exist_ok=True)
 	figures_dir = os.path.join(dirname, 'figures')
-	
-	for directory in os.listdir(dirname):
-		if os.path.isfile(os.path.join(dirname, directory)) or not 'complete.txt' in os.listdir(os.path.join(dirname, directory)):
-			continue
 
-		setup = parse(dirname, directory)
+	if catalog is None:
+		catalog = Results_Catalog()
+		catalog.ingest(dirname)
+
+	for run in catalog.query(dirname):
+		setup = run['setup']
 
-		subdir = os.path.join(dirname, directory)
+		subdir = run['logdir']
 
 		figure_name = '{}_{}_p{}e{}_cffl_localepoch{}_localbatch{}_lr{}_upload{}_pretrain0.png'.format(
 			setup['dataset'],  setup['model'],
@@ -105,10 +116,13 @@ def collate_pngs(dirname):
 	return
 
 
-def examine(dirname):
+def examine(dirname, catalog_path='results_catalog.sqlite'):
+	catalog = Results_Catalog(catalog_path)
+	catalog.ingest(dirname)
 	experiment_results = plot_convergence(dirname)
-	collate_pngs(dirname)
-	fair_df, perf_df = collect_and_compile_performance(dirname)
+	collate_pngs(dirname, catalog)
+	fair_df, perf_df = collect_and_compile_performance(dirname, catalog)
+	catalog.close()
 
 if __name__ == '__main__':
 		
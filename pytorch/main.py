@@ -5,6 +5,7 @@ import copy
 import time
 import datetime
 import random
+import contextlib
 from itertools import product
 
 import numpy as np
@@ -13,6 +14,11 @@ from torch import nn, optim
 
 from utils.Data_Prepper import Data_Prepper
 from utils.Federated_Learner import Federated_Learner
+from utils.Result_Store import Result_Store, args_hash
+from utils.Metrics_Store import get_metrics_dir
+from utils.Results_Catalog import Results_Catalog
+from utils.Repeat_Engine import Repeat_Engine, seed_repeat, export_diagnostics
+from utils.utils import seeded_repeats
 from examine_results import examine
 
 from torch.multiprocessing import Pool, Process, set_start_method
@@ -47,22 +53,52 @@ def write_aggregate_dict(performance_dicts, filename):
 	return
 
 
-def run_experiments(args, repeat=5, logs_dir='logs'):
-	update_gpu(args)
-	init_deterministic()
-
-	# init steps
+def get_logdir(args, repeat=5, logs_dir='logs'):
 	model_name = str(args['model_fn']).split('.')[-1][:-2]
 	subdir = "{}_p{}_e{}-{}-{}_b{}_size{}_lr{}_theta{}_{}runs_{}_a{}_fr{}_{}".format(args['dataset']+'@'+args['split'],args['n_participants'], 
 							args['pretrain_epochs'], args['fl_epochs'], args['fl_individual_epochs'],
 							args['batch_size'], args['sample_size_cap'], args['lr'], args['theta'],
 							str(repeat), args['aggregate_mode'], args['alpha'],args['n_freeriders'], model_name,
 							)
-	logdir = os.path.join(logs_dir, subdir)
-	os.makedirs(logdir, exist_ok=True)
+	# the hash of all the args that affect the results, so that configs that differ only in the others (e.g. gamma) have their own directories,
+	# but not of the code version: a config keeps its directory across code changes, and is recomputed in it, see run_experiments_in
+	subdir += '_' + args_hash(args, repeat)[:10]
+	return os.path.join(logs_dir, subdir)
+
+@contextlib.contextmanager
+def logdir_lock(logdir):
+	# one process at a time in a log directory, e.g. the same config twice in a sweep, released if the process dies
+	try:
+		import fcntl
+	except ImportError:
+		yield
+		return
+	with open(os.path.join(logdir, 'lock'), 'w') as file:
+		fcntl.flock(file, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(file, fcntl.LOCK_UN)
+
+def run_experiments(args, repeat=5, logs_dir='logs'):
+	update_gpu(args)
+	init_deterministic()
 
-	if 'complete.txt' in os.listdir(logdir):
+	# init steps
+	logdir = get_logdir(args, repeat, logs_dir)
+	os.makedirs(logdir, exist_ok=True)
+	with logdir_lock(logdir):
+		run_experiments_in(logdir, args, repeat)
+
+def run_experiments_in(logdir, args, repeat):
+	# the result store first: a log directory is complete only with its config in the store, otherwise it is computed again
+	result_store = Result_Store(args.get('result_store', 'result_store'))
+	cached = result_store.get(args, repeat)
+	if cached is not None and 'complete.txt' in os.listdir(logdir):
 		return
+	for filename in ['complete.txt', 'performance_dict.log', 'performance_dict_pretrain.log']:
+		if os.path.isfile(os.path.join(logdir, filename)):
+			os.remove(os.path.join(logdir, filename))
 
 	with open(os.path.join(logdir,'settings_dict.txt'), 'w') as file:
 		[file.write(key + ' : ' + str(value) + '\n') for key,value in args.items()]
@@ -71,6 +107,15 @@ def run_experiments(args, repeat=5, logs_dir='logs'):
 	sys.stdout = log
 	print("Experimental settings are: ", args, '\n')
 
+	if cached is not None:
+		print("Serving the results from the result store: ", result_store.get_dir(args, repeat))
+		performance_dicts, performance_dicts_pretrain = cached
+		result_store.copy_metrics(args, repeat, logdir)
+		for performance_dict, performance_dict_pretrain in zip(performance_dicts, performance_dicts_pretrain):
+			write_performance_logs(logdir, performance_dict, performance_dict_pretrain)
+		complete_experiments(logdir, performance_dicts, performance_dicts_pretrain, args.get('results_catalog', 'results_catalog.sqlite'))
+		return
+
 	performance_dicts = []
 	performance_dicts_pretrain = []
 	
@@ -81,55 +126,87 @@ def run_experiments(args, repeat=5, logs_dir='logs'):
 		train_batch_size=args['batch_size'], n_participants=args['n_participants'], sample_size_cap=args['sample_size_cap'], 
 		train_val_split_ratio=args['train_val_split_ratio'], device=args['device'], args_dict=args)
 
+	if args.get('co_schedule_repeats', False):
+		# all the repeats at once, with the same results as below with args['seed_repeats']
+		federated_learners = Repeat_Engine(args, data_prep, repeat, logdir).train()
+	else:
+		federated_learners = run_repeats_sequentially(args, data_prep, repeat, logdir)
+
+	for federated_learner in federated_learners:
+		performance_dicts.append(federated_learner.performance_dict)
+		performance_dicts_pretrain.append(federated_learner.performance_dict_pretrain)
+		write_performance_logs(logdir, federated_learner.performance_dict, federated_learner.performance_dict_pretrain)
+
+	result_store.put(args, repeat, performance_dicts, performance_dicts_pretrain, logdir)
+	complete_experiments(logdir, performance_dicts, performance_dicts_pretrain, args.get('results_catalog', 'results_catalog.sqlite'))
+	return
+
+def run_repeats_sequentially(args, data_prep, repeat, logdir=None):
 	for i in range(repeat):
+		if seeded_repeats(args):
+			seed_repeat(i)
 		print()
 		print("Experiment : No.{}/{}".format(str(i+1) ,str(repeat)))
 		# data_prep = Data_Prepper(args['dataset'], train_batch_size=args['batch_size'], sample_size_cap=args['sample_size_cap'], train_val_split_ratio=args['train_val_split_ratio'])
-		federated_learner = Federated_Learner(args, data_prep)
+		federated_learner = Federated_Learner(args, data_prep, metrics_dir=get_metrics_dir(logdir, i) if logdir else None)
 
 		# train
 		federated_learner.train()
 		# analyze
 		federated_learner.get_fairness_analysis()
+		export_diagnostics(federated_learner, logdir, i)
+		yield federated_learner
 
-		performance_dicts.append(federated_learner.performance_dict)
-		
-		with open(os.path.join(logdir, 'performance_dict.log'), 'a') as log:
-			log.write(json.dumps(federated_learner.performance_dict))
-			log.write('\n')
-
-		performance_dicts_pretrain.append(federated_learner.performance_dict_pretrain)
-		with open(os.path.join(logdir, 'performance_dict_pretrain.log'), 'a') as log:
-			log.write(json.dumps(federated_learner.performance_dict_pretrain))
-			log.write('\n')
+def write_performance_logs(logdir, performance_dict, performance_dict_pretrain):
+	with open(os.path.join(logdir, 'performance_dict.log'), 'a') as log:
+		log.write(json.dumps(performance_dict))
+		log.write('\n')
 
+	with open(os.path.join(logdir, 'performance_dict_pretrain.log'), 'a') as log:
+		log.write(json.dumps(performance_dict_pretrain))
+		log.write('\n')
 
+def complete_experiments(logdir, performance_dicts, performance_dicts_pretrain, results_catalog=None):
 	write_aggregate_dict(performance_dicts, os.path.join(logdir, 'aggregate_dict.txt'))
 	write_aggregate_dict(performance_dicts_pretrain, os.path.join(logdir, 'aggregate_dict_pretrain.txt'))
 
 	with open(os.path.join(logdir, 'complete.txt'), 'w') as file:
 		file.write('complete')
 
-	return
+	if results_catalog:
+		catalog = Results_Catalog(results_catalog)
+		catalog.ingest_run(logdir)
+		catalog.close()
 
 def get_parallel_groups(experiment_args, parallel_size=4):
 	experiment_args = np.asarray(experiment_args)
 	from math import ceil
 	return np.array_split(experiment_args, ceil(len(experiment_args)/parallel_size))
 
-def run_experiments_full(experiment_args, repeat=1):
+def get_timestamp():
+	return datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H:%M')
 
+def run_experiments_full(experiment_args, repeat=1, n_workers=1, threads_per_worker=None, experiment_dir=None, timestamp=None):
+	"""
+	n_workers: number of configs to run in parallel worker processes, see sweep.run_sweep.
+	None to use all the available cores. Default: 1, sequential in this process.
+	experiment_dir: the directory of the experiments, an existing one to resume them: the complete configs are skipped.
+	Default: <dataset>/Experiments_<timestamp>
+	timestamp: of the default experiment_dir, that of an earlier run to resume it. Default: now
+	"""
 
-	ts = time.time()
-	st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d-%H:%M')
-	experiment_dir = 'Experiments_{}'.format(st)
-	experiment_dir = os.path.join("{}".format(experiment_args[0]['dataset']), experiment_dir)
+	if experiment_dir is None:
+		experiment_dir = os.path.join("{}".format(experiment_args[0]['dataset']), 'Experiments_{}'.format(timestamp or get_timestamp()))
 
 	os.makedirs(experiment_dir, exist_ok=True)
 	
 
-	for args in experiment_args:
-		run_experiments(args, repeat, experiment_dir)
+	if n_workers == 1:
+		for args in experiment_args:
+			run_experiments(args, repeat, experiment_dir)
+	else:
+		from sweep import run_sweep
+		run_sweep(experiment_args, repeat, experiment_dir, n_workers=n_workers, threads_per_worker=threads_per_worker)
 
 	try:
 		examine(experiment_dir)
@@ -150,6 +227,8 @@ def init_deterministic():
 
 if __name__ == '__main__':
 	# init steps	
+	# python main.py <timestamp> resumes the experiments of an interrupted run, e.g. 2020-06-01-12:00
+	timestamp = sys.argv[1] if len(sys.argv) > 1 else get_timestamp()
 
 	experiment_args = []	
 	args = copy.deepcopy(mnist_args)
@@ -165,7 +244,7 @@ if __name__ == '__main__':
 				args['lr'] = 0.25
 
 			experiment_args.append(copy.deepcopy(args))
-	run_experiments_full(experiment_args, repeat=1)
+	run_experiments_full(experiment_args, repeat=1, timestamp=timestamp)
 
 	experiment_args = []	
 	args = copy.deepcopy(mnist_args)
@@ -182,7 +261,7 @@ if __name__ == '__main__':
 			args['fl_individual_epochs'] = 1
 
 			experiment_args.append(copy.deepcopy(args))
-	run_experiments_full(experiment_args, repeat=1)
+	run_experiments_full(experiment_args, repeat=1, timestamp=timestamp)
 
 
 
@@ -195,7 +274,7 @@ if __name__ == '__main__':
 			args['theta'] = theta
 
 			experiment_args.append(copy.deepcopy(args))
-	run_experiments_full(experiment_args, repeat=1)
+	run_experiments_full(experiment_args, repeat=1, timestamp=timestamp)
 
 
 
@@ -210,4 +289,4 @@ if __name__ == '__main__':
 			args['theta'] = theta
 
 			experiment_args.append(copy.deepcopy(args))
-	run_experiments_full(experiment_args, repeat=1)
\ No newline at end of file
+	run_experiments_full(experiment_args, repeat=1, timestamp=timestamp)
\ No newline at end of file
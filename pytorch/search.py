@@ -0,0 +1,193 @@
+"""
+Successive-halving search over the hyperparameters of the learner.
+
+Every candidate, e.g. a (lr, theta, alpha, reputation_threshold_coef) combination, is run for a small
+number of communication rounds and ranked on the CFFL validation accuracies of the participants
+(the per-round participant_val_accs the learner computes for the reputations). Only the best 1/eta
+of the candidates continue to the next rung, which is eta times as many rounds, up to fl_epochs.
+Every candidate is constructed and trained from the random state right after the data preparation, as the
+first repeat of main.py is, the learners are checkpointed at the end of each rung and the survivors resume
+from their checkpoints, so a survivor that reaches fl_epochs has the same results as a full run with its hyperparameters.
+An interrupted search is resumed from the checkpoints by running it again on the same search_dir.
+
+The ranking and the rounds of each candidate are written to <search_dir>/search_manifest.json,
+and the results of the best candidate are written to a log directory under <search_dir>, as in main.py.
+"""
+import os
+import copy
+import json
+import time
+from itertools import product
+
+import numpy as np
+import torch
+
+from utils.Data_Prepper import Data_Prepper
+from utils.Federated_Learner import Federated_Learner
+from utils.arguments import update_gpu
+from utils.utils import get_rng_state, set_rng_state
+from utils.Metrics_Store import get_metrics_dir
+from main import init_deterministic, get_logdir, write_performance_logs, complete_experiments
+
+
+MANIFEST = 'search_manifest.json'
+
+# the args a candidate may override, they must not change the data preparation
+SEARCH_KEYS = ['lr', 'theta', 'alpha', 'reputation_threshold_coef']
+
+
+def get_candidates(args, **grid):
+	"""
+	All the combinations of the values in <grid>, e.g. get_candidates(args, lr=[0.1, 0.15, 0.25], theta=[0.1, 1]).
+	"""
+	for key in grid:
+		assert key in SEARCH_KEYS, "Cannot search over {}, only over {}.".format(key, SEARCH_KEYS)
+	keys = sorted(grid)
+	candidates = []
+	for values in product(*[grid[key] for key in keys]):
+		candidate = copy.deepcopy(args)
+		candidate.update(zip(keys, values))
+		candidates.append(candidate)
+	return candidates
+
+
+def get_candidate_name(args):
+	return '_'.join('{}{}'.format(key, args[key]) for key in SEARCH_KEYS if key in args)
+
+
+def get_rung_budgets(fl_epochs, min_rounds, eta):
+	budgets = []
+	budget = min_rounds
+	while budget < fl_epochs:
+		budgets.append(budget)
+		budget *= eta
+	budgets.append(fl_epochs)
+	return budgets
+
+
+def get_round_score(federated_learner):
+	# the mean validation accuracy of the honest participants, the free riders are the first participants
+	return float(np.mean(federated_learner.participant_val_accs[federated_learner.n_freeriders:]))
+
+
+def get_score(round_scores, window, rounds):
+	# averaged over the last few rounds of the rung, as the validation accuracies of a single round are noisy
+	return float(np.mean(round_scores[:rounds][-window:]))
+
+
+def write_manifest(search_dir, manifest):
+	path = os.path.join(search_dir, MANIFEST)
+	with open(path + '.tmp', 'w') as file:
+		file.write(json.dumps(manifest, indent=1))
+	os.replace(path + '.tmp', path)
+
+
+def run_candidate(args, data_prep, checkpoint_path, budget, rng_state):
+	"""
+	Resume the candidate from its checkpoint if there is one, otherwise start it from <rng_state>, the random state after
+	the data preparation, and train it until <budget> rounds are completed.
+	Returns the learner and the scores of all its rounds.
+	"""
+	if os.path.isfile(checkpoint_path):
+		federated_learner = Federated_Learner(args, data_prep)
+		checkpoint = torch.load(checkpoint_path)
+		federated_learner.load_state_dict(checkpoint['learner'])
+		round_scores = checkpoint['round_scores']
+	else:
+		# before the learner, which initializes its models from the random state
+		set_rng_state(rng_state)
+		federated_learner = Federated_Learner(args, data_prep)
+		federated_learner.start_training()
+		round_scores = []
+
+	if federated_learner.rounds_completed < budget:
+		while federated_learner.rounds_completed < budget:
+			federated_learner.train_round(federated_learner.rounds_completed)
+			round_scores.append(get_round_score(federated_learner))
+		torch.save({'learner': federated_learner.state_dict(), 'round_scores': round_scores}, checkpoint_path)
+	return federated_learner, round_scores
+
+
+def successive_halving(candidates, min_rounds=10, eta=3, window=3, search_dir='search', keep_checkpoints=False):
+	"""
+	candidates: the args of the candidates, see get_candidates(), all with the same data and fl_epochs
+	min_rounds: the number of rounds of the first rung
+	eta: the fraction 1/eta of the candidates survive each rung, and the next rung has eta times the rounds
+	window: the candidates are ranked on the mean score of their last <window> rounds
+
+	Returns the args and the Federated_Learner of the best candidate.
+	"""
+	base_args = candidates[0]
+	for args in candidates:
+		for key, value in args.items():
+			if key not in SEARCH_KEYS:
+				assert str(value) == str(base_args[key]), "The candidates can only differ in {}, but differ in {}.".format(SEARCH_KEYS, key)
+
+	update_gpu(base_args)
+	for args in candidates:
+		args['device'], args['device_ids'] = base_args['device'], base_args['device_ids']
+	init_deterministic()
+
+	checkpoint_dir = os.path.join(search_dir, 'checkpoints')
+	os.makedirs(checkpoint_dir, exist_ok=True)
+
+	# the candidates only differ in the learner, so the data is prepared once
+	data_prep = Data_Prepper(base_args['dataset'],
+		train_batch_size=base_args['batch_size'], n_participants=base_args['n_participants'], sample_size_cap=base_args['sample_size_cap'],
+		train_val_split_ratio=base_args['train_val_split_ratio'], device=base_args['device'], args_dict=base_args)
+	rng_state = get_rng_state()
+
+	budgets = get_rung_budgets(base_args['fl_epochs'], min_rounds, eta)
+	names = [get_candidate_name(args) for args in candidates]
+	round_scores = [[] for _ in candidates]
+	manifest = {'budgets': budgets, 'eta': eta, 'window': window, 'rungs': [],
+		'candidates': [{'name': name, 'args': {key: args[key] for key in SEARCH_KEYS if key in args}} for name, args in zip(names, candidates)]}
+
+	survivors = list(range(len(candidates)))
+	for rung, budget in enumerate(budgets):
+		start = time.time()
+		for index in survivors:
+			checkpoint_path = os.path.join(checkpoint_dir, names[index] + '.pt')
+			_, round_scores[index] = run_candidate(candidates[index], data_prep, checkpoint_path, budget, rng_state)
+
+		ranked = sorted(survivors, key=lambda index: get_score(round_scores[index], window, budget), reverse=True)
+		n_survivors = 1 if rung == len(budgets) - 1 else max(1, len(ranked) // eta)
+		for index in ranked[n_survivors:]:
+			if not keep_checkpoints:
+				os.remove(os.path.join(checkpoint_dir, names[index] + '.pt'))
+		survivors = ranked[:n_survivors]
+
+		manifest['rungs'].append({'rung': rung, 'rounds': budget, 'seconds': round(time.time() - start, 3),
+			'ranking': [{'name': names[index], 'score': get_score(round_scores[index], window, budget)} for index in ranked],
+			'survivors': [names[index] for index in survivors]})
+		for index, candidate in enumerate(manifest['candidates']):
+			candidate['round_scores'] = round_scores[index]
+		write_manifest(search_dir, manifest)
+		print("Rung {}: {} candidates for {} rounds, best {} with score {:.4f}.".format(
+			rung, len(ranked), budget, names[ranked[0]], get_score(round_scores[ranked[0]], window, budget)))
+
+	best = survivors[0]
+	best_args = candidates[best]
+	federated_learner, _ = run_candidate(best_args, data_prep, os.path.join(checkpoint_dir, names[best] + '.pt'), budgets[-1], rng_state)
+	federated_learner.finish_training()
+	federated_learner.get_fairness_analysis()
+
+	logdir = get_logdir(best_args, 1, search_dir)
+	os.makedirs(logdir, exist_ok=True)
+	with open(os.path.join(logdir, 'settings_dict.txt'), 'w') as file:
+		[file.write(key + ' : ' + str(value) + '\n') for key, value in best_args.items()]
+	federated_learner.metrics.save(get_metrics_dir(logdir, 0))
+	write_performance_logs(logdir, federated_learner.performance_dict, federated_learner.performance_dict_pretrain)
+	complete_experiments(logdir, [federated_learner.performance_dict], [federated_learner.performance_dict_pretrain])
+
+	manifest['best'] = {'name': names[best], 'logdir': logdir}
+	write_manifest(search_dir, manifest)
+	return best_args, federated_learner
+
+
+if __name__ == '__main__':
+	from utils.arguments import cifar_cnn_args
+
+	args = copy.deepcopy(cifar_cnn_args)
+	candidates = get_candidates(args, lr=[0.005, 0.01, 0.015], theta=[0.1, 1], alpha=[3, 5, 7], reputation_threshold_coef=[1 / 6.0, 1 / 3.0])
+	successive_halving(candidates, min_rounds=10, eta=3, search_dir=os.path.join(args['dataset'], 'Search'))
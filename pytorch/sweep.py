@@ -0,0 +1,146 @@
+"""
+Sweep scheduler: runs the experiment configs from main.py in a pool of worker processes.
+
+The available cores are split between the workers, each worker is pinned to its own cpu set and
+runs torch with that many intra-op threads. Configs that are already complete are skipped, so an
+interrupted sweep can be resumed by running it again on the same experiment_dir.
+Progress and per-config timings are written to <experiment_dir>/sweep_manifest.json.
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+
+MANIFEST = 'sweep_manifest.json'
+
+# the cpu set of this worker process, set in init_worker
+worker_cpus = None
+
+
+def get_available_cpus():
+	if hasattr(os, 'sched_getaffinity'):
+		return sorted(os.sched_getaffinity(0))
+	return list(range(os.cpu_count()))
+
+
+def split_cpus(cpus, n_workers, threads_per_worker=None):
+	if not threads_per_worker:
+		threads_per_worker = max(1, len(cpus) // n_workers)
+	cpu_sets = []
+	for worker_id in range(n_workers):
+		cpu_set = cpus[worker_id * threads_per_worker: (worker_id + 1) * threads_per_worker]
+		# oversubscribed: more workers than cores, wrap around
+		cpu_sets.append(cpu_set or [cpus[worker_id % len(cpus)]])
+	return cpu_sets, threads_per_worker
+
+
+def init_worker(cpu_set_queue, threads_per_worker, pin_cpus):
+	global worker_cpus
+	worker_cpus = cpu_set_queue.get()
+	if pin_cpus and hasattr(os, 'sched_setaffinity'):
+		os.sched_setaffinity(0, worker_cpus)
+	torch.set_num_threads(threads_per_worker)
+	try:
+		torch.set_num_interop_threads(1)
+	except RuntimeError:
+		pass
+
+
+def run_config(job):
+	index, args, repeat, experiment_dir = job
+	from main import run_experiments
+
+	record = {'index': index, 'pid': os.getpid(), 'cpus': worker_cpus,
+		'started': datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')}
+	stdout = sys.stdout
+	start = time.time()
+	try:
+		# run_experiments redirects sys.stdout to the log of the config
+		run_experiments(args, repeat, experiment_dir)
+		record['status'] = 'complete'
+	except Exception:
+		record['status'] = 'failed'
+		record['error'] = traceback.format_exc()
+	finally:
+		if sys.stdout is not stdout:
+			sys.stdout.close()
+			sys.stdout = stdout
+	record['seconds'] = round(time.time() - start, 3)
+	record['finished'] = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+	return record
+
+
+def write_manifest(experiment_dir, manifest):
+	path = os.path.join(experiment_dir, MANIFEST)
+	with open(path + '.tmp', 'w') as file:
+		file.write(json.dumps(manifest, indent=1))
+	os.replace(path + '.tmp', path)
+
+
+def is_complete(logdir, cached):
+	# complete in the result store first, and then in the log directory, as in run_experiments
+	return cached and os.path.isfile(os.path.join(logdir, 'complete.txt'))
+
+
+def run_sweep(experiment_args, repeat, experiment_dir, n_workers=None, threads_per_worker=None, pin_cpus=True):
+	from main import get_logdir
+	from utils.Result_Store import Result_Store
+
+	os.makedirs(experiment_dir, exist_ok=True)
+	# keep the records of the configs completed by a previous run of this sweep
+	previous = {}
+	if os.path.isfile(os.path.join(experiment_dir, MANIFEST)):
+		with open(os.path.join(experiment_dir, MANIFEST)) as file:
+			previous = {entry['logdir']: entry for entry in json.loads(file.read())['configs']}
+
+	manifest = {'experiment_dir': experiment_dir, 'repeat': repeat, 'configs': []}
+	pending = []
+	for index, args in enumerate(experiment_args):
+		logdir = get_logdir(args, repeat, experiment_dir)
+		entry = {'index': index, 'logdir': logdir, 'dataset': args['dataset'], 'n_participants': args['n_participants'], 'theta': args['theta']}
+		cached = Result_Store(args.get('result_store', 'result_store')).contains(args, repeat)
+		if is_complete(logdir, cached):
+			entry.update(previous.get(logdir, {'status': 'skipped'}))
+			entry['index'] = index
+		else:
+			entry['status'] = 'pending'
+			# already computed under another experiment directory, only needs to be copied over
+			entry['cached'] = cached
+			pending.append((index, args, repeat, experiment_dir))
+		manifest['configs'].append(entry)
+
+	cpus = get_available_cpus()
+	if not n_workers:
+		n_workers = max(1, len(cpus) // (threads_per_worker or 1))
+	n_workers = max(1, min(n_workers, len(pending)))
+	cpu_sets, threads_per_worker = split_cpus(cpus, n_workers, threads_per_worker)
+
+	manifest.update({'n_workers': n_workers, 'threads_per_worker': threads_per_worker, 'cpu_sets': cpu_sets})
+	write_manifest(experiment_dir, manifest)
+	n_cached = sum(entry.get('cached', False) for entry in manifest['configs'])
+	print("Sweep: {} configs to run ({} served from the result store), {} already complete, with {} workers x {} threads.".format(
+		len(pending), n_cached, len(experiment_args) - len(pending), n_workers, threads_per_worker))
+	if not pending:
+		return manifest
+
+	start = time.time()
+	ctx = mp.get_context('spawn')
+	cpu_set_queue = ctx.Queue()
+	for cpu_set in cpu_sets:
+		cpu_set_queue.put(cpu_set)
+
+	with ctx.Pool(n_workers, initializer=init_worker, initargs=(cpu_set_queue, threads_per_worker, pin_cpus)) as pool:
+		for record in pool.imap_unordered(run_config, pending):
+			manifest['configs'][record['index']].update(record)
+			write_manifest(experiment_dir, manifest)
+			print("Sweep: config {} {} in {} seconds.".format(record['index'], record['status'], record['seconds']))
+
+	manifest['seconds'] = round(time.time() - start, 3)
+	write_manifest(experiment_dir, manifest)
+	return manifest
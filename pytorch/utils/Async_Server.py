@@ -0,0 +1,237 @@
+import numpy as np
+import torch
+
+from utils.Federated_Learner import allocate_download, compute_reputations_partial
+from utils.utils import evaluate, add_update_to_model, flatten, unflatten
+
+
+# the state of the server besides the learner's, see state_dict()
+ASYNC_STATE = ['clock', 'version', 'finish_times', 'waiting', 'uploads', 'download_versions', 'snapshots', 'raw_reputations',
+				'val_accs', 'staleness', 'staleness_total', 'waiting_seconds']
+
+# the learner attributes of the federated model, reputations, reputation threshold and reputable participants of each track
+TRACK_STATE = {
+	'cffl': ('federated_model', 'reputations', 'reputation_threshold', 'R'),
+	'pretrain': ('federated_model_pretrain', 'reputations_pretrain', 'reputation_threshold_pretrain', 'R_pretrain'),
+}
+
+
+class Async_Server():
+	"""
+	The server of the asynchronous mode (args['asynchronous']): in place of the synchronous rounds, each participant uploads
+	as soon as its local training finishes, and the server applies every upload on its arrival.
+
+	The arrivals are ordered on a simulated clock, so the runs stay deterministic: the local training of participant i takes
+	its samples per round (its shard, capped by epoch_sample_size, times fl_individual_epochs) / participant_speeds[i],
+	and the freeriders pretend to train on the average shard. On the arrival of participant i, the server
+	1. evaluates the upload on the current federated model and updates the reputation of i alone, see compute_reputations_partial,
+	2. adds the upload of a reputable participant with its aggregation weight, discounted by (1 + staleness) ** -staleness_exponent,
+	   where the staleness is the number of arrivals since the last download of i,
+	3. allocates the download of i from the change of the federated model since its last download, as assign_updates_with_filter does
+	   from the aggregate of a round, and i starts its next local training.
+	The dssgd and fedavg models are updated by each arrival, as in the synchronous rounds.
+
+	max_staleness: a participant starts its next local training only if it has uploaded at most max_staleness times more than
+	the slowest participant, and waits otherwise (stale synchronous parallel): 0 puts a barrier after every round.
+	Default: 1. None opts out of the bound, a participant never waits, and a slow participant's uploads can become arbitrarily stale.
+	The server keeps the federated models of the last download of each participant, at most one per participant.
+
+	A round of the learner is n_participants arrivals, and records the latest validation accuracies of every participant.
+
+	This is a deterministic simulation of the asynchronous schedule, not a concurrent one: the local trainings still run one
+	at a time, in the order of their arrivals (in the workers of a Federated_Runtime too), so the mode gives no wall-clock speed-up
+	over the synchronous rounds. The simulated clock measures what the schedule would save, see the time printed at the end.
+	"""
+
+	def __init__(self, learner):
+		assert learner.runtime is None or not learner.runtime.collective, "The asynchronous mode calls the participants one at a time, use a runtime of Federated_Runtime."
+		args = learner.args
+		self.learner = learner
+		self.max_staleness = args.get('max_staleness', 1)
+		self.staleness_exponent = args.get('staleness_exponent', 0)
+
+		n_participants = learner.n_participants
+		speeds = args.get('participant_speeds', None) or [1.0] * n_participants
+		assert len(speeds) == n_participants, "participant_speeds needs a speed for each of the {} participants (the freeriders first).".format(n_participants)
+		shard_sizes = learner.shard_sizes.tolist()
+		average_shard = np.mean([size for size in shard_sizes if size > 0])
+		self.durations = [min(size or average_shard, args['epoch_sample_size']) * args['fl_individual_epochs'] / speed
+			for size, speed in zip(shard_sizes, speeds)]
+
+		self.clock = 0.
+		self.version = 0
+		self.finish_times = {i: self.durations[i] for i in range(n_participants)}
+		# the participants waiting for the slowest one, and since when
+		self.waiting = {}
+		self.waiting_seconds = [0.] * n_participants
+		self.uploads = [0] * n_participants
+		self.staleness = [0] * n_participants
+		self.staleness_total = 0
+		self.download_versions = [0] * n_participants
+
+	def start(self, federated_val_acc):
+		"""
+		Start the local training of all the participants, from the federated models after the pretraining.
+		"""
+		learner = self.learner
+		n_participants = learner.n_participants
+		self.snapshots = {0: self.snapshot()}
+
+		# every participant starts with the same reputation, as a synchronous round of equal validation accuracies leaves it,
+		# so that the first arrivals are not compared with zeros
+		self.raw_reputations = {}
+		self.val_accs = {}
+		for track, (_, reputations, _, R) in TRACK_STATE.items():
+			setattr(learner, reputations, torch.ones(n_participants) / len(getattr(learner, R)))
+			self.raw_reputations[track] = getattr(learner, reputations).clone()
+		for track in ['cffl', 'pretrain', 'dssgd', 'fedavg']:
+			self.val_accs[track] = [federated_val_acc] * n_participants
+
+	def snapshot(self):
+		return {track: flatten(list(getattr(self.learner, model).parameters())).clone() for track, (model, _, _, _) in TRACK_STATE.items()}
+
+	def run_round(self, epoch):
+		learner = self.learner
+		learner.profiler.begin_round(epoch)
+		for _ in range(learner.n_participants):
+			self.arrive(epoch)
+		learner.profiler.end_round(epoch)
+
+		learner.participant_val_accs = list(self.val_accs['cffl'])
+		learner.participant_val_accs_pretrain = list(self.val_accs['pretrain'])
+		learner.dssgd_val_accs = list(self.val_accs['dssgd'])
+		learner.fedavg_val_accs = list(self.val_accs['fedavg'])
+
+	def arrive(self, epoch):
+		"""
+		The next upload to arrive at the server, and the download of its participant.
+		"""
+		learner, args = self.learner, self.learner.args
+		i = min(self.finish_times, key=lambda j: (self.finish_times[j], j))
+		self.clock = self.finish_times.pop(i)
+		participant = learner.participants[i]
+		staleness = self.version - self.download_versions[i]
+		self.staleness[i] = staleness
+		self.staleness_total += staleness
+
+		learner.profiler.begin('participant', participant=i)
+		learner.profiler.mark()
+		uploads = participant.local_updates(args['fl_individual_epochs'], args['grad_clip'], args['largest_criterion'], save_gpu=learner.save_gpu, profiler=learner.profiler)
+
+		if args.get('alpha_decay', False):
+			alpha = learner.alpha * (1 + epoch / args['fl_epochs'])
+		else:
+			alpha = learner.alpha
+
+		for track, (model, reputations, reputation_threshold, R) in TRACK_STATE.items():
+			learner.profiler.begin('track', track=track)
+			self.val_accs[track][i] = learner.one_on_one_evaluate(getattr(learner, model), participant, uploads[track], participant.theta, is_pretrain=(track == 'pretrain'))
+			learner.profiler.clock('evaluate', key='gradient clipping and filtering' + (' for pretrain' if track == 'pretrain' else ''))
+
+			self.raw_reputations[track], updated_reputations, updated_threshold, updated_R = compute_reputations_partial(
+				self.raw_reputations[track], getattr(learner, reputations), getattr(learner, reputation_threshold), getattr(learner, R), [i], self.val_accs[track],
+				alpha=alpha, reputation_fade=learner.reputation_fade, split=args['split'], reputation_threshold_coef=learner.reputation_threshold_coef)
+			setattr(learner, reputations, updated_reputations)
+			setattr(learner, reputation_threshold, updated_threshold)
+			setattr(learner, R, updated_R)
+			learner.profiler.clock('reputation updates')
+			learner.profiler.end()
+
+		# the dssgd and fedavg models are updated by each upload in the synchronous rounds too
+		learner.profiler.begin('track', track='dssgd')
+		participant.download_model('dssgd', add_update_to_model(learner.dssgd_model, uploads['dssgd']).state_dict())
+		learner.profiler.clock('aggregate', key='server aggregation dssgd')
+		self.val_accs['dssgd'][i] = evaluate(learner.dssgd_model, learner.valid_loader, learner.device, verbose=False)[1]
+		learner.profiler.clock('evaluate', key='server aggregation dssgd')
+		learner.profiler.end()
+
+		learner.profiler.begin('track', track='fedavg')
+		weight = torch.div(learner.shard_sizes[i], learner.shard_sizes.sum())
+		participant.download_model('fedavg', add_update_to_model(learner.fedavg_model, uploads['fedavg'], weight=weight).state_dict())
+		learner.profiler.clock('aggregate', key='server aggregation fedavg')
+		self.val_accs['fedavg'][i] = evaluate(learner.fedavg_model, learner.valid_loader, learner.device, verbose=False)[1]
+		learner.profiler.clock('evaluate', key='server aggregation fedavg')
+		learner.profiler.end()
+
+		# the stale uploads are discounted
+		discount = (1. + staleness) ** -self.staleness_exponent
+		for track, (model, reputations, _, R) in TRACK_STATE.items():
+			if i in getattr(learner, R):
+				weight = learner.aggregation_weights(getattr(learner, reputations), [i])[i]
+				add_update_to_model(getattr(learner, model), uploads[track], weight=weight * discount, device=learner.device)
+		self.version += 1
+		learner.profiler.clock('aggregate gradients and update FL model')
+
+		weights = learner.download_weights()
+		before = self.snapshots[self.download_versions[i]]
+		for track, (model, reputations, _, R) in TRACK_STATE.items():
+			if i not in getattr(learner, R):
+				continue
+			parameters = list(getattr(learner, model).parameters())
+			change = unflatten(flatten(parameters) - before[track], parameters)
+			allocated_grad = self.allocate(i, change, getattr(learner, reputations))
+			if allocated_grad is not None:
+				participant.apply_download(track, allocated_grad, uploads[track], weights[i])
+		del uploads
+
+		self.download_versions[i] = self.version
+		self.snapshots[self.version] = self.snapshot()
+		for version in list(self.snapshots):
+			if version not in self.download_versions:
+				del self.snapshots[version]
+		learner.profiler.clock('assign updates')
+		learner.profiler.end()
+
+		self.uploads[i] += 1
+		self.waiting[i] = self.clock
+		self.start_waiting()
+
+	def allocate(self, i, change, reputations):
+		"""
+		The download of participant i from the <change> of the federated model, as allocated in Federated_Learner.assign_updates_with_filter.
+		"""
+		learner, args = self.learner, self.learner.args
+		if args['largest_criterion'] == 'layer':
+			return allocate_download(change, 'layer', reputations[i])
+		if args['largest_criterion'] != 'all':
+			return None
+
+		num_downloads = learner.download_count(i, reputations, learner.param_count)
+		absolute_values = torch.cat([update.data.view(-1).abs() for update in change])
+		if args.get('download', 'topk') == 'random':
+			return allocate_download(change, 'random', num_downloads, torch.randperm(len(absolute_values)))
+		topk, _ = torch.topk(absolute_values, int(len(absolute_values)))
+		return allocate_download(change, 'topk', topk[num_downloads-1])
+
+	def start_waiting(self):
+		# the participants within max_staleness uploads of the slowest one start their next local training
+		slowest = min(self.uploads)
+		for j in sorted(self.waiting):
+			if self.max_staleness is None or self.uploads[j] - slowest <= self.max_staleness:
+				self.waiting_seconds[j] += self.clock - self.waiting.pop(j)
+				self.finish_times[j] = self.clock + self.durations[j]
+
+	def summary(self):
+		"""
+		The simulated time of the uploads so far, in samples trained at speed 1, and the share of it the participants spent waiting,
+		against the same number of rounds with a barrier, where every round takes as long as the slowest participant.
+		"""
+		n_participants = len(self.durations)
+		rounds = sum(self.uploads) / n_participants
+		barrier_time = rounds * max(self.durations)
+		return {
+			'simulated time': round(self.clock, 3),
+			'waiting share': round(sum(self.waiting_seconds) / max(self.clock * n_participants, 1e-12), 4),
+			'mean staleness': round(self.staleness_total / max(sum(self.uploads), 1), 3),
+			'uploads': self.uploads,
+			'simulated time with a barrier': round(barrier_time, 3),
+			'waiting share with a barrier': round(1 - np.mean(self.durations) / max(self.durations), 4),
+		}
+
+	def state_dict(self):
+		return {name: getattr(self, name) for name in ASYNC_STATE}
+
+	def load_state_dict(self, state):
+		for name in ASYNC_STATE:
+			setattr(self, name, state[name])
+
@@ -0,0 +1,102 @@
+import threading
+from queue import Queue, Empty
+
+import torch
+
+
+class Bucket_Loader():
+	"""
+	Length-bucketed, pre-padded batches for the torchtext datasets.
+
+	Replaces BucketIterator(sort_key=lambda x: len(x.text)): the examples are sorted by length,
+	numericalized and padded ONCE into contiguous batch-first [B, L] tensors, so that iterating
+	over the loader does no per-epoch preprocessing and the batches need no permute afterwards.
+
+	train=True: the order of the buckets is reshuffled every epoch (the composition of each bucket is fixed)
+	train=False: the buckets are served in the sorted order, as BucketIterator does for evaluation
+
+	prefetch=True keeps the padded tensors on the cpu and moves the next <prefetch_size> batches
+	to the device in a background thread while the current batch is being consumed.
+	"""
+
+	def __init__(self, dataset, text_field, label_field, batch_size, train=False, device=None, min_length=1, prefetch=False, prefetch_size=2):
+		self.batch_size = batch_size
+		self.train = train
+		self.device = device
+		self.prefetch = prefetch
+		self.prefetch_size = prefetch_size
+
+		pad_index = text_field.vocab.stoi[text_field.pad_token]
+		text_stoi, label_stoi = text_field.vocab.stoi, label_field.vocab.stoi
+
+		lengths = [len(example.text) for example in dataset.examples]
+		# stable sort so that the buckets are deterministic for the same dataset
+		order = sorted(range(len(lengths)), key=lengths.__getitem__)
+
+		storage_device = torch.device('cpu') if prefetch else device
+
+		self.batches = []
+		for start in range(0, len(order), batch_size):
+			bucket = order[start:start + batch_size]
+			max_length = max(min_length, lengths[bucket[-1]])
+
+			batch_data = torch.full((len(bucket), max_length), pad_index, dtype=torch.long)
+			for row, index in enumerate(bucket):
+				tokens = dataset.examples[index].text
+				if tokens:
+					batch_data[row, :len(tokens)] = torch.tensor([text_stoi[token] for token in tokens])
+			batch_target = torch.tensor([label_stoi[dataset.examples[index].label] for index in bucket], dtype=torch.long)
+
+			if prefetch and str(device).startswith('cuda'):
+				batch_data, batch_target = batch_data.pin_memory(), batch_target.pin_memory()
+
+			self.batches.append((batch_data.to(storage_device), batch_target.to(storage_device)))
+
+		self.n_samples = len(order)
+
+	def __len__(self):
+		return len(self.batches)
+
+	def batch_order(self):
+		if self.train:
+			return torch.randperm(len(self.batches)).tolist()
+		return range(len(self.batches))
+
+	def __iter__(self):
+		if not self.prefetch:
+			return (self.batches[i] for i in self.batch_order())
+		return self._prefetch_iter(self.batch_order())
+
+	def _prefetch_iter(self, order):
+		queue = Queue(maxsize=self.prefetch_size)
+		stop = threading.Event()
+
+		def producer():
+			for i in order:
+				if stop.is_set():
+					break
+				batch_data, batch_target = self.batches[i]
+				queue.put((batch_data.to(self.device, non_blocking=True), batch_target.to(self.device, non_blocking=True)))
+			queue.put(None)
+
+		thread = threading.Thread(target=producer, daemon=True)
+		thread.start()
+		finished = False
+		try:
+			while True:
+				batch = queue.get()
+				if batch is None:
+					finished = True
+					break
+				yield batch
+		finally:
+			stop.set()
+			if not finished:
+				# the consumer broke early, e.g. due to epoch_sample_size: unblock the producer until it exits,
+				# without waiting on an empty queue, as it may exit between our checks
+				while thread.is_alive():
+					try:
+						queue.get(timeout=0.1)
+					except Empty:
+						pass
+			thread.join()
@@ -0,0 +1,129 @@
+import time
+
+from utils.Data_Prepper import Data_Prepper
+from utils.Federated_Learner import Federated_Learner, EVALUATION_MODES
+from utils.arguments import update_gpu
+
+
+def to_floats(values):
+	return [float(value) for value in values]
+
+
+class CFFL_Session():
+	"""
+	Runs the learner one communication round at a time, so that the caller can observe and steer a run while it trains.
+
+	rounds() is a generator that yields a compact record of each round: the reputations, the reputable participants R,
+	the validation accuracies, the test accuracies (None if the round is not evaluated) and the timings.
+	The caller can stop early with stop() or by breaking out of rounds(), and a later rounds() continues the run.
+	set_eval_policy() changes the evaluation policy between rounds, and state_dict() / evaluate() pull the state at any time.
+	finish() completes the run as Federated_Learner.train() does and returns the performance dicts.
+
+	eval_every: evaluate the participants on the test set every <eval_every> rounds and in the last round,
+	0 to evaluate only in the last round
+	"""
+
+	def __init__(self, args, data_prepper=None, eval_every=1):
+		if data_prepper is None:
+			update_gpu(args)
+			data_prepper = Data_Prepper(args['dataset'],
+				train_batch_size=args['batch_size'], n_participants=args['n_participants'], sample_size_cap=args['sample_size_cap'],
+				train_val_split_ratio=args['train_val_split_ratio'], device=args['device'], args_dict=args)
+
+		self.args = args
+		self.federated_learner = Federated_Learner(args, data_prepper)
+		self.eval_every = eval_every
+		self.started = False
+		self.stopped = False
+		self.finished = False
+		self.evaluated_rounds = []
+
+	def set_eval_policy(self, eval_every):
+		self.eval_every = eval_every
+
+	def should_evaluate(self, epoch):
+		if epoch == self.args['fl_epochs'] - 1:
+			return True
+		return self.eval_every > 0 and (epoch + 1) % self.eval_every == 0
+
+	def stop(self):
+		self.stopped = True
+
+	def rounds(self):
+		assert not self.finished, "The session is finished."
+		federated_learner = self.federated_learner
+		if not self.started:
+			federated_learner.start_training()
+			self.started = True
+
+		self.stopped = False
+		while not self.stopped and federated_learner.rounds_completed < self.args['fl_epochs']:
+			epoch = federated_learner.rounds_completed
+			time_dict_before = dict(federated_learner.time_dict)
+			start = time.time()
+
+			federated_learner.run_round(epoch)
+			evaluate = self.should_evaluate(epoch)
+			federated_learner.record_round(epoch, evaluate=evaluate)
+			if evaluate:
+				self.evaluated_rounds.append(epoch + 1)
+
+			yield self.get_record(epoch, evaluate, time.time() - start, time_dict_before)
+
+	def get_record(self, epoch, evaluate, seconds, time_dict_before):
+		federated_learner = self.federated_learner
+		record = {
+			'round': epoch + 1,
+			'reputations': to_floats(federated_learner.reputations),
+			'reputation_threshold': float(federated_learner.reputation_threshold),
+			'R': [int(i) for i in federated_learner.R],
+			'reputations_pretrain': to_floats(federated_learner.reputations_pretrain),
+			'reputation_threshold_pretrain': float(federated_learner.reputation_threshold_pretrain),
+			'R_pretrain': [int(i) for i in federated_learner.R_pretrain],
+			'val_accs': {'cffl': to_floats(federated_learner.participant_val_accs), 'pretrain': to_floats(federated_learner.participant_val_accs_pretrain),
+				'dssgd': to_floats(federated_learner.dssgd_val_accs), 'fedavg': to_floats(federated_learner.fedavg_val_accs)},
+			'test_accs': None,
+			'seconds': round(seconds, 3),
+			'timings': {key: round(value - time_dict_before.get(key, 0), 3) for key, value in federated_learner.time_dict.items()},
+		}
+		if evaluate:
+			record['test_accs'] = {'dssgd': to_floats(federated_learner.dssgd_models_test_accs), 'fedavg': to_floats(federated_learner.fedavg_models_test_accs),
+				'standalone': to_floats(federated_learner.participant_standalone_test_accs),
+				'cffl': to_floats(federated_learner.cffl_test_accs), 'pretrain': to_floats(federated_learner.cffl_test_accs_w_pretrain)}
+		return record
+
+	def evaluate(self, modes=None):
+		"""
+		The current test accuracies of the participants, by evaluation mode, without recording them.
+		"""
+		federated_learner = self.federated_learner
+		modes = modes or list(EVALUATION_MODES)
+		return {mode: to_floats(federated_learner.evaluate_participants_performance(federated_learner.test_loader, mode=mode)) for mode in modes}
+
+	def state_dict(self):
+		return {'learner': self.federated_learner.state_dict(), 'evaluated_rounds': list(self.evaluated_rounds)}
+
+	def load_state_dict(self, state):
+		self.federated_learner.load_state_dict(state['learner'])
+		self.evaluated_rounds = list(state['evaluated_rounds'])
+		self.started = True
+
+	def finish(self):
+		federated_learner = self.federated_learner
+		if not self.started:
+			# finished before any round, the results are of the initial models
+			federated_learner.start_training()
+			self.started = True
+		if federated_learner.rounds_completed not in self.evaluated_rounds:
+			# e.g. stopped early, the fairness analysis needs the test accuracies of the last round
+			federated_learner.performance_summary()
+			self.evaluated_rounds.append(federated_learner.rounds_completed)
+		if self.evaluated_rounds != list(range(1, federated_learner.rounds_completed + 1)):
+			# the test accuracies are not of every round, the rows of the test accuracies are of these rounds, see read_convergence.get_evaluated_rounds
+			federated_learner.performance_dict['evaluated_rounds'] = list(self.evaluated_rounds)
+			federated_learner.performance_dict_pretrain['evaluated_rounds'] = list(self.evaluated_rounds)
+
+		federated_learner.finish_training()
+		federated_learner.get_fairness_analysis()
+		self.finished = True
+		return federated_learner.performance_dict, federated_learner.performance_dict_pretrain
@@ -7,7 +7,12 @@ import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler
 
-from torchtext.data import Field, LabelField, BucketIterator
+from torchtext.data import Field, LabelField
+
+from utils.Bucket_Loader import Bucket_Loader
+from utils.Partitioner import Partitioner
+from utils.Synthetic_Dataset import SYNTHETIC_DATASETS, Synthetic_Dataset, Synthetic_Loader
+from utils.utils import seeded_repeats, tensor_batches
 
 class Data_Prepper:
 	def __init__(self, name, train_batch_size, n_participants, sample_size_cap=-1, test_batch_size=100, valid_batch_size=None, train_val_split_ratio=0.8, device=None,args_dict=None):
@@ -21,14 +26,25 @@ class Data_Prepper:
 
 		self.init_batch_size(train_batch_size, test_batch_size, valid_batch_size)
 
+		self.partitions = {}
+		partitions_dir = self.args_dict.get('partitions_dir', os.path.join('datasets', 'partitions')) if self.args_dict else None
+		self.partitioner = Partitioner(manifest_dir=partitions_dir)
+
 		if name in ['sst', 'mr', 'imdb']:
 			parser = argparse.ArgumentParser(description='CNN text classificer')
 			self.args = parser.parse_args()
 
 			self.train_datasets, self.validation_dataset, self.test_dataset = self.prepare_dataset(name)
 
-			self.valid_loader = BucketIterator(self.validation_dataset, batch_size = 500, sort_key=lambda x: len(x.text), device=self.device  )
-			self.test_loader = BucketIterator(self.test_dataset, batch_size = 500, sort_key=lambda x: len(x.text), device=self.device)
+			# pad to at least the widest convolution kernel of CNN_Text
+			self.min_text_length = max(self.args_dict.get('kernel_sizes', [1]))
+			self.prefetch = self.args_dict.get('prefetch', False)
+			self.text_train_loaders = {}
+
+			self.valid_loader = Bucket_Loader(self.validation_dataset, self.args.text_field, self.args.label_field, batch_size=500,
+				device=self.device, min_length=self.min_text_length, prefetch=self.prefetch)
+			self.test_loader = Bucket_Loader(self.test_dataset, self.args.text_field, self.args.label_field, batch_size=500,
+				device=self.device, min_length=self.min_text_length, prefetch=self.prefetch)
 
 			self.args.embed_num = len(self.args.text_field.vocab)
 			self.args.class_num = len(self.args.label_field.vocab)
@@ -54,8 +70,14 @@ class Data_Prepper:
 			print("Train to split size: {}. Validation size: {}. Test size: {}".format(len(self.train_dataset), len(self.validation_dataset), len(self.test_dataset)))
 			print('------')
 
-			self.valid_loader = DataLoader(self.validation_dataset, batch_size=self.test_batch_size)
-			self.test_loader = DataLoader(self.test_dataset, batch_size=self.test_batch_size)
+			if seeded_repeats(self.args_dict):
+				# the evaluation batches are sliced once from the tensors and shared by all the models and repeats, and do not draw
+				# from the random stream of a repeat as the iterators of a DataLoader do, so the repeats run the same when co-scheduled
+				self.valid_loader = tensor_batches(self.validation_dataset, self.test_batch_size)
+				self.test_loader = tensor_batches(self.test_dataset, self.test_batch_size)
+			else:
+				self.valid_loader = DataLoader(self.validation_dataset, batch_size=self.test_batch_size)
+				self.test_loader = DataLoader(self.test_dataset, batch_size=self.test_batch_size)
 
 
 	def init_batch_size(self, train_batch_size, test_batch_size, valid_batch_size):
@@ -73,69 +95,54 @@ class Data_Prepper:
 		if not batch_size:
 			batch_size = self.train_batch_size
 
-		if split == 'classimbalance':
-			if self.name not in ['mnist','cifar10']:
-				raise NotImplementedError("Calling on dataset {}. Only mnist and cifar10 are implemnted for this split".format(self.name))
-
-			n_classes = 10			
-			data_indices = [(self.train_dataset.targets == class_id).nonzero().view(-1).tolist() for class_id in range(n_classes)]
-			class_sizes = np.linspace(1, n_classes, n_participants, dtype='int')
-			print("class_sizes for each party", class_sizes)
-			party_mean = self.sample_size_cap // self.n_participants
-
-			from collections import defaultdict
-			party_indices = defaultdict(list)
-			for party_id, class_sz in enumerate(class_sizes):	
-				classes = range(class_sz) # can customize classes for each party rather than just listing
-				each_class_id_size = party_mean // class_sz
-				# print("party each class size:", party_id, each_class_id_size)
-				for i, class_id in enumerate(classes):
-					# randomly pick from each class a certain number of samples, with replacement 
-					selected_indices = random.choices(data_indices[class_id], k=each_class_id_size)
-
-					# randomly pick from each class a certain number of samples, without replacement 
-					'''
-					NEED TO MAKE SURE THAT EACH CLASS HAS MORE THAN each_class_id_size for no replacement sampling
-					selected_indices = random.sample(data_indices[class_id],k=each_class_id_size)
-					'''
-					party_indices[party_id].extend(selected_indices)
-
-					# top up to make sure all parties have the same number of samples
-					if i == len(classes) - 1 and len(party_indices[party_id]) < party_mean:
-						extra_needed = party_mean - len(party_indices[party_id])
-						party_indices[party_id].extend(data_indices[class_id][:extra_needed])
-						data_indices[class_id] = data_indices[class_id][extra_needed:]
-
-			indices_list = [party_index_list for party_id, party_index_list in party_indices.items()] 
-
-		elif split == 'powerlaw':
-			if self.name in ['sst', 'mr', 'imdb']:
-				# sst, mr, imdb split is different from other datasets, so return here				
-
-				self.train_loaders = [BucketIterator(train_dataset, batch_size=self.train_batch_size, device=self.device, sort_key=lambda x: len(x.text),train=True) for train_dataset in self.train_datasets]
-				self.shard_sizes = [(len(train_dataset)) for train_dataset in self.train_datasets]
-				return self.train_loaders
+		if split == 'powerlaw' and self.name in ['sst', 'mr', 'imdb']:
+			# sst, mr, imdb split is different from other datasets, so return here				
 
+			if batch_size in self.text_train_loaders:
+				# padded once, shared by the repeats of the experiment
+				self.train_loaders = self.text_train_loaders[batch_size]
 			else:
-				indices_list = powerlaw(list(range(len(self.train_dataset))), n_participants)
+				self.train_loaders = [Bucket_Loader(train_dataset, self.args.text_field, self.args.label_field, batch_size=batch_size, train=True,
+									device=self.device, min_length=self.min_text_length, prefetch=self.prefetch) for train_dataset in self.train_datasets]
+				self.text_train_loaders[batch_size] = self.train_loaders
+			self.shard_sizes = [(len(train_dataset)) for train_dataset in self.train_datasets]
+			return self.train_loaders
 
-		elif split in ['balanced','equal']:
-			from utils.utils import random_split
-			indices_list = random_split(sample_indices=list(range(len(self.train_dataset))), m_bins=n_participants, equal=True)
-		
-		elif split == 'random':
-			from utils.utils import random_split
-			indices_list = random_split(sample_indices=list(range(len(self.train_dataset))), m_bins=n_participants, equal=False)
+		if split == 'classimbalance' and self.name not in ['mnist','cifar10']:
+			raise NotImplementedError("Calling on dataset {}. Only mnist and cifar10 are implemnted for this split".format(self.name))
+
+		indices_list = self.get_partition(n_participants, split)
 
 		# from collections import Counter
 		# for indices in indices_list:
 		# 	print(Counter(self.train_dataset.targets[indices].tolist()))
 
 		self.shard_sizes = [len(indices) for indices in indices_list]
-		participant_train_loaders = [DataLoader(self.train_dataset, batch_size=batch_size, sampler=SubsetRandomSampler(indices)) for indices in indices_list]
+		if isinstance(self.train_dataset, Synthetic_Dataset):
+			# streamed from the chunks of the lazily generated samples
+			return [Synthetic_Loader(self.train_dataset, indices, batch_size) for indices in indices_list]
+		participant_train_loaders = [DataLoader(self.train_dataset, batch_size=batch_size, sampler=SubsetRandomSampler(indices.tolist())) for indices in indices_list]
 
 		return participant_train_loaders
 
+	def get_partition(self, n_participants, split='powerlaw'):
+		"""
+		The partition only depends on the split config, so it is computed once and shared by
+		the repeats, and persisted as a manifest under 'partitions_dir' for later experiments.
+		"""
+		if (n_participants, split) in self.partitions:
+			return self.partitions[(n_participants, split)]
+
+		args_dict = self.args_dict or {}
+		targets = self.train_dataset.targets if split in ['classimbalance', 'dirichlet'] else None
+		if targets is not None:
+			targets = targets.cpu().numpy() if torch.is_tensor(targets) else np.asarray(targets)
+
+		indices_list = self.partitioner.partition_list(len(self.train_dataset), n_participants, split=split, targets=targets,
+			n_classes=getattr(self.train_dataset, 'n_classes', args_dict.get('n_classes', 10)), sample_size_cap=self.sample_size_cap, beta=args_dict.get('dirichlet_beta', 0.5), name=self.name)
+		self.partitions[(n_participants, split)] = indices_list
+		return indices_list
+
 	def prepare_dataset(self, name='adult'):
 		if name == 'adult':
 			from utils.load_adult import get_train_test
@@ -212,6 +219,24 @@ class Data_Prepper:
 			del train, test
 
 			return train_set, validation_set, test_set
+		elif name in SYNTHETIC_DATASETS:
+			from utils.Synthetic_Dataset import get_config, VALID, TEST
+
+			config = get_config(name, (self.args_dict or {}).get('synthetic'))
+			n_samples = config.get('n_samples', self.sample_size_cap)
+			assert n_samples and n_samples > 0, "Set the number of train samples of {} with sample_size_cap or args['synthetic']['n_samples'].".format(name)
+
+			train_set = Synthetic_Dataset(config, n_samples)
+			validation_set = Synthetic_Dataset(config, config['n_valid'], stream=VALID).materialize(device=self.device)
+			test_set = Synthetic_Dataset(config, config['n_test'], stream=TEST).materialize(device=self.device)
+
+			if config['kind'] == 'text':
+				# the embedding arguments of CNN_Text, as for the real text datasets
+				self.args = argparse.Namespace(embed_num=config['vocab_size'], class_num=config['n_classes'], embed_dim=self.args_dict['embed_dim'],
+					kernel_num=self.args_dict['kernel_num'], kernel_sizes=self.args_dict['kernel_sizes'], static=self.args_dict['static'])
+
+			return train_set, validation_set, test_set
+
 		elif name == "sst":
 			import torchtext.data as data
 			text_field = data.Field(lower=True)
@@ -222,10 +247,8 @@ class Data_Prepper:
 			import torchtext.datasets as datasets
 			train_data, validation_data, test_data = datasets.SST.splits(text_field, label_field, fine_grained=True)
 
-			indices_list = powerlaw(list(range(len(train_data))), self.n_participants)
-			ratios = [len(indices) / len(train_data) for indices in indices_list]
-
-			train_datasets = split_torchtext_dataset_ratios(train_data, ratios)
+			indices_list = self.partitioner.partition_list(len(train_data), self.n_participants, split='powerlaw', shuffle=True, name=name)
+			train_datasets = split_torchtext_dataset(train_data, indices_list)
 
 			text_field.build_vocab(*(train_datasets + [validation_data, test_data]))
 			label_field.build_vocab(*(train_datasets + [validation_data, test_data]))
@@ -249,10 +272,8 @@ class Data_Prepper:
 
 			validation_data, test_data = dev_data.split(split_ratio=0.5, random_state = random.seed(1234))
 			
-			indices_list = powerlaw(list(range(len(train_data))), self.n_participants)
-			ratios = [len(indices) / len(train_data) for indices in  indices_list]
-
-			train_datasets = split_torchtext_dataset_ratios(train_data, ratios)
+			indices_list = self.partitioner.partition_list(len(train_data), self.n_participants, split='powerlaw', shuffle=True, name=name)
+			train_datasets = split_torchtext_dataset(train_data, indices_list)
 
 			# print(train_data, dir(train_data))
 			# print((train_datasets[0].examples[0].text))
@@ -292,10 +313,8 @@ class Data_Prepper:
 
 			# train_data, valid_data = train_data.split(split_ratio=self.train_val_split_ratio ,random_state = random.seed(1234))
 
-			indices_list = powerlaw(list(range(len(train_data))), self.n_participants)
-			ratios = [len(indices) / len(train_data) for indices in  indices_list]
-
-			train_datasets = split_torchtext_dataset_ratios(train_data, ratios)
+			indices_list = self.partitioner.partition_list(len(train_data), self.n_participants, split='powerlaw', shuffle=True, name=name)
+			train_datasets = split_torchtext_dataset(train_data, indices_list)
 
 			MAX_VOCAB_SIZE = 25_000
 
@@ -432,16 +451,11 @@ def get_train_valid_indices(n_samples, train_val_split_ratio, sample_size_cap=No
 	return  train_indices, valid_indices 
 
 
-def split_torchtext_dataset_ratios(data, ratios):
-	train_datasets = []
-	while len(ratios) > 1:
-
-		split_ratio = ratios[0] / sum(ratios)
-		ratios.pop(0)
-		train_dataset, data = data.split(split_ratio=split_ratio, random_state=random.seed(1234))
-		train_datasets.append(train_dataset)
-	train_datasets.append(data)
-	return train_datasets
+def split_torchtext_dataset(data, indices_list):
+	# one pass over the examples, instead of repeatedly splitting off the remaining data
+	from torchtext.data import Dataset
+	examples = data.examples
+	return [Dataset([examples[i] for i in indices], data.fields) for indices in indices_list]
 
 
 def generate_bigrams(x):
@@ -0,0 +1,499 @@
+import os
+import sys
+import copy
+import time
+import random
+import socket
+import argparse
+import subprocess
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from utils.Federated_Runtime import Federated_Runtime, Participant_Worker, KEPT_UPLOADS, PYTORCH_DIR, \
+	encode_message, decode_message, join_buffers, LENGTH
+from utils.Participant import TRACK_MODELS
+from utils.Federated_Learner import evaluate_upload, allocate_download
+from utils.utils import evaluate, add_update_to_model, add_gradient_updates, get_rng_state, set_rng_state
+
+
+# the rank of the learner, i.e., the server
+SERVER_RANK = 0
+
+# the columns of the allocation table scattered to the ranks, see Distributed_Runtime.assign
+ALLOCATION_COLUMNS = ['cffl allocated', 'cffl allocation', 'pretrain allocated', 'pretrain allocation', 'weight']
+
+
+def flatten(tensors):
+	return torch.cat([tensor.detach().reshape(-1).cpu() for tensor in tensors])
+
+
+def unflatten(flat, shapes):
+	# views into <flat>, one per shape
+	tensors, offset = [], 0
+	for shape in shapes:
+		numel = int(np.prod(shape))
+		tensors.append(flat[offset:offset + numel].view(shape))
+		offset += numel
+	return tensors
+
+
+def flatten_state(state_dict):
+	# the values of a state dict as one flat tensor per dtype, e.g. the parameters and the number of batches of batch norm
+	values = OrderedDict()
+	for value in state_dict.values():
+		values.setdefault(value.dtype, []).append(value.detach().reshape(-1).cpu())
+	return [torch.cat(dtype_values) for dtype_values in values.values()]
+
+
+def unflatten_state(flats, state_dict):
+	# the state dict of the keys and shapes of <state_dict>, with the values of flatten_state()
+	flats = dict(zip(OrderedDict.fromkeys(value.dtype for value in state_dict.values()), flats))
+	offsets = defaultdict(int)
+	state = OrderedDict()
+	for key, value in state_dict.items():
+		offset = offsets[value.dtype]
+		state[key] = flats[value.dtype][offset:offset + value.numel()].view(value.shape)
+		offsets[value.dtype] += value.numel()
+	return state
+
+
+def seed_rng(seed):
+	torch.manual_seed(seed)
+	np.random.seed(seed)
+	random.seed(seed)
+
+
+def skip_evaluation_draws(eval_loader, n_passes):
+	# the random numbers of <n_passes> evaluations on <eval_loader> without evaluating: each pass over a DataLoader draws its base seed
+	for _ in range(n_passes):
+		iter(eval_loader)
+
+
+def get_free_port(host):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind((host, 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+class Distributed_Connection():
+	"""
+	The messages with one rank over torch.distributed point-to-point, each sent as its length followed by its bytes, see encode_message.
+	"""
+
+	def __init__(self, rank):
+		self.rank = rank
+		self.pending = []
+		self.reset()
+
+	def reset(self):
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.serialization_seconds = 0.
+		self.peer_serialization_seconds = 0.
+
+	def isend(self, message):
+		# the message is encoded now, and sent in the background until wait()
+		start = time.time()
+		data = join_buffers(encode_message(message))
+		self.serialization_seconds += time.time() - start
+		length = torch.tensor([len(data)], dtype=torch.int64)
+		data = torch.from_numpy(np.frombuffer(data, dtype=np.uint8))
+		# the tensors are kept until their sends complete
+		self.pending.append((dist.isend(length, self.rank), length))
+		self.pending.append((dist.isend(data, self.rank), data))
+		self.bytes_sent += LENGTH.size + len(data)
+
+	def wait(self):
+		for work, _ in self.pending:
+			work.wait()
+		self.pending = []
+
+	def send(self, message):
+		self.isend(message)
+		self.wait()
+
+	def send_tensor(self, tensor):
+		# a tensor as is, into a buffer posted by the rank
+		dist.send(tensor, self.rank)
+		self.bytes_sent += tensor.numel() * tensor.element_size()
+
+	def recv(self):
+		length = torch.zeros(1, dtype=torch.int64)
+		dist.recv(length, self.rank)
+		data = torch.empty(int(length.item()), dtype=torch.uint8)
+		dist.recv(data, self.rank)
+		self.bytes_received += LENGTH.size + len(data)
+		start = time.time()
+		message = decode_message(data.numpy())
+		self.serialization_seconds += time.time() - start
+		return message
+
+	def request(self, message):
+		self.send(message)
+		reply = self.recv()
+		self.peer_serialization_seconds = reply['serialization seconds']
+		return reply
+
+	def close(self):
+		try:
+			self.send({'method': 'close'})
+		except RuntimeError:
+			pass
+
+
+class Distributed_Worker(Participant_Worker):
+	"""
+	The participants of a rank: besides the calls to each participant, the phases of the round for all of them at once,
+	together with the server and the other ranks, see Distributed_Runtime.
+	"""
+
+	def __init__(self, connection):
+		super(Distributed_Worker, self).__init__()
+		self.connection = connection
+
+	def setup(self, args, federated_model, **kwargs):
+		super(Distributed_Worker, self).setup(args, federated_model, **kwargs)
+		self.device = args['device']
+		self.indices = sorted(self.participants)
+		self.shapes = [param.shape for param in federated_model.parameters()]
+		self.param_count = sum([param.numel() for param in federated_model.parameters()])
+		# the federated models of the server, for the one-on-one evaluation of the uploads
+		self.federated_models = OrderedDict([('cffl', federated_model), ('pretrain', copy.deepcopy(federated_model))])
+
+	def train_locally(self, epochs, is_pretrain=False, save_gpu=False, grad_clip=None, largest_criterion=None, seed=None, profiler=None):
+		if seed is not None:
+			seed_rng(seed)
+		if is_pretrain:
+			for index in self.indices:
+				self.participants[index].train(epochs, is_pretrain=is_pretrain)
+			return
+
+		flat = torch.empty(2 * self.param_count)
+		dist.broadcast(flat, SERVER_RANK)
+		for model, part in zip(self.federated_models.values(), flat.split(self.param_count)):
+			for param, value in zip(model.parameters(), unflatten(part, self.shapes)):
+				param.data.copy_(value)
+
+		# the dssgd and fedavg models of the server after the upload of each participant, received in the background in the order of the participants
+		self.pending_downloads = OrderedDict()
+		for index in self.indices:
+			buffers = OrderedDict()
+			for track in ['dssgd', 'fedavg']:
+				buffers[track] = [torch.empty_like(flat) for flat in flatten_state(getattr(self.participants[index], TRACK_MODELS[track]).state_dict())]
+			self.pending_downloads[index] = (buffers, [dist.irecv(buffer, SERVER_RANK) for track in buffers for buffer in buffers[track]])
+		profiler.mark()
+
+		for index in self.indices:
+			participant = self.participants[index]
+			if any(self.participants[pending] is participant for pending in self.pending_downloads if pending < index):
+				# a free rider trains again from its downloads, as in the single process
+				self.receive_downloads(until=index)
+				profiler.mark()
+
+			uploads = participant.local_updates(epochs, grad_clip, largest_criterion, save_gpu=save_gpu, profiler=profiler)
+
+			val_acc = evaluate_upload(self.federated_models['cffl'], participant, uploads['cffl'], participant.theta, self.loaders['valid'], self.device)
+			profiler.clock('evaluate', key='gradient clipping and filtering')
+			val_acc_pretrain = evaluate_upload(self.federated_models['pretrain'], participant, uploads['pretrain'], participant.theta, self.loaders['valid'],
+				self.device, is_pretrain=True)
+			profiler.clock('evaluate', key='gradient clipping and filtering for pretrain')
+			# the server evaluates the dssgd and fedavg models after this upload, which draws from the random stream in the single process
+			skip_evaluation_draws(self.loaders['valid'], 2)
+			self.uploads[index] = {track: uploads[track] for track in KEPT_UPLOADS}
+
+			# the dssgd and fedavg uploads are applied by the server in the order of the participants, see Distributed_Runtime.train_locally
+			self.connection.isend({'index': index, 'val_accs': (val_acc, val_acc_pretrain), 'dssgd': uploads['dssgd'], 'fedavg': uploads['fedavg']})
+			profiler.mark()
+
+		self.receive_downloads()
+		self.connection.wait()
+		profiler.clock('download', key='communication')
+
+	def receive_downloads(self, until=None):
+		# the downloads of the participants before <until>, or all
+		for index in list(self.pending_downloads):
+			if until is not None and index >= until:
+				break
+			buffers, works = self.pending_downloads.pop(index)
+			for work in works:
+				work.wait()
+			participant = self.participants[index]
+			for track in buffers:
+				participant.download_model(track, unflatten_state(buffers[track], getattr(participant, TRACK_MODELS[track]).state_dict()))
+
+	def aggregate(self, weights):
+		# the weighted sum of the uploads of the reputable participants of this rank, summed over the ranks at the server
+		flat = torch.zeros(2 * self.param_count)
+		for track, part in zip(KEPT_UPLOADS, flat.split(self.param_count)):
+			aggregated = unflatten(part, self.shapes)
+			for index, weight in weights[track].items():
+				add_gradient_updates(aggregated, self.uploads[index][track], weight)
+		dist.reduce(flat, SERVER_RANK, op=dist.ReduceOp.SUM)
+
+	def assign(self, mode, n_rows):
+		flat = torch.empty(2 * self.param_count)
+		dist.broadcast(flat, SERVER_RANK)
+		aggregated_updates = OrderedDict(zip(KEPT_UPLOADS, [unflatten(part, self.shapes) for part in flat.split(self.param_count)]))
+		permuted_indices = {track: None for track in KEPT_UPLOADS}
+		if mode == 'random':
+			indices = torch.empty(2 * self.param_count, dtype=torch.int64)
+			dist.broadcast(indices, SERVER_RANK)
+			permuted_indices = dict(zip(KEPT_UPLOADS, indices.split(self.param_count)))
+		allocations = torch.empty(n_rows, len(ALLOCATION_COLUMNS), dtype=torch.float64)
+		dist.scatter(allocations, src=SERVER_RANK)
+
+		for index, row in zip(self.indices, allocations.tolist()):
+			# the float32 values of the server, exactly
+			weight = torch.tensor(row[4], dtype=torch.float32)
+			for track, (allocated, allocation) in zip(KEPT_UPLOADS, [row[0:2], row[2:4]]):
+				if not allocated:
+					continue
+				allocation = int(allocation) if mode == 'random' else torch.tensor(allocation, dtype=torch.float32)
+				allocated_grad = allocate_download(aggregated_updates[track], mode, allocation, permuted_indices[track])
+				self.participants[index].apply_download(track, allocated_grad, self.uploads[index][track], weight)
+		self.uploads = {}
+
+	def evaluate_participants(self, name, eval_loader, seed=None):
+		if seed is not None:
+			seed_rng(seed)
+		return [self.participants[index].evaluate(name, eval_loader) for index in self.indices]
+
+
+def serve():
+	"""
+	Run a participant rank: join the process group of the server, from RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT
+	in the environment (as set by torchrun), and handle the calls of the server until it closes.
+	"""
+	dist.init_process_group('gloo', init_method='env://')
+	connection = Distributed_Connection(SERVER_RANK)
+	worker = Distributed_Worker(connection)
+	while True:
+		message = connection.recv()
+		if message['method'] == 'close':
+			break
+		reply = worker.handle(message)
+		if message['method'] == 'setup':
+			# the setup is accounted separately, see Federated_Runtime.start
+			connection.serialization_seconds = 0.
+		reply['serialization seconds'] = connection.serialization_seconds
+		connection.send(reply)
+	dist.destroy_process_group()
+
+
+class Distributed_Runtime(Federated_Runtime):
+	"""
+	Runs the participants of a learner in the ranks of a torch.distributed gloo process group: the learner is rank 0 (the server),
+	and the participants are split among the ranks 1 to args['runtime_workers'], with the phases of the round done by all the ranks at once:
+		the local training: each rank trains its participants and evaluates their uploads on the federated models broadcast by the server,
+			and streams their dssgd and fedavg uploads to the server, that applies them in the order of the participants as in the single process
+		the aggregation: each rank sums the weighted uploads of its reputable participants, and the sums are reduced to the server
+		the downloads: the aggregates are broadcast to the ranks, and the allocations of the participants (by their reputations) scattered,
+			so that each rank masks the downloads of its participants from the aggregates
+		the evaluation: each rank evaluates its participants
+	So the server holds neither the participants nor their uploads, and the ranks train and evaluate in parallel.
+	The other calls to a participant are sent to its rank as with Federated_Runtime.
+
+	args['runtime']: 'gloo'
+	args['runtime_workers']: the number of participant ranks. Default: 1
+	args['runtime_address']: <host>:<port> of the server, the MASTER_ADDR and MASTER_PORT of the group. Default: 127.0.0.1 on a free port
+	args['runtime_spawn']: True to start the ranks here, False to wait for them to be started with
+		RANK=<1 to runtime_workers> WORLD_SIZE=<runtime_workers + 1> MASTER_ADDR=<host> MASTER_PORT=<port> python -m utils.Distributed_Runtime
+		e.g. on other machines, from the pytorch directory. Default: True
+
+	With one participant rank, the random state is passed to the rank and back as with Federated_Runtime, and the results are exactly
+	the same as in the single process. With more, the first rank continues the random state of the server and the others are seeded
+	from it every round, so the results are deterministic for the number of ranks, but not the same as in the single process.
+	The time_dict of the server has its own phases, e.g. the local training is the time waiting for the ranks,
+	see summary() for the phases of the ranks, and the bytes exchanged with them, by the messages and the collectives.
+	"""
+
+	transports = ['gloo']
+	collective = True
+
+	def __init__(self, args, profiler):
+		assert dist.is_available(), "torch.distributed is not available in this build of torch."
+		assert not dist.is_initialized(), "The gloo runtime needs its own process group, only one learner can use it at a time."
+		assert str(args['device']) == 'cpu', "The gloo runtime runs on the cpu."
+		super(Distributed_Runtime, self).__init__(args, profiler)
+		self.collective_bytes_sent = 0
+		self.collective_bytes_received = 0
+		self.worker_totals = defaultdict(float)
+
+	def connect(self, n_workers):
+		host, port = (self.address or '127.0.0.1:0').rsplit(':', 1)
+		port = int(port) or get_free_port(host)
+		environment = dict(os.environ, MASTER_ADDR=host, MASTER_PORT=str(port), WORLD_SIZE=str(n_workers + 1))
+		if self.spawn:
+			for rank in range(1, n_workers + 1):
+				self.processes.append(subprocess.Popen([sys.executable, '-m', 'utils.Distributed_Runtime'], cwd=PYTORCH_DIR,
+					env=dict(environment, RANK=str(rank))))
+		else:
+			print("Waiting for {} participant ranks: RANK=<1 to {}> WORLD_SIZE={} MASTER_ADDR={} MASTER_PORT={} python -m utils.Distributed_Runtime".format(
+				n_workers, n_workers, n_workers + 1, host, port))
+		dist.init_process_group('gloo', init_method='tcp://{}:{}'.format(host, port), rank=SERVER_RANK, world_size=n_workers + 1)
+		return [Distributed_Connection(rank) for rank in range(1, n_workers + 1)]
+
+	def send_all(self, method, kwargs, random=False, profile=False):
+		"""
+		Call the worker method of every rank, with the kwargs of each rank, and return without waiting for the replies, see recv_all().
+		random: the call uses the random numbers, so the first rank continues the random state of the server, and the others are seeded from it
+		profile: the method clocks its phases, and the seconds are added to the rank seconds of summary()
+		"""
+		seeds = [int(torch.randint(2 ** 31 - 1, (1,)).item()) for _ in self.connections[1:]] if random else []
+		for rank, (connection, rank_kwargs) in enumerate(zip(self.connections, kwargs)):
+			if rank > 0 and random:
+				rank_kwargs = dict(rank_kwargs, seed=seeds[rank - 1])
+			connection.isend({'method': method, 'kwargs': rank_kwargs, 'profile': profile,
+				'rng_state': get_rng_state() if random and rank == 0 else None})
+		self.messages += len(self.connections)
+
+	def recv_all(self):
+		results = []
+		for connection in self.connections:
+			connection.wait()
+			reply = connection.recv()
+			connection.peer_serialization_seconds = reply['serialization seconds']
+			if 'error' in reply:
+				raise RuntimeError("A call failed in the participant rank {}:\n{}".format(connection.rank, reply['error']))
+			if reply['rng_state'] is not None:
+				set_rng_state(reply['rng_state'])
+			for key, seconds in (reply['totals'] or {}).items():
+				self.worker_totals[key] += seconds
+			results.append(reply['result'])
+		return results
+
+	def broadcast(self, tensor):
+		dist.broadcast(tensor, SERVER_RANK)
+		self.collective_bytes_sent += tensor.numel() * tensor.element_size() * len(self.connections)
+
+	def train_locally(self, learner, epochs, is_pretrain=False, save_gpu=False):
+		"""
+		The local training of all the participants, see Federated_Learner.train_locally.
+		"""
+		kwargs = {'epochs': epochs, 'is_pretrain': is_pretrain, 'save_gpu': save_gpu,
+			'grad_clip': learner.args['grad_clip'], 'largest_criterion': learner.args['largest_criterion']}
+		self.send_all('train_locally', [kwargs] * len(self.connections), random=True, profile=True)
+		if is_pretrain:
+			self.recv_all()
+			return
+
+		profiler = learner.profiler
+		self.broadcast(flatten(list(learner.federated_model.parameters()) + list(learner.federated_model_pretrain.parameters())))
+
+		participant_val_accs, participant_val_accs_pretrain, dssgd_val_accs, fedavg_val_accs = [], [], [], []
+		ranks = {index: rank for rank, indices in enumerate(self.worker_indices) for index in indices}
+		for index in range(self.n_participants):
+			profiler.begin('participant', participant=index)
+			connection = self.connections[ranks[index]]
+			upload = connection.recv()
+			assert upload['index'] == index, "The uploads of participant {} are out of order.".format(index)
+			profiler.clock('local train', key='participants local training')
+			participant_val_accs.append(upload['val_accs'][0])
+			participant_val_accs_pretrain.append(upload['val_accs'][1])
+
+			# as in Federated_Learner.train_locally, the server models are updated by each participant in turn, then 'downloaded' by it
+			profiler.begin('track', track='dssgd')
+			add_update_to_model(learner.dssgd_model, upload['dssgd'])
+			profiler.clock('aggregate', key='server aggregation dssgd')
+			dssgd_val_accs.append(evaluate(learner.dssgd_model, learner.valid_loader, learner.device, verbose=False)[1])
+			profiler.clock('evaluate', key='server aggregation dssgd')
+			profiler.end()
+
+			profiler.begin('track', track='fedavg')
+			weight = torch.div(learner.shard_sizes[index], learner.shard_sizes.sum())
+			add_update_to_model(learner.fedavg_model, upload['fedavg'], weight=weight)
+			profiler.clock('aggregate', key='server aggregation fedavg')
+			fedavg_val_accs.append(evaluate(learner.fedavg_model, learner.valid_loader, learner.device, verbose=False)[1])
+			profiler.clock('evaluate', key='server aggregation fedavg')
+			profiler.end()
+
+			for model in [learner.dssgd_model, learner.fedavg_model]:
+				for flat in flatten_state(model.state_dict()):
+					connection.send_tensor(flat)
+			profiler.end()
+			del upload
+
+		self.recv_all()
+		return participant_val_accs, participant_val_accs_pretrain, dssgd_val_accs, fedavg_val_accs
+
+	def aggregate(self, weights, weights_pretrain):
+		"""
+		The aggregates of the uploads weighted by <weights> (by participant and track), see Federated_Learner.aggregate_gradients_and_update_federated_model.
+		"""
+		self.send_all('aggregate', [{'weights': {'cffl': OrderedDict((i, weights[i]) for i in weights if i in indices),
+			'pretrain': OrderedDict((i, weights_pretrain[i]) for i in weights_pretrain if i in indices)}} for indices in self.worker_indices])
+		flat = torch.zeros(2 * self.param_count)
+		dist.reduce(flat, SERVER_RANK, op=dist.ReduceOp.SUM)
+		self.collective_bytes_received += flat.numel() * flat.element_size() * len(self.connections)
+		self.recv_all()
+		return [unflatten(part, self.shapes) for part in flat.split(self.param_count)]
+
+	def assign(self, mode, aggregated_updates, allocations, permuted_indices, weights):
+		"""
+		The downloads of the participants, by their allocations (by track and participant) of the <aggregated_updates>,
+		see Federated_Learner.assign_updates_with_filter.
+		"""
+		n_rows = max(len(indices) for indices in self.worker_indices)
+		self.send_all('assign', [{'mode': mode, 'n_rows': n_rows}] * len(self.connections))
+		self.broadcast(flatten(list(aggregated_updates['cffl']) + list(aggregated_updates['pretrain'])))
+		if mode == 'random':
+			self.broadcast(torch.cat([permuted_indices['cffl'], permuted_indices['pretrain']]))
+
+		# a row per participant of each rank, with the float32 values as float64, exactly
+		tables = [torch.zeros(n_rows, len(ALLOCATION_COLUMNS), dtype=torch.float64) for _ in range(len(self.connections) + 1)]
+		for table, indices in zip(tables[1:], self.worker_indices):
+			for row, index in enumerate(indices):
+				for column, track in [(0, 'cffl'), (2, 'pretrain')]:
+					if index in allocations[track]:
+						table[row, column] = 1
+						table[row, column + 1] = float(allocations[track][index])
+				table[row, 4] = float(weights[index])
+		dist.scatter(tables[SERVER_RANK], scatter_list=tables, src=SERVER_RANK)
+		self.collective_bytes_sent += sum(table.numel() * table.element_size() for table in tables[1:])
+		self.recv_all()
+
+	def evaluate_participants(self, model_name, eval_loader):
+		# random, each pass over a DataLoader draws its base seed
+		self.send_all('evaluate_participants', [{'name': model_name, 'eval_loader': self.loader_names[id(eval_loader)]}] * len(self.connections), random=True)
+		accs = [None] * self.n_participants
+		for indices, rank_accs in zip(self.worker_indices, self.recv_all()):
+			for index, acc in zip(indices, rank_accs):
+				accs[index] = acc
+		return accs
+
+	def start(self, federated_model, train_loaders, n_freeriders, loaders):
+		self.shapes = [param.shape for param in federated_model.parameters()]
+		self.param_count = sum([param.numel() for param in federated_model.parameters()])
+		return super(Distributed_Runtime, self).start(federated_model, train_loaders, n_freeriders, loaders)
+
+	def summary(self):
+		"""
+		As Federated_Runtime.summary(), with the collectives in the bytes, and the seconds of the phases of the ranks, summed over them.
+		"""
+		summary = super(Distributed_Runtime, self).summary()
+		summary['MB to participants'] = round(summary['MB to participants'] + self.collective_bytes_sent / 1024 / 1024, 3)
+		summary['MB from participants'] = round(summary['MB from participants'] + self.collective_bytes_received / 1024 / 1024, 3)
+		summary['rank seconds'] = OrderedDict((key, round(seconds, 3)) for key, seconds in self.worker_totals.items())
+		return summary
+
+	def close(self):
+		super(Distributed_Runtime, self).close()
+		if dist.is_initialized():
+			dist.destroy_process_group()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='A participant rank of the gloo runtime, see Distributed_Runtime. '
+		'The rank and the server are read from RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT in the environment.')
+	parser.parse_args(argv)
+	serve()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
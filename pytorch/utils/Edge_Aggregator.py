@@ -0,0 +1,68 @@
+import torch
+
+from utils.Federated_Learner import allocate_download
+from utils.utils import add_gradient_updates
+
+
+# the tracks of the uploads kept by the edge aggregators, aggregated by the reputations
+EDGE_TRACKS = ['cffl', 'pretrain']
+
+
+def split_groups(n_participants, n_groups):
+	# contiguous groups of participants in their order (the freeriders first), of sizes differing by at most one
+	n_groups = max(1, min(n_groups, n_participants))
+	return [list(range(g * n_participants // n_groups, (g + 1) * n_participants // n_groups)) for g in range(n_groups)]
+
+
+class Edge_Aggregator():
+	"""
+	An edge aggregator of the two-level topology (args['edge_groups']): it owns a group of participants and keeps their uploads
+	of the round, and the root (the learner) only receives a summary of the group:
+		reputation_statistics(): the sum of the validation accuracies of the reputable participants of the group, the root sums them
+			into the normalizer of the reputation update, see compute_reputations_sinh
+		aggregate(): the weighted sum of the uploads of the reputable participants of the group, by track, the root sums them into the aggregates
+	The root updates the reputations, allocates the downloads from the aggregates as in Federated_Learner.assign_updates_with_filter,
+	and pushes the aggregates and the allocations down to the edge aggregators, that apply the downloads of their participants, see assign().
+	So the root holds and adds one partial sum per group, rather than the uploads of every participant.
+	"""
+
+	def __init__(self, learner, indices):
+		self.learner = learner
+		self.indices = indices
+		self.uploads = {}
+
+	def collect(self, i, uploads):
+		self.uploads[i] = {track: uploads[track] for track in EDGE_TRACKS}
+
+	def clear(self):
+		self.uploads = {}
+
+	def reputation_statistics(self, val_accs, R):
+		R = set(R)
+		return sum([val_accs[i] for i in self.indices if i in R])
+
+	def aggregate(self, weights):
+		"""
+		The partial sums of the group, by track, of the uploads weighted by <weights> (by track and participant).
+		"""
+		partial_sums = {}
+		for track in EDGE_TRACKS:
+			partial_sums[track] = [torch.zeros(param.shape).to(self.learner.device) for param in self.learner.federated_model.parameters()]
+			for i in self.indices:
+				# the deferred participants and those absent from the round have no uploads
+				if i in weights[track] and i in self.uploads:
+					add_gradient_updates(partial_sums[track], self.uploads[i][track], weights[track][i])
+		return partial_sums
+
+	def assign(self, mode, aggregated_updates, allocations, permuted_indices, weights):
+		"""
+		The downloads of the participants of the group, by their allocations (by track and participant) of the <aggregated_updates> from the root.
+		"""
+		for i in self.indices:
+			if i not in self.uploads:
+				continue
+			for track in EDGE_TRACKS:
+				if i in allocations[track]:
+					allocated_grad = allocate_download(aggregated_updates[track], mode, allocations[track][i], permuted_indices[track])
+					self.learner.participants[i].apply_download(track, allocated_grad, self.uploads[i][track], weights[i])
+		self.clear()
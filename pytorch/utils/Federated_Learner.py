@@ -1,24 +1,42 @@
-import time
 import json
 import pandas as pd
 import numpy as np
 import copy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math
 import torch
 from torch import nn, optim
 
 from utils.Data_Prepper import Data_Prepper
-from utils.Participant import Participant
+from utils.Participant import make_participant, make_freerider
+from utils.Metrics_Store import Metrics_Store
+from utils.Profiler import Profiler
+from utils.Memory_Tracker import Memory_Tracker
+from utils.Federated_Runtime import make_runtime
+from utils.Participant_Store import Participant_Store
 
 from utils.utils import evaluate, averge_models, \
-	add_update_to_model, compute_grad_update, compare_models,  \
-	add_gradient_updates
+	add_update_to_model, compare_models,  \
+	add_gradient_updates, get_rng_state, set_rng_state
+
+
+# the training state of the learner besides the models, see state_dict()
+LEARNER_STATE = ['reputations', 'reputations_pretrain', 'reputation_threshold', 'reputation_threshold_pretrain', 'reputation_threshold_coef',
+				'R', 'R_pretrain', 'alpha', 'reputation_fade', 'rounds_completed', 'participant_val_accs', 'participant_val_accs_pretrain',
+				'dssgd_val_accs', 'fedavg_val_accs', 'raw_reputations', 'raw_reputations_pretrain',
+				'participant_model_test_accs_before', 'participant_model_test_accs_before_w_pretrain']
+
+# the evaluation modes of evaluate_participants_performance, and the corresponding participant models
+EVALUATION_MODES = OrderedDict([('dssgd', 'dssgd_model'), ('fedavg', 'fedavg_model'), ('standalone', 'standalone_model'),
+					('cffl', 'model'), ('pretrain', 'model_pretrain')])
 
 
 class Federated_Learner:
 
-	def __init__(self, args, data_prepper):
+	def __init__(self, args, data_prepper, metrics_dir=None):
+		"""
+		metrics_dir: the directory to write the per-round metrics to as they are recorded, see Metrics_Store
+		"""
 		self.args = args
 		self.device = args['device']
 		self.device_ids = args['device_ids']
@@ -34,34 +52,45 @@ class Federated_Learner:
 			self.args['n_participants'], self.args['split'])
 		self.shard_sizes = torch.tensor(self.data_prepper.shard_sizes).float()
 		print("Shard sizes are: ", self.shard_sizes.tolist())
-		self.init_participants()
 		self.performance_dict = defaultdict(list)
 		self.performance_dict_pretrain = defaultdict(list)
 		self.time_dict = defaultdict(float)
+		self.memory_tracker = Memory_Tracker(self.memory_owners, device=self.device) if self.args.get('track_memory', False) else None
+		self.profiler = Profiler(self.time_dict, enabled=self.args.get('profile', False), operator_rounds=self.args.get('profile_operator_rounds', []),
+			memory=self.memory_tracker)
+		# the participants train in worker processes, see Federated_Runtime
+		self.runtime = make_runtime(self.args, self.profiler) if self.args.get('runtime', None) else None
+		# the server of the asynchronous mode, see start_training
+		self.async_server = None
+		# the participants of the current round if not all of them, see sample_participants
+		self.sampled_participants = None
+		# the state of the participants out of memory, see Participant_Store
+		self.participant_store = None
+		# the parameters of the participant models in one tensor, see Participant_Arena
+		self.participant_arena = None
+		self.init_participants()
+		# the edge aggregators of the groups of participants in the two-level topology, see Edge_Aggregator
+		self.edge_aggregators = None
+		if self.args.get('edge_groups', None):
+			self.edge_aggregators = make_edge_aggregators(self)
+			self.edge_of = {i: edge for edge in self.edge_aggregators for i in edge.indices}
+		self.metrics = Metrics_Store(self.args['fl_epochs'], self.n_participants, directory=metrics_dir)
 
 	def init_participants(self):
 		assert self.n_participants == len(
 			self.participant_train_loaders), "Num of participants is not equal to num of loaders"
 		model_fn = self.args['model_fn']
-		optimizer_fn = self.args['optimizer_fn']
-		lr = self.args['lr']
-		fed_lr = self.args['fed_lr'] if 'fed_lr' in self.args else lr
-		dssgd_lr = self.args['dssgd_lr']
-		std_lr = self.args['std_lr'] if 'std_lr' in self.args else dssgd_lr
-
 		device = self.args['device']
-		loss_fn = self.args['loss_fn']
-		theta = self.args['theta']
-		epoch_sample_size = self.args['epoch_sample_size']
-		grad_clip = self.args['grad_clip']
-		gamma = self.args['gamma']
 
-		if self.data_prepper.name in ['sst', 'mr', 'imdb']:
+		if self.data_prepper.args is not None:
+			# the text models, with the embedding arguments of the dataset
 			self.federated_model = model_fn(args=self.data_prepper.args, device=device)
 		else:
 			self.federated_model = model_fn(device=device)
 
-		self.load_locked_model_initializations()
+		if self.args.get('lock_initializations', True):
+			# the same initialization for all the runs on the dataset
+			self.load_locked_model_initializations()
 
 		if len(self.args['device_ids']) > 1:
 			print("From Federated Learner - Let's use {} gpus.".format(len(self.args['device_ids'])))
@@ -73,20 +102,18 @@ class Federated_Learner:
 		self.federated_model_pretrain = copy.deepcopy(self.federated_model)
 
 		self.participants = []
+		if self.runtime is not None:
+			assert not self.args.get('participant_store', None), "The participants of the runtime are kept by its workers, not by a participant store."
+			assert not self.args.get('participant_arena', False), "The participant models of the runtime are in its workers, not in an arena."
+			# the participants are created in the workers, and the learner calls them through proxies, see Federated_Runtime.start
+			self.participants = self.runtime.start(self.federated_model, self.participant_train_loaders, self.n_freeriders,
+				OrderedDict([('valid', self.valid_loader), ('test', self.test_loader)]))
+
 		# add in free riders
 		if self.n_freeriders > 0:		
-			freerider = Participant(train_loader=None,
-							model=copy.deepcopy(self.federated_model),
-							model_pretrain = copy.deepcopy(self.federated_model),
-							standalone_model=copy.deepcopy(self.federated_model),
-							dssgd_model=copy.deepcopy(self.federated_model),
-							fedavg_model=copy.deepcopy(self.federated_model),
-							theta=theta,
-							device=device,
-							is_free_rider=True
-							)
-
-			self.participants += [freerider] * self.n_freeriders
+			if self.runtime is None:
+				freerider = make_freerider(self.args, self.federated_model)
+				self.participants += [freerider] * self.n_freeriders
 			self.n_participants += self.n_freeriders
 			self.shard_sizes = torch.cat([torch.zeros(self.n_freeriders), self.shard_sizes])
 			# for i in range(self.n_freeriders):
@@ -94,108 +121,85 @@ class Federated_Learner:
 			# 	self.shard_sizes.insert(0, 0)
 			# 	self.n_participants+=1
 		
+		if self.runtime is not None:
+			return
+
+		if self.args.get('participant_store', None):
+			# the participants are materialized from the arena of the store when called
+			assert not self.args.get('participant_arena', False), "The participant store keeps only a few participants in memory, not an arena of all of them."
+			self.participant_store = Participant_Store(self.args, self.federated_model, self.participant_train_loaders, self.profiler)
+			self.participants += self.participant_store.participants
+			return
+
 		# possible to enumerate through various model_fns, optimizer_fns, lrs,
 		# thetas, or even devices
 		for i, participant_train_loader in enumerate(self.participant_train_loaders):
-			model = copy.deepcopy(self.federated_model)
-			optimizer = optimizer_fn(model.parameters(), lr=lr)
-			scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma = gamma)
-
-
-			model_pretrain = copy.deepcopy(self.federated_model)
-			optimizer_pretrain = optimizer_fn(model_pretrain.parameters(), lr=lr)
-			scheduler_pretrain = torch.optim.lr_scheduler.ExponentialLR(optimizer_pretrain, gamma = gamma)
-
-
-			standalone_model = copy.deepcopy(self.federated_model)
-			standalone_optimizer = optimizer_fn(standalone_model.parameters(), lr=std_lr)
-			standalone_scheduler = torch.optim.lr_scheduler.ExponentialLR(standalone_optimizer, gamma = gamma)
-
-			dssgd_model = copy.deepcopy(self.federated_model)
-			dssgd_optimizer = optimizer_fn(dssgd_model.parameters(), lr=dssgd_lr)
-			# dssgd_optimizer = optimizer_fn(dssgd_model.parameters(), lr=lr)
-			# 0.977 ** 100 ~= 0.1    a smaller decay rate
-			dssgd_scheduler = torch.optim.lr_scheduler.ExponentialLR(dssgd_optimizer, gamma = gamma)
-
-			fedavg_model = copy.deepcopy(self.federated_model)
-			fedavg_optimizer = optimizer_fn(fedavg_model.parameters(), lr=fed_lr)
-			fedavg_scheduler = torch.optim.lr_scheduler.ExponentialLR(fedavg_optimizer, gamma = gamma)
-
-
-			participant = Participant(train_loader=participant_train_loader,
-							model=model, optimizer=optimizer, scheduler=scheduler,
-							model_pretrain=model_pretrain, optimizer_pretrain=optimizer_pretrain,scheduler_pretrain=scheduler_pretrain,
-							pretraining_lr=self.args['pretraining_lr'],
-
-							standalone_model=standalone_model, standalone_optimizer=standalone_optimizer, standalone_scheduler=standalone_scheduler,
-							dssgd_model=dssgd_model, dssgd_optimizer=dssgd_optimizer,dssgd_scheduler=dssgd_scheduler,
-							fedavg_model=fedavg_model, fedavg_optimizer=fedavg_optimizer, fedavg_scheduler=fedavg_scheduler,
-							loss_fn=loss_fn, theta=theta,
-							grad_clip=grad_clip, epoch_sample_size=epoch_sample_size,
-							device=device,
-							id=i,
-							)
+			participant = make_participant(self.args, self.federated_model, participant_train_loader, id=i)
 			self.participants.append(participant)
+
+		if self.args.get('participant_arena', False):
+			assert not (self.save_gpu and 'cuda' in str(self.device)), "The participant models stay in the arena on the device, without save_gpu."
+			self.participant_arena = make_participant_arena(self.participants)
 		return
 
 	def train_locally(self, epochs, is_pretrain=False, save_gpu=False):
 
+		# the participants that ran out of the round budget and continue their local training in the next round
+		self.deferred_participants = []
+
+		if self.runtime is not None and self.runtime.collective:
+			# the participants of all the ranks train at once, see Distributed_Runtime.train_locally
+			return self.runtime.train_locally(self, epochs, is_pretrain=is_pretrain, save_gpu=save_gpu)
+
 		if is_pretrain:
 			for i, participant in enumerate(self.participants):
 				participant.train(epochs, is_pretrain=is_pretrain)
 			return
 
-		self.filtered_updates = []
-		self.filtered_updates_pretrain = []
+		# the participants absent from the round upload nothing, and keep their last validation accuracies
+		self.filtered_updates = [None] * self.n_participants
+		self.filtered_updates_pretrain = [None] * self.n_participants
 
 		self.aggregated_gradient_updates = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
 		self.aggregated_gradient_updates_pretrain = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
-
-		participant_val_accs = []
-		participant_val_accs_pretrain = []
-		dssgd_val_accs = []
-		fedavg_val_accs = []
-
-		for i, participant in enumerate(self.participants):
-			self.timestamp = time.time()
-
-			model_before = copy.deepcopy(participant.model)
-			dssgd_model_before = copy.deepcopy(participant.dssgd_model)
-			model_pretrain_before = copy.deepcopy(participant.model_pretrain)
-			fedavg_model_before = copy.deepcopy(participant.fedavg_model)
-
-			participant.train(epochs, is_pretrain=is_pretrain, save_gpu=save_gpu)
-			model_after = copy.deepcopy(participant.model)
-			dssgd_model_after = copy.deepcopy(participant.dssgd_model)
-			model_pretrain_after = copy.deepcopy(participant.model_pretrain)
-			fedavg_model_after = copy.deepcopy(participant.fedavg_model)
-
-			self.clock('participants local training')
-
-			# recover the model before training for clipped grad update later
-			participant.model.load_state_dict(model_before.state_dict())
-
-			raw_grad_update = compute_grad_update(model_before, model_after, device=self.device)
-			del model_before, model_after  # to free up memory immediately
-
-
-			'''
-			# clipped stats
-			columns = ['','grad_mean','clipped_count', 'clipped_ratio']
-			data_rows = []
-
-			all_update_mod = torch.cat([update.data.view(-1).abs()for update in raw_grad_update])
-			n_clipped = (all_update_mod > self.args['grad_clip']).sum().item()
-			data_rows.append([ 'w/o pretrain: ', all_update_mod.mean().item(), n_clipped, torch.true_divide(n_clipped, len(all_update_mod)).item() ])
-			'''
-
-			clipped_grad_update = clip_gradient_update(raw_grad_update, self.args['grad_clip'])
-			# add the clipped grad to local model
-			add_update_to_model(participant.model, clipped_grad_update, device=self.device)
-			filtered_grad_update = mask_grad_update_by_order(clipped_grad_update, mask_order=None, mask_percentile=participant.theta, mode=self.args['largest_criterion']) 
-
-			fed_val_acc = self.one_on_one_evaluate(self.federated_model, participant.model, filtered_grad_update, participant.theta)
-			participant_val_accs.append(fed_val_acc)
+		if self.edge_aggregators is not None:
+			for edge in self.edge_aggregators:
+				edge.clear()
+
+		if self.sampled_participants is None:
+			participant_val_accs = [None] * self.n_participants
+			participant_val_accs_pretrain = [None] * self.n_participants
+			dssgd_val_accs = [None] * self.n_participants
+			fedavg_val_accs = [None] * self.n_participants
+		else:
+			participant_val_accs = list(self.participant_val_accs)
+			participant_val_accs_pretrain = list(self.participant_val_accs_pretrain)
+			dssgd_val_accs = list(self.dssgd_val_accs)
+			fedavg_val_accs = list(self.fedavg_val_accs)
+
+		for i in self.round_participants():
+			participant = self.participants[i]
+			self.profiler.begin('participant', participant=i)
+			self.profiler.mark()
+
+			# the local training, and the clipping and filtering of the updates to upload, see Participant.local_updates
+			uploads = participant.local_updates(epochs, self.args['grad_clip'], self.args['largest_criterion'], save_gpu=save_gpu, profiler=self.profiler,
+				budget=self.round_budget(i), defer_late=(self.args.get('late_participants', 'partial') == 'defer'))
+
+			if uploads is None:
+				# deferred: no upload and no download in this round, and the dssgd and fedavg models are the server's
+				self.deferred_participants.append(i)
+				participant_val_accs[i] = None
+				participant_val_accs_pretrain[i] = None
+				dssgd_val_accs[i] = evaluate(self.dssgd_model, self.valid_loader, self.device, verbose=False)[1]
+				fedavg_val_accs[i] = evaluate(self.fedavg_model, self.valid_loader, self.device, verbose=False)[1]
+				self.profiler.clock('evaluate', key='server aggregation dssgd')
+				self.profiler.end()
+				continue
+
+			self.profiler.begin('track', track='cffl')
+			fed_val_acc = self.one_on_one_evaluate(self.federated_model, participant, uploads['cffl'], participant.theta)
+			participant_val_accs[i] = fed_val_acc
 
 			# minus the uploaded grad updates
 			# add_update_to_model(participant.model, filtered_grad_update, weight= -1.0)
@@ -203,86 +207,172 @@ class Federated_Learner:
 			# register this filtered_updates for later to removed
 			# NOTE that we do not minus this update because this participant may not be reputable 
 			# after evaluation, meaning it does not receive allocated_grad, so no need to minus its own
-			self.filtered_updates.append(filtered_grad_update)
+			if self.edge_aggregators is None:
+				self.filtered_updates[i] = uploads['cffl']
 
-			self.clock('gradient clipping and filtering')
+			self.profiler.clock('evaluate', key='gradient clipping and filtering')
+			self.profiler.end()
 
 			# for with pretraining
 
-			participant.model_pretrain.load_state_dict(model_pretrain_before.state_dict())
-			raw_grad_update = compute_grad_update(model_pretrain_before, model_pretrain_after, device=self.device)				
-			del model_pretrain_before, model_pretrain_after
-
-			'''
-			# clipped stats
-			all_update_mod = torch.cat([update.data.view(-1).abs()for update in raw_grad_update])
-			n_clipped = (all_update_mod > self.args['grad_clip']).sum().item()
-			data_rows.append([ 'w pretrain: ', all_update_mod.mean().item(), n_clipped, torch.true_divide(n_clipped, len(all_update_mod)).item() ])
-			'''
-
-			clipped_grad_update = clip_gradient_update(raw_grad_update, self.args['grad_clip'])
-			add_update_to_model(participant.model_pretrain, clipped_grad_update, device=self.device)
-			filtered_grad_update = mask_grad_update_by_order(clipped_grad_update, mask_order=None, mask_percentile=participant.theta, mode=self.args['largest_criterion']) 			
-
-			fed_val_acc = self.one_on_one_evaluate(self.federated_model_pretrain, participant.model_pretrain, filtered_grad_update, participant.theta, is_pretrain=True)
-			participant_val_accs_pretrain.append(fed_val_acc)
+			self.profiler.begin('track', track='pretrain')
+			fed_val_acc = self.one_on_one_evaluate(self.federated_model_pretrain, participant, uploads['pretrain'], participant.theta, is_pretrain=True)
+			participant_val_accs_pretrain[i] = fed_val_acc
 
 			# minus the uploaded grad updates
 			# add_update_to_model(participant.model_pretrain, filtered_grad_update, weight= -1.0)
-			self.filtered_updates_pretrain.append(filtered_grad_update)
+			if self.edge_aggregators is None:
+				self.filtered_updates_pretrain[i] = uploads['pretrain']
+			else:
+				# the uploads to aggregate are kept by the edge aggregator of the participant
+				self.edge_of[i].collect(i, uploads)
 			
-			self.clock('gradient clipping and filtering for pretrain')
+			self.profiler.clock('evaluate', key='gradient clipping and filtering for pretrain')
+			self.profiler.end()
 
 
 			# for DSSGD model
 
-			dssgd_grad_update = compute_grad_update(dssgd_model_before, dssgd_model_after, device=self.device)
-			del dssgd_model_before, dssgd_model_after  # to free up memory immediately
-
-			'''
-			# clipped stats
-			all_update_mod = torch.cat([update.data.view(-1).abs()for update in dssgd_grad_update])
-			n_clipped = (all_update_mod > self.args['grad_clip']).sum().item()
-			data_rows.append([ 'dssgd:', all_update_mod.mean().item(), n_clipped, torch.true_divide(n_clipped, len(all_update_mod)).item() ])
-			'''
-
-			filtered_grad_update = mask_grad_update_by_order(clip_gradient_update(dssgd_grad_update, 0.001), mask_order=None, mask_percentile=participant.theta, mode=self.args['largest_criterion'])
-
+			self.profiler.begin('track', track='dssgd')
 			# this is executed in a fixed sequence, so the self.dssgd_model gets gradually updated and 'downloaded' by each participant
-			participant.dssgd_model.load_state_dict(add_update_to_model(self.dssgd_model, filtered_grad_update).state_dict(), strict=False)
-		
-			dssgd_val_acc = evaluate(participant.dssgd_model, self.valid_loader, self.device, verbose=False)[1]
-			dssgd_val_accs.append(dssgd_val_acc)
+			participant.download_model('dssgd', add_update_to_model(self.dssgd_model, uploads['dssgd']).state_dict())
+			self.profiler.clock('aggregate', key='server aggregation dssgd')
 
-			self.clock('server aggregation dssgd')
+			# the participant's dssgd model is now the same as the server's
+			dssgd_val_acc = evaluate(self.dssgd_model, self.valid_loader, self.device, verbose=False)[1]
+			dssgd_val_accs[i] = dssgd_val_acc
 
+			self.profiler.clock('evaluate', key='server aggregation dssgd')
+			self.profiler.end()
 
-			# for fedavg model
 
-			fedavg_grad_update = compute_grad_update(fedavg_model_before, fedavg_model_after, device=self.device)
-			del fedavg_model_before, fedavg_model_after  # to free up memory immediately
+			# for fedavg model
 
+			self.profiler.begin('track', track='fedavg')
 			# this is executed in a fixed sequence, so the self.dssgd_model gets gradually updated and 'downloaded' by each participant
 			# to follow fedavg method, incorporate the weighting via the shardsize
 
-			weight = torch.div(self.shard_sizes[i], self.shard_sizes.sum())
-			participant.fedavg_model.load_state_dict(add_update_to_model(self.fedavg_model, fedavg_grad_update, weight = weight).state_dict(), strict=False)
+			weight = torch.div(self.shard_sizes[i], self.round_shard_sizes().sum())
+			participant.download_model('fedavg', add_update_to_model(self.fedavg_model, uploads['fedavg'], weight = weight).state_dict())
+			self.profiler.clock('aggregate', key='server aggregation fedavg')
 			
-			fedavg_val_acc = evaluate(participant.fedavg_model, self.valid_loader, self.device, verbose=False)[1]
-			fedavg_val_accs.append(fedavg_val_acc)
+			fedavg_val_acc = evaluate(self.fedavg_model, self.valid_loader, self.device, verbose=False)[1]
+			fedavg_val_accs[i] = fedavg_val_acc
 
-			self.clock('server aggregation fedavg')
+			self.profiler.clock('evaluate', key='server aggregation fedavg')
+			self.profiler.end()
+			self.profiler.end()
+			del uploads
 
-			'''
-			# clipped stats
-			print(pd.DataFrame(data=data_rows, columns=columns))
-			'''
+		if self.deferred_participants:
+			participant_val_accs = self.deferred_val_accs(participant_val_accs, self.participant_val_accs)
+			participant_val_accs_pretrain = self.deferred_val_accs(participant_val_accs_pretrain, self.participant_val_accs_pretrain)
 
 		return participant_val_accs, participant_val_accs_pretrain, dssgd_val_accs, fedavg_val_accs
 
 
+	def round_budget(self, i):
+		"""
+		The budget of the local training of participant i in a round, see Participant.train: round_deadline samples times its participant_speeds
+		(samples at speed 1, as the clock of Async_Server), or round_deadline seconds if deadline_unit is 'seconds'. None without a round_deadline.
+		"""
+		deadline = self.args.get('round_deadline', None)
+		if deadline is None:
+			return None
+		if self.args.get('deadline_unit', 'samples') == 'seconds':
+			return {'seconds': deadline}
+		speeds = self.args.get('participant_speeds', None)
+		return {'samples': deadline * speeds[i] if speeds else deadline}
+
+	def deferred_val_accs(self, val_accs, last_val_accs):
+		"""
+		The validation accuracies of the deferred participants for the reputation update, by deferred_reputation:
+		'keep': its accuracy of the last round (the mean of the round before it has one), so that its reputation only moves with the others'
+		'zero': zero, so that its reputation fades like that of a participant with a useless upload
+		"""
+		uploaded = [val_acc for val_acc in val_accs if val_acc is not None]
+		for i in self.deferred_participants:
+			if self.args.get('deferred_reputation', 'keep') == 'zero' or not uploaded:
+				val_accs[i] = torch.tensor(0.)
+			elif last_val_accs is not None:
+				val_accs[i] = last_val_accs[i]
+			else:
+				val_accs[i] = sum(uploaded) / len(uploaded)
+		return val_accs
+
+	def sample_participants(self):
+		"""
+		The participants of a round, a participation_fraction of them sampled by participant_sampling:
+		'uniform', 'shard': by shard size (the freeriders by the average shard), 'reputation': by the reputations (without pretraining).
+		None (all the participants) for a participation_fraction of 1.
+		"""
+		fraction = self.args.get('participation_fraction', 1)
+		if fraction >= 1:
+			return None
+		sampling = self.args.get('participant_sampling', 'uniform')
+		if sampling == 'shard':
+			weights = self.shard_sizes.clone()
+			weights[weights == 0] = weights[weights > 0].mean()
+		elif sampling == 'reputation':
+			weights = self.reputations.clone()
+		else:
+			weights = torch.ones(self.n_participants)
+		n_sampled = min(max(1, int(round(fraction * self.n_participants))), int((weights > 0).sum()))
+		return sorted(torch.multinomial(weights, n_sampled, replacement=False).tolist())
+
+	def round_participants(self):
+		return self.sampled_participants if self.sampled_participants is not None else range(self.n_participants)
+
+	def round_shard_sizes(self):
+		# the shard sizes of the participants of the round, and zeros for the others
+		if self.sampled_participants is None:
+			return self.shard_sizes
+		shard_sizes = torch.zeros(self.n_participants)
+		shard_sizes[self.sampled_participants] = self.shard_sizes[self.sampled_participants]
+		return shard_sizes
+
+	def update_sampled_reputations(self, val_accs, val_accs_pretrain, alpha):
+		"""
+		The reputation update of the sampled participants, see compute_reputations_partial, with the absent participants by absent_reputation:
+		'keep': their reputations stay, and their last validation accuracies count in the others' relative accuracies
+		'zero': their reputations fade as with a validation accuracy of zero
+		"""
+		updated = self.sampled_participants
+		if self.args.get('absent_reputation', 'keep') == 'zero':
+			sampled = set(self.sampled_participants)
+			val_accs = [val_acc if i in sampled else torch.tensor(0.) for i, val_acc in enumerate(val_accs)]
+			val_accs_pretrain = [val_acc if i in sampled else torch.tensor(0.) for i, val_acc in enumerate(val_accs_pretrain)]
+			updated = range(self.n_participants)
+
+		self.raw_reputations, self.reputations, self.reputation_threshold, self.R = compute_reputations_partial(self.raw_reputations, self.reputations,
+			self.reputation_threshold, self.R, updated, val_accs,
+			alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef,
+			total_val_accs=self.reputation_statistics(val_accs, self.R))
+		self.raw_reputations_pretrain, self.reputations_pretrain, self.reputation_threshold_pretrain, self.R_pretrain = compute_reputations_partial(self.raw_reputations_pretrain, self.reputations_pretrain,
+			self.reputation_threshold_pretrain, self.R_pretrain, updated, val_accs_pretrain,
+			alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef,
+			total_val_accs=self.reputation_statistics(val_accs_pretrain, self.R_pretrain))
+
+	def reputation_statistics(self, val_accs, R):
+		"""
+		The sum of the validation accuracies of R, the normalizer of the reputation update, summed by the edge aggregators over their groups.
+		None without them, for compute_reputations_sinh to sum it.
+		"""
+		if self.edge_aggregators is None:
+			return None
+		return sum([edge.reputation_statistics(val_accs, R) for edge in self.edge_aggregators])
+
 	def train(self):
+		self.start_training()
+		for epoch in range(self.args['fl_epochs']):
+			self.train_round(epoch)
+		self.finish_training()
+		return
 
+	def start_training(self):
+		"""
+		Initialize the reputations and do the local pretraining, before the first communication round.
+		"""
 		self.reputations = torch.zeros((self.n_participants))
 		self.reputations_pretrain = torch.zeros((self.n_participants))
 
@@ -293,10 +383,16 @@ class Federated_Learner:
 
 		self.R = list(range(self.n_participants))
 		self.R_pretrain = list(range(self.n_participants))
+		self.rounds_completed = 0
+		self.participant_val_accs, self.participant_val_accs_pretrain = None, None
+		self.dssgd_val_accs, self.fedavg_val_accs = None, None
+		self.raw_reputations, self.raw_reputations_pretrain = None, None
+
+		if self.args.get('round_deadline', None) is not None:
+			assert self.runtime is None or not self.runtime.collective, "The round deadline is not supported by the ranks of Distributed_Runtime."
+			assert not self.args.get('asynchronous', False), "The asynchronous participants have no rounds to meet a deadline of."
 
-		fl_epochs = self.args['fl_epochs']
 		device = self.args['device']
-		fl_individual_epochs = self.args['fl_individual_epochs']
 
 		self.alpha = self.args['alpha'] if 'alpha' in self.args else 5
 		self.reputation_fade = self.args['reputation_fade'] if 'reputation_fade' in self.args else 1
@@ -305,11 +401,11 @@ class Federated_Learner:
 		self.performance_dict_pretrain['shard_sizes'] = self.shard_sizes.tolist()
 
 		# print("Start local pretraining ")
-		self.timestamp = time.time()
+		self.profiler.mark()
 
 		self.train_locally(self.args['pretrain_epochs'], is_pretrain=True, save_gpu=self.save_gpu)
 
-		self.clock('pretraining')
+		self.profiler.clock('pretraining')
 
 		self.participant_model_test_accs_before = self.evaluate_participants_performance(self.test_loader)
 		self.performance_dict['participant_model_test_accs_before'] = self.participant_model_test_accs_before
@@ -331,69 +427,130 @@ class Federated_Learner:
 		print("CFFL server model test accuracy : {:.4%}".format(federated_test_acc))
 
 
-		self.clock('evaluation after pretraining')
+		if self.args.get('asynchronous', False):
+			self.async_server = make_async_server(self)
+			self.async_server.start(federated_val_acc)
 
-		# print("\nStart federated learning \n")
-		for epoch in range(fl_epochs):
-			# 1. training locally
-			participant_val_accs, participant_val_accs_pretrain, dssgd_val_accs, fedavg_val_accs = self.train_locally(fl_individual_epochs,save_gpu=self.save_gpu)
+		if self.edge_aggregators is not None:
+			assert self.runtime is None or not self.runtime.collective, "The ranks of Distributed_Runtime already aggregate their participants, use a runtime of Federated_Runtime."
+			assert self.async_server is None, "The asynchronous server applies every upload on its arrival, without the edge aggregators."
 
-			if 'alpha_decay' in self.args and self.args['alpha_decay']:
-				alpha = self.alpha * (1 + epoch/fl_epochs)
-			else:
-				alpha = self.alpha
+		if self.args.get('participation_fraction', 1) < 1:
+			assert self.runtime is None or not self.runtime.collective, "The ranks of Distributed_Runtime train all their participants every round."
+			assert self.async_server is None, "The asynchronous participants are not sampled."
+			# the reputations of equal validation accuracies, and the server's accuracy for the participants not sampled yet, see update_sampled_reputations
+			self.reputations = torch.ones(self.n_participants) / self.n_participants
+			self.reputations_pretrain = self.reputations.clone()
+			self.raw_reputations, self.raw_reputations_pretrain = self.reputations.clone(), self.reputations.clone()
+			self.participant_val_accs = [federated_val_acc] * self.n_participants
+			self.participant_val_accs_pretrain = [federated_val_acc] * self.n_participants
+			self.dssgd_val_accs = [federated_val_acc] * self.n_participants
+			self.fedavg_val_accs = [federated_val_acc] * self.n_participants
+
+		self.profiler.clock('evaluation after pretraining')
+		return
+
+	def train_round(self, epoch):
+		self.run_round(epoch)
+		self.record_round(epoch)
 
-			# 2. update the reputations and reputation_threshold
-			# and update the reputable participants set
+	def run_round(self, epoch):
+		"""
+		One communication round: local training, reputation updates, aggregation and the downloads.
+		"""
+		if self.async_server is not None:
+			# n_participants arrivals at the asynchronous server in place of the synchronous round
+			self.async_server.run_round(epoch)
+			self.rounds_completed = epoch + 1
+			return
+
+		fl_epochs = self.args['fl_epochs']
+		fl_individual_epochs = self.args['fl_individual_epochs']
+		self.profiler.begin_round(epoch)
+		self.sampled_participants = self.sample_participants()
+		if self.participant_store is not None:
+			# the store counts the participants by their train loaders, i.e., after the free riders, who are not in the store
+			self.participant_store.schedule = None if self.sampled_participants is None else \
+				[i - self.n_freeriders for i in self.sampled_participants if i >= self.n_freeriders]
+
+		# 1. training locally
+		participant_val_accs, participant_val_accs_pretrain, self.dssgd_val_accs, self.fedavg_val_accs = self.train_locally(fl_individual_epochs,save_gpu=self.save_gpu)
+		self.participant_val_accs, self.participant_val_accs_pretrain = participant_val_accs, participant_val_accs_pretrain
+
+		if 'alpha_decay' in self.args and self.args['alpha_decay']:
+			alpha = self.alpha * (1 + epoch/fl_epochs)
+		else:
+			alpha = self.alpha
+
+		# 2. update the reputations and reputation_threshold
+		# and update the reputable participants set (unless all the participants are deferred)
+		if self.sampled_participants is not None:
+			self.update_sampled_reputations(participant_val_accs, participant_val_accs_pretrain, alpha)
+		elif len(self.deferred_participants) < self.n_participants:
 			self.reputations, self.reputation_threshold, self.R  = compute_reputations_sinh(self.reputations, self.reputation_threshold, self.R, participant_val_accs, 
-				alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef)
+				alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef,
+				total_val_accs=self.reputation_statistics(participant_val_accs, self.R))
 			self.reputations_pretrain, self.reputation_threshold_pretrain, self.R_pretrain = compute_reputations_sinh(self.reputations_pretrain, self.reputation_threshold_pretrain, self.R_pretrain, participant_val_accs_pretrain, 
-				alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef)
-
-			self.clock('reputation updates')
+				alpha=alpha, reputation_fade=self.reputation_fade, split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef,
+				total_val_accs=self.reputation_statistics(participant_val_accs_pretrain, self.R_pretrain))
 
+		self.profiler.clock('reputation updates')
 
-			# 3. aggregate the gradients and update the federated model
-			self.aggregate_gradients_and_update_federated_model()
-			self.clock('aggregate gradients and update FL model')
 
+		# 3. aggregate the gradients and update the federated model
+		self.aggregate_gradients_and_update_federated_model()
+		self.profiler.clock('aggregate gradients and update FL model')
 
-			# 4. gradient downloads and uploads according to reputations and thetas
-			self.assign_updates_with_filter()
-			self.clock('assign updates')
 
-			# update the performance dict as log
-			if (epoch+1) % 20 == 0:
-				print()
-				print('Epoch {}:'.format(epoch + 1))
-				print("Without pretraining:")
-				print("Reputations: {}, Reputation threshold: {}.".format(np.around(self.reputations.tolist(), 3),
-					np.around(self.reputation_threshold.item(), 3)))
-				print("Reputable participants: ", self.R)
-				print()
-				print("With pretraining:")
-				print("Reputations: {}, Reputation threshold: {}.".format(np.around(self.reputations_pretrain.tolist(), 3),
-					np.around(self.reputation_threshold_pretrain.item(), 3))) 
-				print("Reputable participants: ", self.R_pretrain)
-				print()
+		# 4. gradient downloads and uploads according to reputations and thetas
+		self.assign_updates_with_filter()
+		self.profiler.clock('assign updates')
+		self.profiler.end_round(epoch)
 
+		# update the performance dict as log
+		if (epoch+1) % 20 == 0:
+			print()
+			print('Epoch {}:'.format(epoch + 1))
+			print("Without pretraining:")
+			print("Reputations: {}, Reputation threshold: {}.".format(np.around(self.reputations.tolist(), 3),
+				np.around(self.reputation_threshold.item(), 3)))
+			print("Reputable participants: ", self.R)
+			print()
+			print("With pretraining:")
+			print("Reputations: {}, Reputation threshold: {}.".format(np.around(self.reputations_pretrain.tolist(), 3),
+				np.around(self.reputation_threshold_pretrain.item(), 3))) 
+			print("Reputable participants: ", self.R_pretrain)
+			print()
+		self.rounds_completed = epoch + 1
+		return
 
-			self.performance_summary(to_print=((epoch+1)%20==0))
+	def record_round(self, epoch, test_accs=None, evaluate=True):
+		"""
+		Evaluate the participants on the test set and record the round in the performance dicts.
+		test_accs: the test accuracies of the evaluation_models(), if already evaluated together with other models.
+		evaluate: False to record the round without the test set evaluation, see CFFL_Session.
+		"""
+		self.profiler.mark()
+		if evaluate:
+			self.performance_summary(to_print=((epoch+1)%20==0), test_accs=test_accs)
 
 
-			self.performance_dict['dssgd_val_accs'].append(dssgd_val_accs)
-			self.performance_dict_pretrain['dssgd_val_accs'].append(dssgd_val_accs)
-			self.performance_dict['fedavg_val_accs'].append(fedavg_val_accs)
-			self.performance_dict_pretrain['fedavg_val_accs'].append(fedavg_val_accs)
+		self.metrics.append('val_accs', 'dssgd', self.dssgd_val_accs)
+		self.metrics.append('val_accs', 'fedavg', self.fedavg_val_accs)
+		self.metrics.append('val_accs', 'cffl', self.participant_val_accs)
+		self.metrics.append('val_accs', 'pretrain', self.participant_val_accs_pretrain)
 
-			self.performance_dict['reputations'].append(self.reputations)
-			self.performance_dict['reputation_threshold'].append(self.reputation_threshold)
+		self.metrics.append('reputations', 'cffl', self.reputations.tolist())
+		self.metrics.append('reputation_threshold', 'cffl', self.reputation_threshold)
 
-			self.performance_dict_pretrain['reputations'].append(self.reputations_pretrain)
-			self.performance_dict_pretrain['reputation_threshold'].append(self.reputation_threshold_pretrain)
-			# print()
-			self.clock('performance update')
+		self.metrics.append('reputations', 'pretrain', self.reputations_pretrain.tolist())
+		self.metrics.append('reputation_threshold', 'pretrain', self.reputation_threshold_pretrain)
+		self.metrics.flush()
+		# print()
+		self.profiler.clock('performance update', round=epoch + 1)
+		return
 
+	def finish_training(self):
 		total_seconds = 0
 		for key, value in self.time_dict.items():
 			# print(key, value)
@@ -404,10 +561,102 @@ class Federated_Learner:
 		print('-----')
 		print(json.dumps(self.time_dict))
 		print('-----')
+		if self.memory_tracker is not None:
+			print('Memory of the phases in MB: peak RSS, and the live tensors by owner.')
+			print('-----')
+			print(json.dumps(self.memory_tracker.summary()))
+			print('-----')
+		if self.runtime is not None:
+			print('Communication with the participant workers.')
+			print('-----')
+			print(json.dumps(self.runtime.summary()))
+			print('-----')
+			self.runtime.close()
+		if self.participant_store is not None:
+			print('Materializations of the participants from the store.')
+			print('-----')
+			print(json.dumps(self.participant_store.summary()))
+			print('-----')
+			self.participant_store.close()
+		if self.async_server is not None:
+			print('Simulated time of the asynchronous uploads, against the same rounds with a barrier.')
+			print('-----')
+			print(json.dumps(self.async_server.summary()))
+			print('-----')
+		if self.profiler.enabled:
+			print('Runtime of the phases by track and by participant in seconds.')
+			print(self.profiler.summary('track').to_string())
+			print(self.profiler.summary('participant').to_string())
+			print('-----')
 
 		self.convert_tensors_in_dicts()
 		return
 
+	def memory_owners(self):
+		# the objects holding the tensors of the run, by owner, see Memory_Tracker
+		# with the runtime, the participants' models and optimizers are in the workers, and with the store, only the live ones are in memory
+		participants = self.participants if self.participant_store is None else self.participant_store.live_participants()
+		participant_models = [getattr(participant, name, None) for participant in participants
+			for name in ['model', 'model_pretrain', 'standalone_model', 'dssgd_model', 'fedavg_model']]
+		optimizers = [getattr(participant, name, None) for participant in participants
+			for name in ['optimizer', 'optimizer_pretrain', 'standalone_optimizer', 'dssgd_optimizer', 'fedavg_optimizer']]
+		server_models = [getattr(self, name, None) for name in ['federated_model', 'federated_model_pretrain', 'dssgd_model', 'fedavg_model']]
+		stored_updates = [getattr(self, name, None) for name in ['filtered_updates', 'filtered_updates_pretrain',
+			'aggregated_gradient_updates', 'aggregated_gradient_updates_pretrain']]
+		datasets = [self.data_prepper, self.participant_train_loaders, self.valid_loader, self.test_loader]
+		owners = OrderedDict([('participant models', participant_models), ('optimizer state', optimizers), ('server models', server_models),
+			('stored updates', stored_updates), ('datasets', datasets)])
+		if self.edge_aggregators is not None:
+			# the uploads kept by the edge aggregators, apart from the stored updates of the root
+			owners['edge uploads'] = [edge.uploads for edge in self.edge_aggregators]
+		return owners
+
+	def state_dict(self):
+		"""
+		Everything needed to resume the training after start_training() or any completed round,
+		including the random states so that the resumed run is the same as an uninterrupted one.
+		"""
+		state = {name: getattr(self, name) for name in LEARNER_STATE}
+		for name in ['federated_model', 'federated_model_pretrain', 'dssgd_model', 'fedavg_model']:
+			state[name] = getattr(self, name).state_dict()
+		if self.participant_arena is not None:
+			# the participant models at once, as a copy of the arena
+			state['participant_arena'] = self.participant_arena.state_dict()
+			state['participants'] = [participant.state_dict(models=False) for participant in self.participants]
+		else:
+			state['participants'] = [participant.state_dict() for participant in self.participants]
+		state['performance_dict'] = dict(self.performance_dict)
+		state['performance_dict_pretrain'] = dict(self.performance_dict_pretrain)
+		state['time_dict'] = dict(self.time_dict)
+		state['metrics'] = self.metrics.state_dict()
+		if self.async_server is not None:
+			state['async_server'] = self.async_server.state_dict()
+		state['rng_state'] = get_rng_state()
+		return state
+
+	def load_state_dict(self, state):
+		for name in LEARNER_STATE:
+			setattr(self, name, state[name])
+		for name in ['federated_model', 'federated_model_pretrain']:
+			getattr(self, name).load_state_dict(state[name])
+		self.dssgd_model = copy.deepcopy(self.federated_model).to(self.device)
+		self.dssgd_model.load_state_dict(state['dssgd_model'])
+		self.fedavg_model = copy.deepcopy(self.federated_model).to(self.device)
+		self.fedavg_model.load_state_dict(state['fedavg_model'])
+		for participant, participant_state in zip(self.participants, state['participants']):
+			participant.load_state_dict(participant_state)
+		if 'participant_arena' in state:
+			self.participant_arena.load_state_dict(state['participant_arena'])
+		self.performance_dict = defaultdict(list, state['performance_dict'])
+		self.performance_dict_pretrain = defaultdict(list, state['performance_dict_pretrain'])
+		self.time_dict = defaultdict(float, state['time_dict'])
+		self.profiler.totals = self.time_dict
+		self.metrics.load_state_dict(state['metrics'])
+		if 'async_server' in state:
+			self.async_server = make_async_server(self)
+			self.async_server.load_state_dict(state['async_server'])
+		set_rng_state(state['rng_state'])
+
 	def load_locked_model_initializations(self, dirname='initialized_models'):
 		import os
 		models_dir = os.path.join(dirname, self.args['dataset'])
@@ -427,15 +676,8 @@ class Federated_Learner:
 			torch.save(self.federated_model.state_dict(), model_path)
 
 
-	def one_on_one_evaluate(self, federated_model, participant_model, filtered_grad_update, theta, is_pretrain=False):
-		if theta == 1 and not is_pretrain:
-			fed_val_acc = evaluate(participant_model, self.valid_loader, self.device, verbose=False)[1]
-		else:
-			model_to_eval = copy.deepcopy(federated_model)
-			add_update_to_model(model_to_eval, filtered_grad_update, device=self.device)
-			fed_val_acc = evaluate(model_to_eval, self.valid_loader, self.device, verbose=False)[1]
-			del model_to_eval
-		return fed_val_acc
+	def one_on_one_evaluate(self, federated_model, participant, filtered_grad_update, theta, is_pretrain=False):
+		return evaluate_upload(federated_model, participant, filtered_grad_update, theta, self.valid_loader, self.device, is_pretrain=is_pretrain)
 
 	def aggregate_gradients_and_update_federated_model(self, eta=1):
 		"""
@@ -454,40 +696,58 @@ class Federated_Learner:
 		eta: is used as a way to manually introduce complex learning rate or lr scheduler.Default:1
 
 		"""
-		self.aggregated_gradient_updates = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
-		self.aggregated_gradient_updates_pretrain = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
-
-		for i in self.R:
-			filtered_grad_update = self.filtered_updates[i]
-			if self.args['aggregate_mode'] == 'sum':
-				weight = 1.0
-			elif self.args['aggregate_mode'] == 'reputation-sum':
-				weight = self.reputations[i]
-			else: # default average
-				if self.args['split'] != 'classimbalance':
-					weight = self.shard_sizes[i] * 1. / sum(self.shard_sizes)
-
-				else:
-					assert self.args['dataset'] in ['mnist', 'cifar10'], "Fedavg and classimbalance Not supported for this dataset {}".format(self.args['dataset'])
-					# currently only for cifar10 and mnist, so a total of 10 classes
-					n_classes = 10
-					class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
-					weight = class_sizes[i] / n_classes
-
-			add_gradient_updates(self.aggregated_gradient_updates, filtered_grad_update, weight)
+		weights = self.aggregation_weights(self.reputations, self.R)
+		weights_pretrain = self.aggregation_weights(self.reputations_pretrain, self.R_pretrain)
+
+		if self.runtime is not None and self.runtime.collective:
+			# the uploads stay in the ranks of the participants, and are summed there, see Distributed_Runtime.aggregate
+			self.aggregated_gradient_updates, self.aggregated_gradient_updates_pretrain = self.runtime.aggregate(weights, weights_pretrain)
+		elif self.edge_aggregators is not None:
+			# the uploads stay in the edge aggregators, and the root sums their partial sums
+			self.aggregated_gradient_updates = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
+			self.aggregated_gradient_updates_pretrain = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
+			for g, edge in enumerate(self.edge_aggregators):
+				partial_sums = edge.aggregate({'cffl': weights, 'pretrain': weights_pretrain})
+				self.profiler.clock('edge aggregation', group=g)
+				add_gradient_updates(self.aggregated_gradient_updates, partial_sums['cffl'])
+				add_gradient_updates(self.aggregated_gradient_updates_pretrain, partial_sums['pretrain'])
+				del partial_sums
+				self.profiler.clock('aggregate gradients and update FL model')
+		else:
+			self.aggregated_gradient_updates = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
+			self.aggregated_gradient_updates_pretrain = [torch.zeros(param.shape).to(self.device) for param in self.federated_model.parameters()]
+			# the deferred participants have no uploads
+			for i, weight in weights.items():
+				if self.filtered_updates[i] is not None:
+					add_gradient_updates(self.aggregated_gradient_updates, self.filtered_updates[i], weight)
+			for i, weight in weights_pretrain.items():
+				if self.filtered_updates_pretrain[i] is not None:
+					add_gradient_updates(self.aggregated_gradient_updates_pretrain, self.filtered_updates_pretrain[i], weight)
 
 		add_update_to_model(self.federated_model, self.aggregated_gradient_updates, weight=eta, device=self.device)
 		# self.federated_val_acc = evaluate(self.federated_model, self.valid_loader, device=self.device, verbose=False)[1]
 
-		for i in self.R_pretrain:
-			filtered_grad_update = self.filtered_updates_pretrain[i]
+		add_update_to_model(self.federated_model_pretrain, self.aggregated_gradient_updates_pretrain, weight=eta, device=self.device)
+		# self.federated_val_acc_pretrain = evaluate(self.federated_model_pretrain, self.valid_loader, device=self.device, verbose=False)[1]
+
+	def aggregation_weights(self, reputations, R):
+		"""
+		The weight of the upload of each reputable participant in R in the aggregate, by aggregate_mode, see aggregate_gradients_and_update_federated_model.
+		With sampled participants, the weights of the participants of the round, and the mean is over their shards.
+		"""
+		weights = OrderedDict()
+		shard_sizes = self.round_shard_sizes()
+		if self.sampled_participants is not None:
+			sampled = set(self.sampled_participants)
+			R = [i for i in R if i in sampled]
+		for i in R:
 			if self.args['aggregate_mode'] == 'sum':
 				weight = 1.0
 			elif self.args['aggregate_mode'] == 'reputation-sum':
-				weight = self.reputations_pretrain[i]
-			else: # default fedavg
+				weight = reputations[i]
+			else: # default average
 				if self.args['split'] != 'classimbalance':
-					weight = self.shard_sizes[i] * 1. / sum(self.shard_sizes)
+					weight = self.shard_sizes[i] * 1. / sum(shard_sizes)
 
 				else:
 					assert self.args['dataset'] in ['mnist', 'cifar10'], "Fedavg and classimbalance Not supported for this dataset {}".format(self.args['dataset'])
@@ -495,10 +755,8 @@ class Federated_Learner:
 					n_classes = 10
 					class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
 					weight = class_sizes[i] / n_classes
-			add_gradient_updates(self.aggregated_gradient_updates_pretrain, filtered_grad_update, weight)
-
-		add_update_to_model(self.federated_model_pretrain, self.aggregated_gradient_updates_pretrain, weight=eta, device=self.device)
-		# self.federated_val_acc_pretrain = evaluate(self.federated_model_pretrain, self.valid_loader, device=self.device, verbose=False)[1]
+			weights[i] = weight
+		return weights
 
 	def assign_updates_with_filter(self):
 		"""
@@ -506,19 +764,15 @@ class Federated_Learner:
 		and filter out its own updates in the local model
 		and apply to its local model
 		"""
-		if self.args['aggregate_mode'] == 'mean':
-			if self.args['split']!='classimbalance':
-				weights = torch.div(self.shard_sizes , max(self.shard_sizes) )
-			else:
-				n_classes=10
-				class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
-				weights = torch.div(torch.tensor(class_sizes).float(), max(class_sizes) )
-		else:
-			weights = torch.ones(self.n_participants)  
+		weights = self.download_weights()
 
 		# default download mode is 'topk'
 		download = 'topk' if 'download' not in self.args else self.args['download']
 
+		# the allocation of each reputable participant by track, see allocate_download()
+		allocations = OrderedDict([('cffl', OrderedDict()), ('pretrain', OrderedDict())])
+		permuted_indices = {'cffl': None, 'pretrain': None}
+
 		if self.args['largest_criterion'] == 'all':
 
 			# preprocess to get the topk largest values for all (only need sort it once for the highest reputation)
@@ -526,95 +780,130 @@ class Federated_Learner:
 			absolute_values = torch.cat([update.data.view(-1).abs() for update in self.aggregated_gradient_updates])
 
 			if download == 'random':
-				random_permuted_indices = torch.randperm(len(absolute_values))
+				permuted_indices['cffl'] = torch.randperm(len(absolute_values))
 			else:
 				topk, _ = torch.topk(absolute_values, int(len(absolute_values))) 
 
 			# pretrain
 			absolute_values = torch.cat([update.data.view(-1).abs() for update in self.aggregated_gradient_updates_pretrain])
 			if download == 'random':
-				random_permuted_pretrain_indices = torch.randperm(len(absolute_values)) if download == 'random' else None
+				permuted_indices['pretrain'] = torch.randperm(len(absolute_values))
 			else:
 				topk_pretrain, _ = torch.topk(absolute_values, int(len(absolute_values))) 
 				del _
 
 			del absolute_values
 
-			
-			for i, participant in enumerate(self.participants):
+			mode = 'random' if download == 'random' else 'topk'
+			for i in self.round_participants():
+				participant = self.participants[i]
 
 				# no pretrain
 				if i in self.R:
-					agg_grad_update = copy.deepcopy(self.aggregated_gradient_updates)
-					if self.args['split']!='classimbalance':
-						num_downloads  = int(self.reputations[i]*1. / max(self.reputations) *self.shard_sizes[i] *1. / max(self.shard_sizes) * participant.param_count)
-					else:
-						n_classes = 10
-						class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
-						num_downloads  = int(self.reputations[i]*1. / max(self.reputations) *class_sizes[i] / n_classes * participant.param_count)
-					
-					if download == 'random':
-						assert random_permuted_indices is not None, "Uninitialized <random_permuted_indices>"
-						allocated_grad = mask_grad_update_by_indices(agg_grad_update, indices=random_permuted_indices[:num_downloads])
-					else:
-						allocated_grad = mask_grad_update_by_magnitude(agg_grad_update, topk[num_downloads-1])
-					
-					add_update_to_model(participant.model, allocated_grad)
-					add_update_to_model(participant.model, self.filtered_updates[i], weight=-weights[i])
+					num_downloads = self.download_count(i, self.reputations, participant.param_count)
+					allocations['cffl'][i] = num_downloads if download == 'random' else topk[num_downloads-1]
 					
 				# with pretrain
 				if i in self.R_pretrain:
-					agg_grad_update = copy.deepcopy(self.aggregated_gradient_updates_pretrain)
-					if self.args['split']!='classimbalance':
-						num_downloads  = int(self.reputations_pretrain[i]*1. / max(self.reputations_pretrain) *self.shard_sizes[i] *1. / max(self.shard_sizes) * participant.param_count)
-					else:
-						n_classes = 10
-						class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
-						num_downloads  = int(self.reputations_pretrain[i]*1. / max(self.reputations_pretrain) *class_sizes[i] / n_classes * participant.param_count)
-					
-					if download == 'random':
-						assert random_permuted_pretrain_indices is not None, "Uninitialized <random_permuted_pretrain_indices>"
-						allocated_grad = mask_grad_update_by_indices(agg_grad_update, indices=random_permuted_pretrain_indices[:num_downloads])
-					else:				
-						allocated_grad = mask_grad_update_by_magnitude(agg_grad_update, topk_pretrain[num_downloads-1])
-
-					add_update_to_model(participant.model_pretrain, allocated_grad)
-					add_update_to_model(participant.model_pretrain, self.filtered_updates_pretrain[i], weight=-weights[i])
+					num_downloads = self.download_count(i, self.reputations_pretrain, participant.param_count)
+					allocations['pretrain'][i] = num_downloads if download == 'random' else topk_pretrain[num_downloads-1]
 
 		elif self.args['largest_criterion'] == 'layer':
 			
-			for i, participant in enumerate(self.participants):
-				# no pretrain
+			mode = 'layer'
+			for i in self.round_participants():
 				if i in self.R:
-					allocated_grad = mask_grad_update_by_order(self.aggregated_gradient_updates, mask_order=None, mask_percentile=self.reputations[i], mode='layer')
-					add_update_to_model(participant.model, allocated_grad)
-					add_update_to_model(participant.model, self.filtered_updates[i], weight=-weights[i])
-
-				# with pretrain
+					allocations['cffl'][i] = self.reputations[i]
 				if i in self.R_pretrain:
-					allocated_grad = mask_grad_update_by_order(self.aggregated_gradient_updates_pretrain, mask_order=None, mask_percentile=self.reputations_pretrain[i], mode='layer')
-					add_update_to_model(participant.model_pretrain, allocated_grad)
-					add_update_to_model(participant.model_pretrain, self.filtered_updates_pretrain[i], weight=-weights[i])
-		return
+					allocations['pretrain'][i] = self.reputations_pretrain[i]
+
+		else:
+			return
 
-	def performance_summary(self, to_print=False):
-		self.dssgd_models_test_accs = self.evaluate_participants_performance(self.test_loader, mode='dssgd')
-		self.fedavg_models_test_accs = self.evaluate_participants_performance(self.test_loader, mode='fedavg')
-		self.participant_standalone_test_accs = self.evaluate_participants_performance(self.test_loader, mode='standalone')
-		self.cffl_test_accs = self.evaluate_participants_performance(self.test_loader)
-		self.cffl_test_accs_w_pretrain = self.evaluate_participants_performance(self.test_loader, mode='pretrain')
+		if self.runtime is not None and self.runtime.collective:
+			# the aggregates are broadcast and the allocations scattered to the ranks of the participants, see Distributed_Runtime.assign
+			self.runtime.assign(mode, OrderedDict([('cffl', self.aggregated_gradient_updates), ('pretrain', self.aggregated_gradient_updates_pretrain)]),
+				allocations, permuted_indices, weights)
+			return
 
-		# no pretrain
-		self.performance_dict['DSSGD_model_test_accs'].append(self.dssgd_models_test_accs)
-		self.performance_dict['fedavg_model_test_accs'].append(self.fedavg_models_test_accs)
-		self.performance_dict['participant_standalone_test_accs'].append(self.participant_standalone_test_accs)
-		self.performance_dict['cffl_test_accs'].append(self.cffl_test_accs)
+		if self.edge_aggregators is not None:
+			# the aggregates and the allocations are pushed down to the edge aggregators, that apply the downloads of their participants
+			aggregated_updates = {'cffl': self.aggregated_gradient_updates, 'pretrain': self.aggregated_gradient_updates_pretrain}
+			self.profiler.clock('assign updates')
+			for g, edge in enumerate(self.edge_aggregators):
+				edge.assign(mode, aggregated_updates, allocations, permuted_indices, weights)
+				self.profiler.clock('edge assignment', group=g)
+			return
 
-		# with pretrain
-		self.performance_dict_pretrain['DSSGD_model_test_accs'].append(self.dssgd_models_test_accs)
-		self.performance_dict_pretrain['fedavg_model_test_accs'].append(self.fedavg_models_test_accs)
-		self.performance_dict_pretrain['participant_standalone_test_accs'].append(self.participant_standalone_test_accs)
-		self.performance_dict_pretrain['cffl_test_accs'].append(self.cffl_test_accs_w_pretrain)
+		aggregated_updates = {'cffl': self.aggregated_gradient_updates, 'pretrain': self.aggregated_gradient_updates_pretrain}
+		filtered_updates = {'cffl': self.filtered_updates, 'pretrain': self.filtered_updates_pretrain}
+		if self.participant_arena is not None:
+			# the downloads of all the participants of a track at once, on the rows of their models
+			for track in ['cffl', 'pretrain']:
+				indices = [i for i in self.round_participants() if i in allocations[track] and filtered_updates[track][i] is not None]
+				self.participant_arena.apply_downloads([self.participants[i] for i in indices], track, aggregated_updates[track], mode,
+					[allocations[track][i] for i in indices], permuted_indices[track], [filtered_updates[track][i] for i in indices], [weights[i] for i in indices])
+			return
+
+		for i in self.round_participants():
+			participant = self.participants[i]
+			for track in ['cffl', 'pretrain']:
+				if i in allocations[track] and filtered_updates[track][i] is not None:
+					allocated_grad = allocate_download(aggregated_updates[track], mode, allocations[track][i], permuted_indices[track])
+					participant.apply_download(track, allocated_grad, filtered_updates[track][i], weights[i])
+		return
+
+	def download_weights(self):
+		"""
+		The weight of its own upload that each participant takes off its download, see Participant.apply_download.
+		"""
+		if self.args['aggregate_mode'] == 'mean':
+			if self.args['split']!='classimbalance':
+				return torch.div(self.shard_sizes , max(self.shard_sizes) )
+			else:
+				n_classes=10
+				class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
+				return torch.div(torch.tensor(class_sizes).float(), max(class_sizes) )
+		return torch.ones(self.n_participants)
+
+	def download_count(self, i, reputations, param_count):
+		"""
+		The number of values of the aggregate downloaded by the reputable participant i, by its reputation and shard size.
+		"""
+		if self.args['split']!='classimbalance':
+			return int(reputations[i]*1. / reputations.max() *self.shard_sizes[i] *1. / self.shard_sizes.max() * param_count)
+		n_classes = 10
+		class_sizes = np.linspace(1, n_classes, self.n_participants, dtype='int')
+		return int(reputations[i]*1. / reputations.max() *class_sizes[i] / n_classes * param_count)
+
+	def performance_summary(self, to_print=False, test_accs=None):
+		if test_accs is None and self.sampled_participants is not None and len(self.metrics.get('test_accs', 'cffl')) > 0:
+			# the models of the participants absent from the round are the same as in the last round
+			test_accs = {mode: self.metrics.last('test_accs', mode) for mode in EVALUATION_MODES}
+			for mode, model_name in EVALUATION_MODES.items():
+				for i in self.sampled_participants:
+					test_accs[mode][i] = self.participants[i].evaluate(model_name, self.test_loader)
+		elif test_accs is None and self.participant_store is not None:
+			# each participant is materialized once for all its models
+			test_accs = {mode: [] for mode in EVALUATION_MODES}
+			for participant in self.participants:
+				for mode, model_name in EVALUATION_MODES.items():
+					test_accs[mode].append(participant.evaluate(model_name, self.test_loader))
+		elif test_accs is None:
+			test_accs = {mode: self.evaluate_participants_performance(self.test_loader, mode=mode) for mode in EVALUATION_MODES}
+
+		self.dssgd_models_test_accs = test_accs['dssgd']
+		self.fedavg_models_test_accs = test_accs['fedavg']
+		self.participant_standalone_test_accs = test_accs['standalone']
+		self.cffl_test_accs = test_accs['cffl']
+		self.cffl_test_accs_w_pretrain = test_accs['pretrain']
+
+		# the dssgd, fedavg and standalone models are the same with or without pretrain
+		self.metrics.append('test_accs', 'dssgd', self.dssgd_models_test_accs)
+		self.metrics.append('test_accs', 'fedavg', self.fedavg_models_test_accs)
+		self.metrics.append('test_accs', 'standalone', self.participant_standalone_test_accs)
+		self.metrics.append('test_accs', 'cffl', self.cffl_test_accs)
+		self.metrics.append('test_accs', 'pretrain', self.cffl_test_accs_w_pretrain)
 
 		if to_print:
 			print('Below are testset  accuracies: ---')
@@ -657,10 +946,10 @@ class Federated_Learner:
 
 
 		# no pretrain
-		participant_standalone_test_accs = self.performance_dict['participant_standalone_test_accs'][-1]
-		DSSGD_model_test_accs = self.performance_dict['DSSGD_model_test_accs'][-1]
-		fedavg_model_test_accs = self.performance_dict['fedavg_model_test_accs'][-1]
-		cffl_test_accs = self.performance_dict['cffl_test_accs'][-1]
+		participant_standalone_test_accs = self.metrics.last('test_accs', 'standalone')
+		DSSGD_model_test_accs = self.metrics.last('test_accs', 'dssgd')
+		fedavg_model_test_accs = self.metrics.last('test_accs', 'fedavg')
+		cffl_test_accs = self.metrics.last('test_accs', 'cffl')
 
 		from scipy.stats import pearsonr
 		corrs = pearsonr(participant_standalone_test_accs, DSSGD_model_test_accs)
@@ -679,10 +968,7 @@ class Federated_Learner:
 		self.performance_dict['rr_fedavg_best'] = fedavg_model_test_accs[best_participant_id]
 
 		# with pretrain
-		participant_standalone_test_accs = self.performance_dict_pretrain['participant_standalone_test_accs'][-1]
-		DSSGD_model_test_accs = self.performance_dict_pretrain['DSSGD_model_test_accs'][-1]
-		fedavg_model_test_accs = self.performance_dict_pretrain['fedavg_model_test_accs'][-1]
-		cffl_test_accs = self.performance_dict_pretrain['cffl_test_accs'][-1]
+		cffl_test_accs = self.metrics.last('test_accs', 'pretrain')
 
 		corrs = pearsonr(participant_standalone_test_accs, DSSGD_model_test_accs)
 		self.performance_dict_pretrain['standalone_vs_rrdssgd'].append(corrs[0])
@@ -716,32 +1002,31 @@ class Federated_Learner:
 		return
 
 	def evaluate_participants_performance(self, eval_loader, mode=None):
-		device = self.args['device']
-		if mode == 'standalone':
-			return [evaluate(participant.standalone_model, eval_loader, device, verbose=False)[1] for participant in self.participants]
-		elif mode == 'dssgd':
-			return [evaluate(participant.dssgd_model, eval_loader, device, verbose=False)[1] for participant in self.participants]
-		elif mode == 'pretrain':
-			return [evaluate(participant.model_pretrain, eval_loader, device, verbose=False)[1] for participant in self.participants]
-		elif mode == 'fedavg':
-			return [evaluate(participant.fedavg_model, eval_loader, device, verbose=False)[1] for participant in self.participants]
-		else:
-			return [evaluate(participant.model, eval_loader, device, verbose=False)[1] for participant in self.participants]
-	def clock(self, key):
-		self.timestamp_  = time.time()
-		self.time_dict[key] += self.timestamp_ - self.timestamp
-		self.timestamp = self.timestamp_
+		model_name = EVALUATION_MODES.get(mode, 'model')
+		if self.runtime is not None and self.runtime.collective:
+			# the participants of all the ranks are evaluated at once
+			return self.runtime.evaluate_participants(model_name, eval_loader)
+		return [participant.evaluate(model_name, eval_loader) for participant in self.participants]
 
+	def evaluation_models(self):
+		"""
+		The participant models evaluated on the test set every round, by evaluation mode.
+		"""
+		assert self.runtime is None, "The participant models are in the workers of the runtime, evaluate them with evaluate_participants_performance()."
+		assert self.participant_store is None, "The participant models are materialized one at a time by the participant store, evaluate them with evaluate_participants_performance()."
+		return {mode: [getattr(participant, model_name) for participant in self.participants] for mode, model_name in EVALUATION_MODES.items()}
 
 	def update_reputations(self, participant_val_accs, participant_val_accs_pretrain):
 		self.reputations, self.reputation_threshold, self.R  = compute_reputations_sinh(self.reputations, self.reputation_threshold, self.R, participant_val_accs, alpha=self.args['alpha'], split=self.args['split'], reputation_threshold_coef=self.reputation_threshold_coef)
 		self.reputations_pretrain, self.reputation_threshold_pretrain, self.R_pretrain = compute_reputations_sinh(self.reputations_pretrain, self.reputation_threshold_pretrain, self.R_pretrain, participant_val_accs_pretrain, alpha=self.args['alpha'],split=self.args['split'],reputation_threshold_coef=self.reputation_threshold_coef)
 
 
-def compute_reputations_sinh(reputations, reputation_threshold, R, val_accs, alpha=5, reputation_fade=1, split='powerlaw', reputation_threshold_coef=1.0/3.0):
+def compute_reputations_sinh(reputations, reputation_threshold, R, val_accs, alpha=5, reputation_fade=1, split='powerlaw', reputation_threshold_coef=1.0/3.0, total_val_accs=None):
 	# print('alpha used is :', alpha, ' current reputations are : ', reputations, ' current threshold: ', reputation_threshold)
+	# total_val_accs: the sum of the validation accuracies of R if already summed, e.g. by the edge aggregators, see Edge_Aggregator
 	R_size = len(R)
-	total_val_accs = sum([val_accs[i] for i in R])
+	if total_val_accs is None:
+		total_val_accs = sum([val_accs[i] for i in R])
 	for i in R:
 		reputation_epoch = val_accs[i] / total_val_accs
 
@@ -775,6 +1060,74 @@ def compute_reputations_sinh(reputations, reputation_threshold, R, val_accs, alp
 
 	return reputations, reputation_threshold, R
 
+def compute_reputations_partial(raw_reputations, reputations, reputation_threshold, R, updated, val_accs, alpha=5, reputation_fade=1, split='powerlaw', reputation_threshold_coef=1.0/3.0, total_val_accs=None):
+	"""
+	compute_reputations_sinh for the uploads of the <updated> participants alone, e.g. the sampled participants of a round or an arrival at Async_Server:
+	their validation accuracies, relative to the latest ones of R, are faded into their reputations, and the reputations are the normalized sinh of
+	the faded values <raw_reputations> of R, the others' from their last update. With all of R updated, it is the same as compute_reputations_sinh.
+	Returns the faded values too, for the next updates.
+	total_val_accs: as in compute_reputations_sinh.
+	"""
+	updated = [i for i in updated if i in R]
+	if not updated:
+		return raw_reputations, reputations, reputation_threshold, R
+
+	R_size = len(R)
+	if total_val_accs is None:
+		total_val_accs = sum([val_accs[i] for i in R])
+	raw_reputations = raw_reputations.clone()
+	for i in updated:
+		reputation_epoch = val_accs[i] / total_val_accs
+
+		if reputation_fade == 1:
+			raw_reputations[i] = reputations[i] * 0.8 + reputation_epoch * 0.2
+		else:
+			raw_reputations[i] = (reputations[i] + reputation_epoch) * 0.5
+
+	reputations = torch.zeros(len(raw_reputations))
+	reputations[R] = torch.sinh(alpha * raw_reputations[R])
+
+	# normalize among the reputable participants
+	reputations /= reputations.sum().float()
+
+	# update reputable participants, and isolate the non-reputable participants by setting their reputations to 0
+	R = [i for i in R if reputations[i] >= reputation_threshold]
+	reputations[reputations < reputation_threshold] = 0
+
+	if R_size != len(R):
+		reputations /= reputations.sum().float()
+		reputation_threshold = compute_reputation_threshold(len(R), split, reputation_threshold_coef)
+
+	return raw_reputations, reputations, reputation_threshold, R
+
+def make_async_server(learner):
+	# imported here, as Async_Server uses the functions of this module
+	from utils.Async_Server import Async_Server
+	return Async_Server(learner)
+
+def make_edge_aggregators(learner):
+	# imported here, as Edge_Aggregator uses the functions of this module
+	from utils.Edge_Aggregator import Edge_Aggregator, split_groups
+	return [Edge_Aggregator(learner, indices) for indices in split_groups(learner.n_participants, learner.args['edge_groups'])]
+
+def make_participant_arena(participants):
+	# imported here, as Participant_Arena uses the functions of this module
+	from utils.Participant_Arena import Participant_Arena
+	return Participant_Arena(participants)
+
+def evaluate_upload(federated_model, participant, filtered_grad_update, theta, eval_loader, device, is_pretrain=False):
+	"""
+	The accuracy of the <federated_model> with the upload of the participant applied, or of the participant's own model if it uploads all of its update.
+	"""
+	if theta == 1 and not is_pretrain:
+		fed_val_acc = participant.evaluate('model', eval_loader)
+	else:
+		model_to_eval = copy.deepcopy(federated_model)
+		add_update_to_model(model_to_eval, filtered_grad_update, device=device)
+		fed_val_acc = evaluate(model_to_eval, eval_loader, device, verbose=False)[1]
+		del model_to_eval
+	return fed_val_acc
+
 def clip_gradient_update(grad_update, grad_clip):
 	"""
 	Return a copy of clipped grad update 
@@ -813,6 +1166,20 @@ def mask_grad_update_by_order(grad_update, mask_order, mask_percentile=None, mod
 				grad_update[i].data[layer.data.abs() < topk[-1]] = 0
 		return grad_update
 
+def allocate_download(aggregated_update, mode, allocation, permuted_indices=None):
+	"""
+	The update allocated to a participant from the <aggregated_update>, see Federated_Learner.assign_updates_with_filter:
+	'topk': allocation is the magnitude threshold of the values allocated
+	'random': allocation is the number of values allocated, the first of the <permuted_indices>
+	'layer': allocation is the fraction of the largest values allocated in each layer
+	"""
+	if mode == 'random':
+		assert permuted_indices is not None, "Uninitialized <permuted_indices>"
+		return mask_grad_update_by_indices(aggregated_update, indices=permuted_indices[:allocation])
+	elif mode == 'topk':
+		return mask_grad_update_by_magnitude(aggregated_update, allocation)
+	return mask_grad_update_by_order(aggregated_update, mask_order=None, mask_percentile=allocation, mode='layer')
+
 def mask_grad_update_by_magnitude(grad_update, mask_constant):
 
 	# mask all but the updates with larger magnitude than <mask_constant> to zero
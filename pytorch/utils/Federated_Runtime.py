@@ -0,0 +1,561 @@
+import io
+import os
+import sys
+import time
+import pickle
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import traceback
+import subprocess
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import torch
+
+from utils.Participant import PARTICIPANT_ARGS, make_participant, make_freerider
+from utils.Profiler import Profiler
+from utils.utils import get_rng_state, set_rng_state
+
+
+TRANSPORTS = ['loopback', 'unix', 'tcp']
+
+# the calls that use the random numbers, so the random state is passed to the participant with the call and back
+# (evaluate too, each pass over a DataLoader draws its base seed)
+RANDOM_METHODS = ['train', 'local_updates', 'evaluate']
+
+# the uploads a participant keeps until its download, see Participant.apply_download
+KEPT_UPLOADS = ['cffl', 'pretrain']
+
+# seconds to wait for the spawned workers to connect
+CONNECT_TIMEOUT = 300
+
+# the dtypes of the tensor frames, by code
+DTYPES = [torch.float32, torch.float64, torch.float16, torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]
+DTYPE_CODES = {dtype: code for code, dtype in enumerate(DTYPES)}
+DENSE, SPARSE = 0, 1
+
+# dtype code, encoding, number of dimensions
+FRAME_HEADER = struct.Struct('<BBB')
+# the length of the pickled message and the number of tensor frames after it
+MESSAGE_HEADER = struct.Struct('<QQ')
+LENGTH = struct.Struct('<Q')
+
+PYTORCH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_numpy_dtype(dtype):
+	return torch.zeros(0, dtype=dtype).numpy().dtype
+
+
+def get_index_dtype(numel):
+	return np.dtype(np.int32) if numel < 2 ** 31 else np.dtype(np.int64)
+
+
+def encode_tensor(tensor):
+	"""
+	The frame of a tensor: its dtype, encoding and shape, then either all of the values (dense), or the flat indices and
+	the values of the nonzero ones (sparse), whichever is smaller, e.g. sparse for the updates masked to a theta fraction.
+	The values are the bytes of the tensor, so the decoded tensor is exactly the same.
+	"""
+	assert tensor.dtype in DTYPE_CODES, "The tensors of dtype {} cannot be framed.".format(tensor.dtype)
+	array = tensor.detach().cpu().contiguous().numpy().reshape(-1)
+	header = FRAME_HEADER.pack(DTYPE_CODES[tensor.dtype], DENSE, tensor.dim()) + struct.pack('<{}q'.format(tensor.dim()), *tensor.shape)
+
+	# nonzero by the bits, so that -0. is kept
+	nonzero = np.flatnonzero(array.view('u{}'.format(array.itemsize)))
+	index_dtype = get_index_dtype(array.size)
+	if len(nonzero) * (index_dtype.itemsize + array.itemsize) < array.nbytes:
+		header = FRAME_HEADER.pack(DTYPE_CODES[tensor.dtype], SPARSE, tensor.dim()) + header[FRAME_HEADER.size:]
+		return [header, LENGTH.pack(len(nonzero)), nonzero.astype(index_dtype).tobytes(), array[nonzero].tobytes()]
+	return [header, memoryview(array).cast('B')]
+
+
+def decode_tensor(buffer, offset):
+	# the tensor of the frame at <offset> of the buffer, and the offset after the frame
+	code, encoding, ndim = FRAME_HEADER.unpack_from(buffer, offset)
+	offset += FRAME_HEADER.size
+	shape = struct.unpack_from('<{}q'.format(ndim), buffer, offset)
+	offset += 8 * ndim
+	dtype = get_numpy_dtype(DTYPES[code])
+	numel = int(np.prod(shape))
+	if encoding == SPARSE:
+		nnz, = LENGTH.unpack_from(buffer, offset)
+		offset += LENGTH.size
+		index_dtype = get_index_dtype(numel)
+		indices = np.frombuffer(buffer, index_dtype, nnz, offset)
+		offset += nnz * index_dtype.itemsize
+		array = np.zeros(numel, dtype)
+		array[indices] = np.frombuffer(buffer, dtype, nnz, offset)
+		offset += nnz * dtype.itemsize
+	else:
+		array = np.frombuffer(buffer, dtype, numel, offset)
+		offset += numel * dtype.itemsize
+	return torch.from_numpy(array).reshape(shape), offset
+
+
+class Tensor_Pickler(pickle.Pickler):
+	# the tensors are not pickled but framed after the message, see encode_tensor
+	def __init__(self, file, frames):
+		super(Tensor_Pickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+		self.frames = frames
+		self.frame_ids = {}
+
+	def persistent_id(self, obj):
+		# the parameters are pickled as parameters, with their data framed
+		if type(obj) is not torch.Tensor:
+			return None
+		if id(obj) not in self.frame_ids:
+			self.frame_ids[id(obj)] = len(self.frames)
+			self.frames.append(obj)
+		return (self.frame_ids[id(obj)], str(obj.device))
+
+
+class Tensor_Unpickler(pickle.Unpickler):
+	def __init__(self, file, tensors):
+		super(Tensor_Unpickler, self).__init__(file)
+		self.tensors = tensors
+		self.loaded = {}
+
+	def persistent_load(self, pid):
+		index, device = pid
+		if index not in self.loaded:
+			self.loaded[index] = self.tensors[index].to(device)
+		return self.loaded[index]
+
+
+def encode_message(message):
+	"""
+	The buffers of a message: the header, the message pickled without its tensors, and the frames of the tensors.
+	"""
+	frames = []
+	file = io.BytesIO()
+	Tensor_Pickler(file, frames).dump(message)
+	pickled = file.getvalue()
+	buffers = [MESSAGE_HEADER.pack(len(pickled), len(frames)), pickled]
+	for tensor in frames:
+		buffers.extend(encode_tensor(tensor))
+	return buffers
+
+
+def decode_message(buffer):
+	pickled_length, n_frames = MESSAGE_HEADER.unpack_from(buffer, 0)
+	offset = MESSAGE_HEADER.size + pickled_length
+	tensors = []
+	for _ in range(n_frames):
+		tensor, offset = decode_tensor(buffer, offset)
+		tensors.append(tensor)
+	pickled = io.BytesIO(memoryview(buffer)[MESSAGE_HEADER.size:MESSAGE_HEADER.size + pickled_length])
+	return Tensor_Unpickler(pickled, tensors).load()
+
+
+def join_buffers(buffers):
+	# one writable buffer, so that the decoded tensors can be used in place
+	return bytearray(b''.join(buffers))
+
+
+def parse_address(address):
+	# 'unix://<path>' or 'tcp://<host>:<port>'
+	if address.startswith('unix://'):
+		return socket.AF_UNIX, address[len('unix://'):]
+	host, port = address.replace('tcp://', '').rsplit(':', 1)
+	return socket.AF_INET, (host, int(port))
+
+
+def format_address(family, address):
+	if family == socket.AF_UNIX:
+		return 'unix://' + address
+	return 'tcp://{}:{}'.format(*address)
+
+
+class Socket_Connection():
+	"""
+	The messages over a socket, each sent as its length followed by its buffers, see encode_message.
+	"""
+
+	def __init__(self, sock):
+		self.sock = sock
+		if sock.family == socket.AF_INET:
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.reset()
+
+	def reset(self):
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.serialization_seconds = 0.
+		# the serialization seconds of the other end, as last reported by it
+		self.peer_serialization_seconds = 0.
+
+	def send(self, message):
+		start = time.time()
+		data = join_buffers(encode_message(message))
+		self.serialization_seconds += time.time() - start
+		self.sock.sendall(LENGTH.pack(len(data)))
+		self.sock.sendall(data)
+		self.bytes_sent += LENGTH.size + len(data)
+
+	def recv_into(self, buffer):
+		view = memoryview(buffer)
+		while len(view):
+			n_bytes = self.sock.recv_into(view)
+			if n_bytes == 0:
+				raise EOFError("The connection is closed.")
+			view = view[n_bytes:]
+
+	def recv(self):
+		header = bytearray(LENGTH.size)
+		self.recv_into(header)
+		data = bytearray(LENGTH.unpack(header)[0])
+		self.recv_into(data)
+		self.bytes_received += LENGTH.size + len(data)
+		start = time.time()
+		message = decode_message(data)
+		self.serialization_seconds += time.time() - start
+		return message
+
+	def request(self, message):
+		self.send(message)
+		reply = self.recv()
+		self.peer_serialization_seconds = reply['serialization seconds']
+		return reply
+
+	def close(self):
+		try:
+			self.send({'method': 'close'})
+		except (OSError, EOFError):
+			pass
+		self.sock.close()
+
+
+class Loopback_Connection():
+	"""
+	The stand-in transport: the messages are encoded and decoded as over a socket, but handled by a worker in this process,
+	i.e., the serialization without the transfer.
+	"""
+
+	def __init__(self, worker):
+		self.worker = worker
+		self.reset()
+
+	def reset(self):
+		self.bytes_sent = 0
+		self.bytes_received = 0
+		self.serialization_seconds = 0.
+		self.peer_serialization_seconds = 0.
+
+	def transfer(self, message):
+		start = time.time()
+		data = join_buffers(encode_message(message))
+		message = decode_message(data)
+		self.serialization_seconds += time.time() - start
+		return message, LENGTH.size + len(data)
+
+	def request(self, message):
+		message, n_bytes = self.transfer(message)
+		self.bytes_sent += n_bytes
+		reply, n_bytes = self.transfer(self.worker.handle(message))
+		self.bytes_received += n_bytes
+		return reply
+
+	def close(self):
+		pass
+
+
+class Participant_Worker():
+	"""
+	The participants hosted by a worker, and the calls of the server to them, see Remote_Participant.
+
+	The participants are created from the setup() call, as the server would create them, see make_participant(),
+	and a participant that is several participants of the server (the free riders) is one participant here too.
+	The uploads of a participant that are needed for its download are kept here, so that they are not sent back.
+	"""
+
+	def __init__(self):
+		self.participants = {}
+		self.loaders = {}
+		self.uploads = {}
+
+	def setup(self, args, federated_model, groups, loaders, threads, cudnn_deterministic, cudnn_benchmark):
+		# the same number of threads and cudnn settings as the server, for the same results
+		torch.set_num_threads(threads)
+		torch.backends.cudnn.deterministic = cudnn_deterministic
+		torch.backends.cudnn.benchmark = cudnn_benchmark
+		self.loaders = loaders
+		for indices, train_loader, participant_id, is_free_rider in groups:
+			if is_free_rider:
+				participant = make_freerider(args, federated_model)
+			else:
+				participant = make_participant(args, federated_model, train_loader, id=participant_id)
+			for index in indices:
+				self.participants[index] = participant
+
+	def handle(self, message):
+		start = time.time()
+		try:
+			if message['rng_state'] is not None:
+				set_rng_state(message['rng_state'])
+			kwargs = dict(message['kwargs'])
+			totals = None
+			if message.get('profile', False):
+				totals = defaultdict(float)
+				kwargs['profiler'] = Profiler(totals)
+			if 'eval_loader' in kwargs:
+				kwargs['eval_loader'] = self.loaders[kwargs['eval_loader']]
+			if message.get('index', None) is None:
+				# the calls to the worker itself, e.g. the setup
+				result = getattr(self, message['method'])(**kwargs)
+			else:
+				index = message['index']
+				if message['method'] == 'apply_download':
+					kwargs['own_update'] = self.uploads[index][kwargs['track']]
+				result = getattr(self.participants[index], message['method'])(*message['args'], **kwargs)
+				if message['method'] == 'local_updates' and result is not None:
+					self.uploads[index] = {track: result[track] for track in KEPT_UPLOADS}
+		except Exception:
+			return {'error': traceback.format_exc(), 'seconds': time.time() - start}
+		return {'result': result, 'totals': dict(totals) if totals is not None else None,
+			'rng_state': get_rng_state() if message['rng_state'] is not None else None, 'seconds': time.time() - start}
+
+
+def serve(address):
+	"""
+	Run a worker process: connect to the server at <address> and handle its calls until it closes the connection.
+	"""
+	family, sock_address = parse_address(address)
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.connect(sock_address)
+	connection = Socket_Connection(sock)
+	worker = Participant_Worker()
+	while True:
+		try:
+			message = connection.recv()
+		except EOFError:
+			break
+		if message['method'] == 'close':
+			break
+		reply = worker.handle(message)
+		if message['method'] == 'setup':
+			# the setup is accounted separately, see Federated_Runtime.start
+			connection.serialization_seconds = 0.
+		reply['serialization seconds'] = connection.serialization_seconds
+		connection.send(reply)
+	sock.close()
+
+
+class Remote_Participant():
+	"""
+	A participant of the server, hosted by a worker: the calls of the learner are sent to the worker, see Participant for the calls.
+	"""
+
+	def __init__(self, runtime, connection, index, id, is_free_rider, theta, param_count):
+		self.runtime = runtime
+		self.connection = connection
+		self.index = index
+		self.id = id
+		self.is_free_rider = is_free_rider
+		self.theta = theta
+		self.param_count = param_count
+
+	def call(self, method, *args, **kwargs):
+		profiler = kwargs.pop('profiler', None)
+		message = {'index': self.index, 'method': method, 'args': args, 'kwargs': kwargs, 'profile': profiler is not None,
+			'rng_state': get_rng_state() if method in RANDOM_METHODS else None}
+		reply = self.runtime.request(self.connection, message)
+		if reply['rng_state'] is not None:
+			set_rng_state(reply['rng_state'])
+		if profiler is not None:
+			# the phases of the participant, as if clocked here
+			for key, seconds in reply['totals'].items():
+				profiler.add(key, seconds)
+		return reply['result']
+
+	def train(self, epochs, is_pretrain=False, save_gpu=False):
+		return self.call('train', epochs, is_pretrain=is_pretrain, save_gpu=save_gpu)
+
+	def local_updates(self, epochs, grad_clip, largest_criterion, save_gpu=False, profiler=None, budget=None, defer_late=False):
+		return self.call('local_updates', epochs, grad_clip, largest_criterion, save_gpu=save_gpu, profiler=profiler, budget=budget, defer_late=defer_late)
+
+	def download_model(self, track, state_dict):
+		return self.call('download_model', track=track, state_dict=state_dict)
+
+	def apply_download(self, track, allocated_grad, own_update, weight):
+		# the participant kept its own upload, see Participant_Worker
+		return self.call('apply_download', track=track, allocated_grad=allocated_grad, weight=weight)
+
+	def evaluate(self, name, eval_loader):
+		return self.call('evaluate', name, eval_loader=self.runtime.loader_names[id(eval_loader)])
+
+	def state_dict(self):
+		return self.call('state_dict')
+
+	def load_state_dict(self, state):
+		return self.call('load_state_dict', state)
+
+
+class Federated_Runtime():
+	"""
+	Runs the participants of a learner in worker processes: the learner is the server (the aggregation, reputations and
+	the allocation of the downloads), and the participants train locally and compute their uploads in the workers.
+
+	args['runtime']: the transport between the server and the workers,
+		'unix' or 'tcp': local sockets, or TCP to run the workers on other machines
+		'loopback': the stand-in transport, the messages are serialized as over the sockets but handled in this process
+	args['runtime_workers']: the number of worker processes, the participants are split among them. Default: 1
+	args['runtime_address']: the address to listen on, a path for 'unix', <host>:<port> for 'tcp'. Default: a temporary path, or 127.0.0.1 on any port
+	args['runtime_spawn']: True to start the workers here, False to wait for them to be started with
+		python -m utils.Federated_Runtime --connect <address>
+		e.g. on other machines, from the pytorch directory. Default: True
+
+	The messages are pickled, with their tensors framed as raw bytes, and the sparse tensors (e.g. the uploads and the allocated
+	downloads) as the indices and values of their nonzero entries, see encode_tensor.
+	The participants are called in the same order as in the single process, with the random state passed along with the calls
+	that use it, so the results are exactly the same as in the single process.
+	The time of the communication (i.e., each call less its handling in the worker) is added to the time_dict under 'communication',
+	and excluded from the phases, and the phases of the local training are clocked in the workers, see summary() for the bytes transferred.
+	"""
+
+	transports = TRANSPORTS
+	# whether the learner leaves the phases of the round to the runtime, see Distributed_Runtime
+	collective = False
+
+	def __init__(self, args, profiler):
+		self.transport = args['runtime']
+		assert self.transport in self.transports, "Unknown runtime {}, only {} are available.".format(self.transport, self.transports)
+		self.n_workers = args.get('runtime_workers', 1)
+		self.address = args.get('runtime_address', None)
+		self.spawn = args.get('runtime_spawn', True)
+		self.args = args
+		self.profiler = profiler
+		self.connections = []
+		self.processes = []
+		self.socket_dir = None
+		self.messages = 0
+		self.communication_seconds = 0.
+
+	def start(self, federated_model, train_loaders, n_freeriders, loaders):
+		"""
+		Create the participants of the learner in the workers: the <n_freeriders> free riders (one participant for all of them),
+		then a participant per train loader, and return the Remote_Participants in their place, in the same order.
+		loaders: the evaluation loaders by name, e.g. {'valid': valid_loader, 'test': test_loader}
+		"""
+		# the participants of a worker: (indices, train_loader, id, is_free_rider)
+		groups = [(list(range(n_freeriders)), None, None, True)] if n_freeriders > 0 else []
+		groups += [([n_freeriders + i], train_loader, i, False) for i, train_loader in enumerate(train_loaders)]
+		self.n_participants = n_freeriders + len(train_loaders)
+
+		self.loader_names = {id(loader): name for name, loader in loaders.items()}
+		self.connections = self.connect(min(self.n_workers, len(groups)))
+		args = {key: self.args[key] for key in PARTICIPANT_ARGS if key in self.args}
+		param_count = sum([p.numel() for p in federated_model.parameters()])
+
+		start = time.time()
+		remote_participants = [None] * self.n_participants
+		# the indices of the participants of each worker
+		self.worker_indices = []
+		for connection, worker_groups in zip(self.connections, np.array_split(np.arange(len(groups)), len(self.connections))):
+			setup = [groups[g] for g in worker_groups]
+			self.request(connection, {'method': 'setup', 'rng_state': None, 'kwargs': {'args': args, 'federated_model': federated_model,
+				'groups': setup, 'loaders': loaders, 'threads': torch.get_num_threads(),
+				'cudnn_deterministic': torch.backends.cudnn.deterministic, 'cudnn_benchmark': torch.backends.cudnn.benchmark}})
+			self.worker_indices.append([index for indices, _, _, _ in setup for index in indices])
+			for indices, _, participant_id, is_free_rider in setup:
+				for index in indices:
+					remote_participants[index] = Remote_Participant(self, connection, index, participant_id, is_free_rider, self.args['theta'], param_count)
+
+		# the setup, e.g. sending the datasets and starting the workers, is not part of the communication of the rounds
+		self.setup_seconds = time.time() - start
+		self.setup_bytes = sum(connection.bytes_sent + connection.bytes_received for connection in self.connections)
+		for connection in self.connections:
+			connection.reset()
+		return remote_participants
+
+	def connect(self, n_workers):
+		if self.transport == 'loopback':
+			return [Loopback_Connection(Participant_Worker()) for _ in range(n_workers)]
+
+		if self.transport == 'unix':
+			family = socket.AF_UNIX
+			if self.address is None:
+				self.socket_dir = tempfile.mkdtemp()
+			address = self.address or os.path.join(self.socket_dir, 'runtime.sock')
+		else:
+			family, address = parse_address(self.address or '127.0.0.1:0')
+		listener = socket.socket(family, socket.SOCK_STREAM)
+		listener.bind(address)
+		listener.listen(n_workers)
+		address = format_address(family, listener.getsockname())
+
+		if self.spawn:
+			listener.settimeout(CONNECT_TIMEOUT)
+			for _ in range(n_workers):
+				self.processes.append(subprocess.Popen([sys.executable, '-m', 'utils.Federated_Runtime', '--connect', address], cwd=PYTORCH_DIR))
+		else:
+			print("Waiting for {} participant workers: python -m utils.Federated_Runtime --connect {}".format(n_workers, address))
+
+		connections = []
+		for _ in range(n_workers):
+			sock, _ = listener.accept()
+			sock.settimeout(None)
+			connections.append(Socket_Connection(sock))
+		listener.close()
+		return connections
+
+	def request(self, connection, message):
+		start = time.time()
+		reply = connection.request(message)
+		communication = time.time() - start - reply['seconds']
+		if message['method'] != 'setup':
+			self.messages += 1
+			self.communication_seconds += communication
+			self.profiler.add('communication', communication)
+		if 'error' in reply:
+			raise RuntimeError("The call {} failed in the participant worker:\n{}".format(message['method'], reply['error']))
+		return reply
+
+	def summary(self):
+		"""
+		The setup of the workers, and the messages and bytes exchanged with them since, and the seconds of the communication,
+		of which the serialization (of both ends).
+		"""
+		serialization_seconds = sum(connection.serialization_seconds + connection.peer_serialization_seconds for connection in self.connections)
+		return OrderedDict([('transport', self.transport), ('workers', len(self.connections)),
+			('setup seconds', round(self.setup_seconds, 3)), ('setup MB', round(self.setup_bytes / 1024 / 1024, 3)), ('messages', self.messages),
+			('MB to participants', round(sum(connection.bytes_sent for connection in self.connections) / 1024 / 1024, 3)),
+			('MB from participants', round(sum(connection.bytes_received for connection in self.connections) / 1024 / 1024, 3)),
+			('communication seconds', round(self.communication_seconds, 3)),
+			('serialization seconds', round(serialization_seconds, 3))])
+
+	def close(self):
+		for connection in self.connections:
+			connection.close()
+		for process in self.processes:
+			process.wait()
+		self.processes = []
+		if self.socket_dir is not None:
+			shutil.rmtree(self.socket_dir, ignore_errors=True)
+			self.socket_dir = None
+
+
+def make_runtime(args, profiler):
+	"""
+	The runtime of args['runtime']: 'gloo' for Distributed_Runtime, or a transport of Federated_Runtime.
+	"""
+	if args['runtime'] == 'gloo':
+		# torch.distributed is only imported for the gloo runtime
+		from utils.Distributed_Runtime import Distributed_Runtime
+		return Distributed_Runtime(args, profiler)
+	return Federated_Runtime(args, profiler)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='A participant worker of the federated runtime, see Federated_Runtime.')
+	parser.add_argument('--connect', required=True, help='the address of the server, unix://<path> or tcp://<host>:<port>')
+	args = parser.parse_args(argv)
+	serve(args.connect)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
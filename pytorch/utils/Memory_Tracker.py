@@ -0,0 +1,176 @@
+import json
+import resource
+from collections import OrderedDict, defaultdict
+
+import torch
+from torch import nn
+
+
+# the phases of the learner and the time_dict keys clocked in each phase
+PHASES = OrderedDict([
+	('pretraining', ['pretraining']),
+	('local training', ['participants local training']),
+	('filtering', ['gradient clipping and filtering', 'gradient clipping and filtering for pretrain', 'reputation updates']),
+	('aggregation', ['server aggregation dssgd', 'server aggregation fedavg', 'edge aggregation', 'aggregate gradients and update FL model']),
+	('assignment', ['assign updates', 'edge assignment']),
+	('evaluation', ['evaluation after pretraining', 'performance update']),
+])
+PHASE_OF_KEY = {key: phase for phase, keys in PHASES.items() for key in keys}
+
+# the live tensors are accounted at the end of these (round level) time_dict keys, for the phases that end there:
+# the local training and filtering of the participants are interleaved, so they are accounted together after the last participant
+ACCOUNTED_KEYS = {
+	'pretraining': ['pretraining'],
+	'reputation updates': ['local training', 'filtering'],
+	'aggregate gradients and update FL model': ['aggregation'],
+	'assign updates': ['assignment'],
+	'performance update': ['evaluation'],
+}
+
+MB = 1024 * 1024
+
+
+def read_status():
+	# the current and peak resident set size of the process in bytes, from /proc (Linux)
+	with open('/proc/self/status') as file:
+		status = dict(line.split(':', 1) for line in file if ':' in line)
+	return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+
+
+def reset_peak_rss():
+	# resets VmHWM to the current RSS, Linux 4.0+
+	try:
+		with open('/proc/self/clear_refs', 'w') as file:
+			file.write('5')
+		return True
+	except (IOError, OSError):
+		return False
+
+
+def get_storage(tensor):
+	# the address and size of the memory of a tensor, shared by its views
+	if hasattr(tensor, 'untyped_storage'):
+		storage = tensor.untyped_storage()
+		return (tensor.device, storage.data_ptr()), storage.nbytes()
+	storage = tensor.storage()
+	return (tensor.device, storage.data_ptr()), storage.size() * storage.element_size()
+
+
+def collect_tensors(obj, tensors, seen, depth=4):
+	"""
+	Append the tensors held by <obj> to <tensors>: in modules, optimizers and containers,
+	and in the attributes of other objects (e.g. datasets and loaders), up to <depth> levels.
+	"""
+	if obj is None or id(obj) in seen:
+		return
+	seen.add(id(obj))
+	if torch.is_tensor(obj):
+		tensors.append(obj)
+	elif isinstance(obj, nn.Module):
+		tensors.extend(obj.parameters())
+		tensors.extend(obj.buffers())
+	elif isinstance(obj, torch.optim.Optimizer):
+		for state in obj.state.values():
+			collect_tensors(state, tensors, seen, depth)
+	elif depth < 0:
+		return
+	elif isinstance(obj, dict):
+		for value in obj.values():
+			collect_tensors(value, tensors, seen, depth - 1)
+	elif isinstance(obj, (list, tuple)):
+		for value in obj:
+			collect_tensors(value, tensors, seen, depth - 1)
+	elif depth > 0 and hasattr(obj, '__dict__') and not isinstance(obj, type):
+		for value in vars(obj).values():
+			collect_tensors(value, tensors, seen, depth - 1)
+
+
+class Memory_Tracker():
+	"""
+	Per-phase memory of the learner: the peak RSS of the process, the peak CUDA allocation, and the live tensor bytes by owner.
+
+	sample(key) is called by the Profiler at every clock(), i.e., at the end of each time_dict key, and records the peak RSS
+	(VmHWM, reset after every sample) and CUDA allocation since the previous sample under the phase of the key, see PHASES.
+	At the end of the round level phases (ACCOUNTED_KEYS), the tensors of the owners are also accounted: get_owners() returns
+	the objects of each owner, e.g. {'participant models': [...], 'optimizer state': [...], 'stored updates': [...], 'datasets': [...]},
+	and a tensor memory shared by several owners (or views) is only counted once, for the first owner.
+	All the values are the maxima over the rounds.
+
+	The RSS is of the whole process, so it includes the other learners in the process, e.g. the co-scheduled repeats.
+	Without /proc (not Linux), the peak RSS is the peak of the process so far, from getrusage.
+	"""
+
+	def __init__(self, get_owners, device=None):
+		self.get_owners = get_owners
+		self.cuda = device is not None and torch.device(device).type == 'cuda' and torch.cuda.is_available()
+		self.peak_rss = defaultdict(int)
+		self.peak_cuda = defaultdict(int)
+		self.tensor_bytes = defaultdict(lambda: defaultdict(int))
+		try:
+			read_status()
+			self.proc = reset_peak_rss()
+		except (IOError, OSError):
+			self.proc = False
+		self.reset_peak_cuda()
+
+	def reset_peak_cuda(self):
+		if not self.cuda:
+			return
+		if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+			torch.cuda.reset_peak_memory_stats()
+		else:
+			torch.cuda.reset_max_memory_allocated()
+
+	def get_peak_rss(self):
+		if self.proc:
+			_, peak_rss = read_status()
+			reset_peak_rss()
+			return peak_rss
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+	def sample(self, key):
+		phase = PHASE_OF_KEY.get(key, key)
+		self.peak_rss[phase] = max(self.peak_rss[phase], self.get_peak_rss())
+		if self.cuda:
+			self.peak_cuda[phase] = max(self.peak_cuda[phase], torch.cuda.max_memory_allocated())
+			self.reset_peak_cuda()
+		if key in ACCOUNTED_KEYS:
+			owner_bytes = self.account()
+			for phase in ACCOUNTED_KEYS[key]:
+				for owner, n_bytes in owner_bytes.items():
+					self.tensor_bytes[phase][owner] = max(self.tensor_bytes[phase][owner], n_bytes)
+
+	def account(self):
+		"""
+		The bytes of the live tensors of each owner.
+		"""
+		storages = set()
+		owner_bytes = OrderedDict()
+		for owner, objects in self.get_owners().items():
+			tensors = []
+			collect_tensors(objects, tensors, set())
+			owner_bytes[owner] = 0
+			for tensor in tensors:
+				storage, n_bytes = get_storage(tensor)
+				if storage not in storages:
+					storages.add(storage)
+					owner_bytes[owner] += n_bytes
+		return owner_bytes
+
+	def summary(self):
+		"""
+		The peak RSS, peak CUDA allocation and the live tensors by owner of each phase, in MB.
+		"""
+		phases = [phase for phase in list(PHASES) + sorted(self.peak_rss) if phase in self.peak_rss or phase in self.tensor_bytes]
+		summary = OrderedDict()
+		for phase in OrderedDict.fromkeys(phases):
+			summary[phase] = OrderedDict([('peak rss', round(self.peak_rss[phase] / MB, 3))])
+			if self.cuda:
+				summary[phase]['peak cuda'] = round(self.peak_cuda[phase] / MB, 3)
+			if phase in self.tensor_bytes:
+				summary[phase]['tensors'] = OrderedDict((owner, round(n_bytes / MB, 3)) for owner, n_bytes in self.tensor_bytes[phase].items())
+		return summary
+
+	def export(self, path):
+		with open(path, 'w') as file:
+			file.write(json.dumps(self.summary(), indent=1))
@@ -0,0 +1,148 @@
+import os
+import json
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+# the per-round metrics, by metric and track, stored as float32 [rounds, participants] arrays
+# (reputation_threshold is a [rounds] array)
+ROUND_METRICS = [
+	('test_accs', ['dssgd', 'fedavg', 'standalone', 'cffl', 'pretrain']),
+	('val_accs', ['dssgd', 'fedavg', 'cffl', 'pretrain']),
+	('reputations', ['cffl', 'pretrain']),
+	('reputation_threshold', ['cffl', 'pretrain']),
+]
+
+# the keys of the per-round metrics in the performance dicts, see read_convergence.get_performance_dicts
+PERFORMANCE_DICT_KEYS = {
+	'DSSGD_model_test_accs': ('test_accs', 'dssgd'),
+	'fedavg_model_test_accs': ('test_accs', 'fedavg'),
+	'participant_standalone_test_accs': ('test_accs', 'standalone'),
+	'cffl_test_accs': ('test_accs', 'cffl'),
+	'dssgd_val_accs': ('val_accs', 'dssgd'),
+	'fedavg_val_accs': ('val_accs', 'fedavg'),
+	'reputations': ('reputations', 'cffl'),
+	'reputation_threshold': ('reputation_threshold', 'cffl'),
+}
+PERFORMANCE_DICT_PRETRAIN_KEYS = dict(PERFORMANCE_DICT_KEYS, cffl_test_accs=('test_accs', 'pretrain'),
+	reputations=('reputations', 'pretrain'), reputation_threshold=('reputation_threshold', 'pretrain'))
+
+INDEX = 'index.json'
+
+
+def get_metrics_dir(logdir, repeat_index):
+	return os.path.join(logdir, 'metrics', 'repeat{}'.format(repeat_index))
+
+
+def get_filename(metric, track):
+	return '{}.{}.npy'.format(metric, track)
+
+
+class Metrics_Store():
+	"""
+	Columnar store of the per-round metrics of a run, in place of the lists of 0-d tensors in the performance dicts.
+
+	Each (metric, track) is a float32 array preallocated for <n_rounds> rounds and filled by append() one round at a time.
+	If <directory> is given, the arrays are .npy files memory-mapped from the directory, so every append is written
+	to disk, and flush() records the number of rounds of each array in index.json. load() maps them back (read-only)
+	without parsing or copying, and get() returns views of the recorded rounds.
+	"""
+
+	def __init__(self, n_rounds, n_participants, directory=None):
+		self.n_participants = n_participants
+		self.directory = directory
+		self.arrays = {}
+		self.lengths = {}
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		for metric, tracks in ROUND_METRICS:
+			for track in tracks:
+				self.arrays[(metric, track)] = self.allocate(metric, track, max(n_rounds, 1))
+				self.lengths[(metric, track)] = 0
+
+	def get_shape(self, metric, n_rounds):
+		return (n_rounds,) if metric == 'reputation_threshold' else (n_rounds, self.n_participants)
+
+	def allocate(self, metric, track, n_rounds):
+		shape = self.get_shape(metric, n_rounds)
+		if self.directory:
+			array = open_memmap(os.path.join(self.directory, get_filename(metric, track)), mode='w+', dtype=np.float32, shape=shape)
+			array[:] = np.nan
+			return array
+		return np.full(shape, np.nan, dtype=np.float32)
+
+	def append(self, metric, track, values):
+		key = (metric, track)
+		length = self.lengths[key]
+		array = self.arrays[key]
+		if length == len(array):
+			# more rounds than preallocated, e.g. an extra evaluation of a stopped CFFL_Session
+			recorded = np.array(array)
+			array = self.arrays[key] = self.allocate(metric, track, 2 * len(array))
+			array[:length] = recorded
+		array[length] = np.asarray([float(value) for value in values] if isinstance(values, (list, tuple)) else float(values), dtype=np.float32)
+		self.lengths[key] = length + 1
+
+	def get(self, metric, track):
+		key = (metric, track)
+		return self.arrays[key][:self.lengths[key]]
+
+	def last(self, metric, track):
+		return self.get(metric, track)[-1].tolist()
+
+	def flush(self):
+		if not self.directory:
+			return
+		for array in self.arrays.values():
+			array.flush()
+		index = {'n_participants': self.n_participants, 'lengths': {get_filename(*key): length for key, length in self.lengths.items()}}
+		path = os.path.join(self.directory, INDEX)
+		with open(path + '.tmp', 'w') as file:
+			file.write(json.dumps(index))
+		os.replace(path + '.tmp', path)
+
+	def save(self, directory):
+		"""
+		Write the recorded rounds to <directory>, e.g. of a store that is in memory only.
+		"""
+		os.makedirs(directory, exist_ok=True)
+		for key, array in self.arrays.items():
+			np.save(os.path.join(directory, get_filename(*key)), array)
+		with open(os.path.join(directory, INDEX), 'w') as file:
+			file.write(json.dumps({'n_participants': self.n_participants, 'lengths': {get_filename(*key): length for key, length in self.lengths.items()}}))
+
+	def state_dict(self):
+		return {key: self.get(*key).tolist() for key in self.arrays}
+
+	def load_state_dict(self, state):
+		for key, values in state.items():
+			self.lengths[key] = 0
+			for value in values:
+				self.append(key[0], key[1], value)
+
+	@classmethod
+	def load(cls, directory):
+		"""
+		Memory-map the arrays of a store written to <directory>, read-only.
+		"""
+		with open(os.path.join(directory, INDEX)) as file:
+			index = json.loads(file.read())
+		store = cls.__new__(cls)
+		store.n_participants = index['n_participants']
+		store.directory = None
+		store.arrays, store.lengths = {}, {}
+		for metric, tracks in ROUND_METRICS:
+			for track in tracks:
+				filename = get_filename(metric, track)
+				store.arrays[(metric, track)] = np.load(os.path.join(directory, filename), mmap_mode='r')
+				store.lengths[(metric, track)] = index['lengths'][filename]
+		return store
+
+	def to_performance_dicts(self):
+		"""
+		The per-round metrics under the keys of the performance dicts, as views.
+		"""
+		performance_dict = {key: self.get(*metric_track) for key, metric_track in PERFORMANCE_DICT_KEYS.items()}
+		performance_dict_pretrain = {key: self.get(*metric_track) for key, metric_track in PERFORMANCE_DICT_PRETRAIN_KEYS.items()}
+		return performance_dict, performance_dict_pretrain
@@ -1,10 +1,35 @@
+import copy
+import time
+import warnings
+from collections import OrderedDict, defaultdict
+
 import torch
 from torch.utils.data import Dataset, DataLoader
 from torch.nn.utils import clip_grad_value_, clip_grad_norm_
-from torchtext.data import Batch
 import utils
 import torch.nn as nn
 
+from utils.Profiler import Profiler
+from utils.utils import evaluate, add_update_to_model, compute_grad_update, fast_math_context, fast_math_batch
+
+
+# the model of each track, that the updates of the track are computed from and applied to
+TRACK_MODELS = OrderedDict([('cffl', 'model'), ('pretrain', 'model_pretrain'), ('dssgd', 'dssgd_model'), ('fedavg', 'fedavg_model')])
+
+# the args used to create the participants, see make_participant()
+PARTICIPANT_ARGS = ['optimizer_fn', 'lr', 'fed_lr', 'dssgd_lr', 'std_lr', 'pretraining_lr', 'gamma', 'device', 'loss_fn', 'theta',
+					'epoch_sample_size', 'grad_clip', 'fused_step', 'fast_math']
+
+# the multi-tensor add of torch >= 1.7, see Participant.step_fused()
+FOREACH = hasattr(torch, '_foreach_add_')
+
+
+def is_plain_sgd(optimizer):
+	# an SGD optimizer whose step is only p -= lr * grad
+	return isinstance(optimizer, torch.optim.SGD) and all(group.get('momentum', 0) == 0 and group.get('weight_decay', 0) == 0
+		and not group.get('maximize', False) for group in optimizer.param_groups)
+
+
 class Participant():
 
 	def __init__(self, train_loader, model=None, optimizer=None,scheduler=None,
@@ -13,7 +38,7 @@ class Participant():
 		dssgd_model=None, dssgd_optimizer=None, dssgd_scheduler=None,
 		fedavg_model=None, fedavg_optimizer=None, fedavg_scheduler=None,
 		loss_fn=None, theta=0.1, grad_clip=0.01, epoch_sample_size=-1,
-		device=None,id=None,is_free_rider=False):
+		device=None,id=None,is_free_rider=False, fused_step=False, fast_math=False):
 
 		self.train_loader = train_loader
 		self.model = model
@@ -40,8 +65,19 @@ class Participant():
 		self.epoch_sample_size = epoch_sample_size
 		self.param_count = sum([p.numel() for p in self.model.parameters()])
 		self.is_free_rider = is_free_rider
+		self.fused_step = fused_step
+		# bfloat16 autocast and channels last images in the local training and evaluation on the CPU, see utils.fast_math_context()
+		self.fast_math = fast_math
+		# the models before and the position of a local training deferred to the next round, see local_updates()
+		self.deferred = None
 
-	def train(self, epochs, is_pretrain=False, save_gpu=False):
+	def train(self, epochs, is_pretrain=False, save_gpu=False, budget=None, position=(0, 0), defer_late=False):
+		"""
+		budget: the samples or seconds the local training can take, {'samples': n} or {'seconds': s}, see Federated_Learner.round_budget
+		position: the (epoch, samples trained in the epoch) to resume the local training from, for the rest of the epoch
+		defer_late: the local training is resumed in the next round if the budget runs out, so the learning rates decay only when it completes
+		Returns the position to resume from if the budget ran out before the epochs, or None.
+		"""
 		if self.is_free_rider:
 			for model in [self.model, self.model_pretrain, self.dssgd_model, self.standalone_model]:
 				model = model.to(self.device)
@@ -64,17 +100,22 @@ class Participant():
 
 		self.fedavg_model.train()
 		self.fedavg_model = self.fedavg_model.to(self.device)
-		for epoch in range(int(epochs)):
-			iter = 0
+		start = time.time()
+		trained = 0
+		stopped = None
+		n_samples = get_n_samples(self.train_loader)
+		for epoch in range(int(position[0]), int(epochs)):
+			iter = position[1] if epoch == position[0] else 0
 			for i, batch in enumerate(self.train_loader):
-				if isinstance(batch, Batch):
-					batch_data, batch_target = batch.text, batch.label
-					batch_data = batch_data.permute(1, 0)
-					# batch_data.data.t_(), batch_target.data.sub_(1)  # batch first, index align
-				else:
-					batch_data, batch_target = batch[0], batch[1]
-
-				batch_data, batch_target = batch_data.to(self.device), batch_target.to(self.device)
+				if iter >= n_samples:
+					# the rest of a resumed epoch is done
+					break
+				if budget is not None and (trained >= budget.get('samples', float('inf')) or time.time() - start >= budget.get('seconds', float('inf'))):
+					stopped = (epoch, iter)
+					break
+				# text batches come batch first from Bucket_Loader, no permute needed
+				batch_data, batch_target = batch[0], batch[1]
+				batch_data, batch_target = fast_math_batch(batch_data.to(self.device), self.device, self.fast_math), batch_target.to(self.device)
 
 				# introduce separate (and slower) pretraining
 				if is_pretrain:
@@ -85,7 +126,9 @@ class Participant():
 							g['lr'] = self.pretraining_lr
 
 					self.optimizer_pretrain.zero_grad()
-					self.loss_fn(self.model_pretrain(batch_data), batch_target).backward()
+					with fast_math_context(self.device, self.fast_math):
+						loss = self.loss_fn(self.model_pretrain(batch_data), batch_target)
+					loss.backward()
 					self.optimizer_pretrain.step()
 					
 					# change the lr back so it does not affect FL training
@@ -95,24 +138,37 @@ class Participant():
 					continue
 
 				iter += len(batch_data)
-				for optimizer, model in zip([self.optimizer_pretrain, self.optimizer, self.standalone_optimizer, self.dssgd_optimizer, self.fedavg_optimizer] ,
-											[self.model_pretrain, self.model, self.standalone_model, self.dssgd_model, self.fedavg_model]):
-					optimizer.zero_grad()
-					self.loss_fn(model(batch_data), batch_target).backward()
-					optimizer.step()
+				trained += len(batch_data)
+				optimizers = [self.optimizer_pretrain, self.optimizer, self.standalone_optimizer, self.dssgd_optimizer, self.fedavg_optimizer]
+				models = [self.model_pretrain, self.model, self.standalone_model, self.dssgd_model, self.fedavg_model]
+				if self.fused_step:
+					self.step_fused(optimizers, models, batch_data, batch_target)
+				else:
+					for optimizer, model in zip(optimizers, models):
+						optimizer.zero_grad()
+						with fast_math_context(self.device, self.fast_math):
+							loss = self.loss_fn(model(batch_data), batch_target)
+						loss.backward()
+						optimizer.step()
 
 				if iter >= self.epoch_sample_size:
 					# specifically for NLP task to terminate for training efficiency
 					break
+			if stopped is not None:
+				break
 
-		if not is_pretrain:
-			# NO lr decay during pretraining
+		if not is_pretrain and not (stopped is not None and defer_late):
+			# NO lr decay during pretraining, nor in a local training that is resumed in the next round
 
-			self.standalone_scheduler.step()
-			self.scheduler_pretrain.step()
-			self.scheduler.step()
-			self.dssgd_scheduler.step()
-			self.fedavg_scheduler.step()
+			with warnings.catch_warnings():
+				if self.fused_step:
+					# the plain SGD optimizers did not step themselves, see step_fused()
+					warnings.filterwarnings('ignore', message=r'Detected call of `lr_scheduler\.step\(\)` before `optimizer\.step\(\)`')
+				self.standalone_scheduler.step()
+				self.scheduler_pretrain.step()
+				self.scheduler.step()
+				self.dssgd_scheduler.step()
+				self.fedavg_scheduler.step()
 
 
 		if 'cuda' in str(self.device) and save_gpu:
@@ -122,4 +178,222 @@ class Participant():
 			self.standalone_model = self.standalone_model.to(cpu)
 			self.dssgd_model = self.dssgd_model.to(cpu)
 			self.fedavg_model = self.fedavg_model.to(cpu)
+		return stopped
+
+	def step_fused(self, optimizers, models, batch_data, batch_target):
+		"""
+		The steps of the <optimizers> of all the tracks on a batch at once (args['fused_step']): one backward of the sum of the losses
+		of the <models>, which share no parameters, so each gets the gradients of its own loss, and one multi-tensor update of the parameters
+		of all the plain SGD optimizers with the same learning rate. The other optimizers (e.g. Adam or SGD with momentum) step on their own.
+		The models are updated exactly as by their own steps, with the graphs of the five forwards held at once.
+		"""
+		for optimizer in optimizers:
+			optimizer.zero_grad()
+		with fast_math_context(self.device, self.fast_math):
+			loss = sum([self.loss_fn(model(batch_data), batch_target) for model in models])
+		loss.backward()
+
+		# the parameters and gradients by learning rate, the current one of each param group as set by the schedulers
+		by_lr = OrderedDict()
+		for optimizer in optimizers:
+			if not is_plain_sgd(optimizer):
+				optimizer.step()
+				continue
+			for group in optimizer.param_groups:
+				params, grads = by_lr.setdefault(group['lr'], ([], []))
+				for param in group['params']:
+					if param.grad is not None:
+						params.append(param.data)
+						grads.append(param.grad.data)
+		for lr, (params, grads) in by_lr.items():
+			if FOREACH:
+				torch._foreach_add_(params, grads, alpha=-lr)
+			else:
+				for param, grad in zip(params, grads):
+					param.add_(grad, alpha=-lr)
+
+	def local_updates(self, epochs, grad_clip, largest_criterion, save_gpu=False, profiler=None, budget=None, defer_late=False):
+		"""
+		Train locally for a communication round and return the updates to upload, by track:
+		cffl, pretrain: the update clipped to <grad_clip> and masked to its largest theta fraction,
+			and the clipped update is kept in the model, i.e., the model is reset to before the round plus the clipped update
+		dssgd: the update clipped to 0.001 and masked to its largest theta fraction
+		fedavg: the whole update
+
+		profiler: clocks the phases under the time_dict keys of the learner, see Federated_Learner.train_locally.
+		budget: the limit of the local training in this round, see train(). If it runs out, the participant uploads the updates of the batches
+			it trained, or if defer_late, returns None and continues the local training in the next round, from its models before this round.
+		"""
+		from utils.Federated_Learner import clip_gradient_update, mask_grad_update_by_order
+		if profiler is None:
+			profiler = Profiler(defaultdict(float))
+
+		if self.deferred is None:
+			models_before = {track: copy.deepcopy(getattr(self, name)) for track, name in TRACK_MODELS.items()}
+			position = (0, 0)
+		else:
+			models_before, position = self.deferred
+			self.deferred = None
+		position = self.train(epochs, save_gpu=save_gpu, budget=budget, position=position, defer_late=defer_late)
+		if position is not None and defer_late:
+			self.deferred = (models_before, position)
+			profiler.clock('local train', key='participants local training')
+			return None
+		models_after = {track: copy.deepcopy(getattr(self, name)) for track, name in TRACK_MODELS.items()}
+		profiler.clock('local train', key='participants local training')
+
+		uploads = OrderedDict()
+		for track, key in [('cffl', 'gradient clipping and filtering'), ('pretrain', 'gradient clipping and filtering for pretrain')]:
+			profiler.begin('track', track=track)
+			model_before, model_after = models_before.pop(track), models_after.pop(track)
+			# recover the model before training for the clipped update
+			getattr(self, TRACK_MODELS[track]).load_state_dict(model_before.state_dict())
+			raw_grad_update = compute_grad_update(model_before, model_after, device=self.device)
+			del model_before, model_after  # to free up memory immediately
+
+			clipped_grad_update = clip_gradient_update(raw_grad_update, grad_clip)
+			# add the clipped grad to local model
+			add_update_to_model(getattr(self, TRACK_MODELS[track]), clipped_grad_update, device=self.device)
+			profiler.clock('clip', key=key)
+			uploads[track] = mask_grad_update_by_order(clipped_grad_update, mask_order=None, mask_percentile=self.theta, mode=largest_criterion)
+			profiler.clock('mask', key=key)
+			profiler.end()
+
+		profiler.begin('track', track='dssgd')
+		dssgd_grad_update = compute_grad_update(models_before.pop('dssgd'), models_after.pop('dssgd'), device=self.device)
+		uploads['dssgd'] = mask_grad_update_by_order(clip_gradient_update(dssgd_grad_update, 0.001), mask_order=None, mask_percentile=self.theta, mode=largest_criterion)
+		profiler.clock('clip and mask', key='server aggregation dssgd')
+		profiler.end()
+
+		profiler.begin('track', track='fedavg')
+		uploads['fedavg'] = compute_grad_update(models_before.pop('fedavg'), models_after.pop('fedavg'), device=self.device)
+		profiler.clock('update', key='server aggregation fedavg')
+		profiler.end()
+		return uploads
+
+	def download_model(self, track, state_dict):
+		# the server model of the track replaces the participant's, as in dssgd and fedavg
+		getattr(self, TRACK_MODELS[track]).load_state_dict(state_dict, strict=False)
+
+	def apply_download(self, track, allocated_grad, own_update, weight):
+		"""
+		Add the update allocated to the participant to the model of the track, less its own upload <own_update> weighted by <weight>.
+		"""
+		model = getattr(self, TRACK_MODELS[track])
+		add_update_to_model(model, allocated_grad)
+		add_update_to_model(model, own_update, weight=-weight)
+
+	def evaluate(self, name, eval_loader):
+		# the accuracy of the model <name>, e.g. 'model' or 'dssgd_model'
+		return evaluate(getattr(self, name), eval_loader, self.device, verbose=False, fast_math=self.fast_math)[1]
+
+	def state_dict(self, models=True):
+		"""
+		The models, optimizers and schedulers of all the tracks, for checkpointing.
+		models: False to leave out the models, e.g. when they are checkpointed by a Participant_Arena
+		"""
+		state = {}
+		for name in PARTICIPANT_STATE:
+			if not models and name in PARTICIPANT_MODELS:
+				continue
+			component = getattr(self, name)
+			if component is not None:
+				state[name] = component.state_dict()
+		if self.deferred is not None:
+			models_before, position = self.deferred
+			state['deferred'] = ({track: model.state_dict() for track, model in models_before.items()}, position)
+		return state
+
+	def load_state_dict(self, state):
+		self.deferred = None
+		for name, component_state in state.items():
+			if name == 'deferred':
+				models_before = {track: copy.deepcopy(getattr(self, name)) for track, name in TRACK_MODELS.items()}
+				for track, model_state in component_state[0].items():
+					models_before[track].load_state_dict(model_state)
+				self.deferred = (models_before, component_state[1])
+				continue
+			getattr(self, name).load_state_dict(component_state)
+
+
+# the models of a participant, of the tracks and standalone
+PARTICIPANT_MODELS = list(TRACK_MODELS.values()) + ['standalone_model']
+
+PARTICIPANT_STATE = ['model', 'optimizer', 'scheduler', 'model_pretrain', 'optimizer_pretrain', 'scheduler_pretrain',
+					'standalone_model', 'standalone_optimizer', 'standalone_scheduler', 'dssgd_model', 'dssgd_optimizer', 'dssgd_scheduler',
+					'fedavg_model', 'fedavg_optimizer', 'fedavg_scheduler']
+
+
+def get_n_samples(train_loader):
+	# the samples of an epoch, of a DataLoader with a sampler, or of a Bucket_Loader or Synthetic_Loader
+	if hasattr(train_loader, 'n_samples'):
+		return train_loader.n_samples
+	return len(train_loader.sampler)
+
+
+def make_participant(args, federated_model, train_loader, id=None):
+	"""
+	A participant with the models of all the tracks initialized as <federated_model>, and their optimizers and schedulers.
+	"""
+	optimizer_fn = args['optimizer_fn']
+	lr = args['lr']
+	fed_lr = args['fed_lr'] if 'fed_lr' in args else lr
+	dssgd_lr = args['dssgd_lr']
+	std_lr = args['std_lr'] if 'std_lr' in args else dssgd_lr
+	gamma = args['gamma']
+
+	model = copy.deepcopy(federated_model)
+	optimizer = optimizer_fn(model.parameters(), lr=lr)
+	scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma = gamma)
+
+
+	model_pretrain = copy.deepcopy(federated_model)
+	optimizer_pretrain = optimizer_fn(model_pretrain.parameters(), lr=lr)
+	scheduler_pretrain = torch.optim.lr_scheduler.ExponentialLR(optimizer_pretrain, gamma = gamma)
+
+
+	standalone_model = copy.deepcopy(federated_model)
+	standalone_optimizer = optimizer_fn(standalone_model.parameters(), lr=std_lr)
+	standalone_scheduler = torch.optim.lr_scheduler.ExponentialLR(standalone_optimizer, gamma = gamma)
+
+	dssgd_model = copy.deepcopy(federated_model)
+	dssgd_optimizer = optimizer_fn(dssgd_model.parameters(), lr=dssgd_lr)
+	# dssgd_optimizer = optimizer_fn(dssgd_model.parameters(), lr=lr)
+	# 0.977 ** 100 ~= 0.1    a smaller decay rate
+	dssgd_scheduler = torch.optim.lr_scheduler.ExponentialLR(dssgd_optimizer, gamma = gamma)
+
+	fedavg_model = copy.deepcopy(federated_model)
+	fedavg_optimizer = optimizer_fn(fedavg_model.parameters(), lr=fed_lr)
+	fedavg_scheduler = torch.optim.lr_scheduler.ExponentialLR(fedavg_optimizer, gamma = gamma)
+
+
+	return Participant(train_loader=train_loader,
+					model=model, optimizer=optimizer, scheduler=scheduler,
+					model_pretrain=model_pretrain, optimizer_pretrain=optimizer_pretrain,scheduler_pretrain=scheduler_pretrain,
+					pretraining_lr=args['pretraining_lr'],
+
+					standalone_model=standalone_model, standalone_optimizer=standalone_optimizer, standalone_scheduler=standalone_scheduler,
+					dssgd_model=dssgd_model, dssgd_optimizer=dssgd_optimizer,dssgd_scheduler=dssgd_scheduler,
+					fedavg_model=fedavg_model, fedavg_optimizer=fedavg_optimizer, fedavg_scheduler=fedavg_scheduler,
+					loss_fn=args['loss_fn'], theta=args['theta'],
+					grad_clip=args['grad_clip'], epoch_sample_size=args['epoch_sample_size'],
+					device=args['device'],
+					id=id,
+					fused_step=args.get('fused_step', False),
+					fast_math=args.get('fast_math', False),
+					)
+
 
+def make_freerider(args, federated_model):
+	# a free rider only perturbs its models at random, see Participant.train()
+	return Participant(train_loader=None,
+					model=copy.deepcopy(federated_model),
+					model_pretrain = copy.deepcopy(federated_model),
+					standalone_model=copy.deepcopy(federated_model),
+					dssgd_model=copy.deepcopy(federated_model),
+					fedavg_model=copy.deepcopy(federated_model),
+					theta=args['theta'],
+					device=args['device'],
+					is_free_rider=True,
+					fast_math=args.get('fast_math', False),
+					)
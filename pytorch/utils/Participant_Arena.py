@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+import torch
+
+from utils.Participant import TRACK_MODELS, PARTICIPANT_MODELS
+from utils.Federated_Learner import allocate_download
+
+
+# the most values of the rows allocated at once by apply_downloads, 64 MB of float32
+CHUNK_NUMEL = 16 * 1024 * 1024
+
+
+def flatten(update):
+	return torch.cat([tensor.data.view(-1) for tensor in update])
+
+
+class Participant_Arena():
+	"""
+	The parameters of all the models of the participants (args['participant_arena']) in one contiguous [models, param_count] tensor,
+	a row per model of each participant, with the parameters of each model as views into its row: the models, their optimizers and
+	everything that updates them in place work as before, and the operations on the models of many participants are tensor operations
+	on their rows, see apply_downloads() and state_dict().
+	The buffers (e.g. of batch norm) stay in the models, as a deep copy of a view would copy the whole arena.
+	A free rider, one participant for all of them, has one row per model.
+	"""
+
+	def __init__(self, participants):
+		self.participants = list(OrderedDict((id(participant), participant) for participant in participants).values())
+		self.models = [getattr(participant, name) for participant in self.participants for name in PARTICIPANT_MODELS]
+		self.rows = {(id(participant), name): row for row, (participant, name) in
+			enumerate((participant, name) for participant in self.participants for name in PARTICIPANT_MODELS)}
+		parameters = list(self.models[0].parameters())
+		self.param_count = sum([param.numel() for param in parameters])
+		self.arena = torch.zeros(len(self.models), self.param_count, dtype=parameters[0].dtype, device=parameters[0].device)
+		for row, model in zip(self.arena, self.models):
+			offset = 0
+			for param in model.parameters():
+				view = row[offset:offset + param.numel()].view(param.shape)
+				view.copy_(param.data)
+				param.data = view
+				offset += param.numel()
+
+	def allocate(self, aggregated, aggregated_update, mode, allocations, permuted_indices):
+		# the rows of allocate_download() of the <allocations> of the flat <aggregated> update
+		if mode == 'topk':
+			thresholds = torch.stack([torch.as_tensor(allocation, dtype=aggregated.dtype) for allocation in allocations]).view(-1, 1).to(aggregated.device)
+			return torch.where(aggregated.abs().unsqueeze(0) < thresholds, torch.zeros(1, dtype=aggregated.dtype, device=aggregated.device), aggregated.unsqueeze(0))
+		if mode == 'random':
+			positions = torch.empty_like(permuted_indices)
+			positions[permuted_indices] = torch.arange(len(permuted_indices), device=permuted_indices.device)
+			counts = torch.tensor(allocations, device=positions.device).view(-1, 1)
+			# none allocated is all of the update, as in mask_grad_update_by_indices
+			keep = (positions.unsqueeze(0) < counts) | (counts == 0)
+			return torch.where(keep.to(aggregated.device), aggregated.unsqueeze(0), torch.zeros(1, dtype=aggregated.dtype, device=aggregated.device))
+		return torch.stack([flatten(allocate_download(aggregated_update, mode, allocation)) for allocation in allocations])
+
+	def apply_downloads(self, participants, track, aggregated_update, mode, allocations, permuted_indices, own_updates, weights):
+		"""
+		Participant.apply_download of the model of <track> of each of the <participants>, with its allocation, own upload and weight,
+		on their rows at once. The repeated participants (the free rider) apply their next downloads in turn, as in the loop of the participants.
+		"""
+		name = TRACK_MODELS[track]
+		first, repeated = OrderedDict(), []
+		for k, participant in enumerate(participants):
+			if id(participant) in first:
+				repeated.append(k)
+			else:
+				first[id(participant)] = k
+
+		aggregated = flatten(aggregated_update).to(self.arena.device)
+		ks = list(first.values())
+		chunk = max(1, CHUNK_NUMEL // max(self.param_count, 1))
+		for start in range(0, len(ks), chunk):
+			chunk_ks = ks[start:start + chunk]
+			rows = torch.tensor([self.rows[(id(participants[k]), name)] for k in chunk_ks], device=self.arena.device)
+			self.arena.index_add_(0, rows, self.allocate(aggregated, aggregated_update, mode, [allocations[k] for k in chunk_ks], permuted_indices))
+			own = torch.stack([flatten(own_updates[k]) for k in chunk_ks]).to(self.arena.device)
+			# the own upload weighted by -weight, as in add_update_to_model
+			own_weights = torch.stack([-torch.as_tensor(weights[k], dtype=own.dtype) for k in chunk_ks]).view(-1, 1).to(self.arena.device)
+			self.arena.index_add_(0, rows, own_weights * own)
+
+		for k in repeated:
+			allocated_grad = allocate_download(aggregated_update, mode, allocations[k], permuted_indices)
+			participants[k].apply_download(track, allocated_grad, own_updates[k], weights[k])
+
+	def state_dict(self):
+		"""
+		The parameters of all the models as one copy of the arena, and their buffers.
+		"""
+		return {'arena': self.arena.clone(), 'buffers': [[buffer.clone() for buffer in model.buffers()] for model in self.models]}
+
+	def load_state_dict(self, state):
+		self.arena.copy_(state['arena'])
+		for model, buffers in zip(self.models, state['buffers']):
+			for buffer, value in zip(model.buffers(), buffers):
+				buffer.copy_(value)
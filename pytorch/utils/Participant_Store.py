@@ -0,0 +1,297 @@
+import os
+import copy
+import time
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.Participant import make_participant
+
+
+# the dtypes of the arena, by store_dtype: bfloat16 is kept as the upper 16 bits of the float32 values, see encode()
+STORE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16}
+
+# the calls that change the state of a participant, so that it is written back to the arena when evicted
+MUTATING_METHODS = ['train', 'local_updates', 'download_model', 'apply_download', 'load_state_dict']
+
+
+def encode(values, store_dtype):
+	# float32 values to the arena dtype, bfloat16 rounded to the nearest even
+	if store_dtype == 'bfloat16':
+		bits = values.astype(np.float32).view(np.uint32)
+		return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+	return values.astype(STORE_DTYPES[store_dtype])
+
+
+def decode(values, store_dtype):
+	if store_dtype == 'bfloat16':
+		return (values.astype(np.uint32) << 16).view(np.float32)
+	return values.astype(np.float32)
+
+
+class Stored():
+	# the place of a tensor of a state in its row of the arena
+	def __init__(self, shape, dtype):
+		self.shape = shape
+		self.dtype = dtype
+
+
+def strip_state(obj, tensors):
+	"""
+	The structure of the state <obj> (nested dicts, lists and tuples), with its floating point tensors replaced by Stored places and appended to <tensors>.
+	The scalar tensors (e.g. the steps of the optimizers and the batches tracked by batch norm) stay in the structure, in full precision.
+	"""
+	if torch.is_tensor(obj):
+		if obj.is_floating_point() and obj.dim() > 0:
+			tensors.append(obj)
+			return Stored(obj.shape, obj.dtype)
+		return obj.detach().clone()
+	if isinstance(obj, dict):
+		stripped = type(obj)((key, strip_state(value, tensors)) for key, value in obj.items())
+		if hasattr(obj, '_metadata'):
+			# the versions of the modules in a state_dict
+			stripped._metadata = copy.deepcopy(obj._metadata)
+		return stripped
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(strip_state(value, tensors) for value in obj)
+	return copy.deepcopy(obj)
+
+
+def fill_state(obj, flat, offset=None):
+	# the state of a structure of strip_state(), with the tensors from the row <flat>
+	if offset is None:
+		offset = [0]
+	if isinstance(obj, Stored):
+		numel = int(np.prod(obj.shape))
+		tensor = flat[offset[0]:offset[0] + numel].view(obj.shape).to(obj.dtype)
+		offset[0] += numel
+		return tensor
+	if isinstance(obj, dict):
+		filled = type(obj)((key, fill_state(value, flat, offset)) for key, value in obj.items())
+		if hasattr(obj, '_metadata'):
+			filled._metadata = obj._metadata
+		return filled
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(fill_state(value, flat, offset) for value in obj)
+	return copy.deepcopy(obj)
+
+
+class Stored_Participant():
+	"""
+	A participant of the learner whose state is kept by a Participant_Store: each call materializes it in a live participant, see Participant for the calls.
+	"""
+
+	def __init__(self, store, index, id, theta, param_count):
+		self.store = store
+		self.index = index
+		self.id = id
+		self.is_free_rider = False
+		self.theta = theta
+		self.param_count = param_count
+
+	def call(self, method, *args, **kwargs):
+		return getattr(self.store.materialize(self.index, dirty=(method in MUTATING_METHODS)), method)(*args, **kwargs)
+
+	def train(self, epochs, is_pretrain=False, save_gpu=False, budget=None, position=(0, 0), defer_late=False):
+		return self.call('train', epochs, is_pretrain=is_pretrain, save_gpu=save_gpu, budget=budget, position=position, defer_late=defer_late)
+
+	def local_updates(self, epochs, grad_clip, largest_criterion, save_gpu=False, profiler=None, budget=None, defer_late=False):
+		return self.call('local_updates', epochs, grad_clip, largest_criterion, save_gpu=save_gpu, profiler=profiler, budget=budget, defer_late=defer_late)
+
+	def download_model(self, track, state_dict):
+		return self.call('download_model', track, state_dict)
+
+	def apply_download(self, track, allocated_grad, own_update, weight):
+		return self.call('apply_download', track, allocated_grad, own_update, weight)
+
+	def evaluate(self, name, eval_loader):
+		return self.call('evaluate', name, eval_loader)
+
+	def state_dict(self):
+		# a copy, as the live participant takes the state of another participant after its eviction
+		return copy.deepcopy(self.call('state_dict'))
+
+	def load_state_dict(self, state):
+		return self.call('load_state_dict', state)
+
+
+class Participant_Store():
+	"""
+	Keeps the state of the participants of a learner (the models, optimizers and schedulers of all the tracks, and the models of a deferred
+	local training) in a memory-mapped arena on disk, a row per participant, and materializes a participant in one of a few live participants
+	only while it is called, see Stored_Participant. So the memory of the participants is that of the live ones, rather than of all of them.
+
+	args['participant_store']: the directory of the arena, or True for a temporary directory, removed by close()
+	args['live_participants']: the number of live participants, the least recently called one is written back to the arena to make room. Default: 2
+	args['store_dtype']: the precision of the floating point tensors in the arena, 'float32' (the results are exactly the same as without the store),
+		'float16' or 'bfloat16' (the rows are half the size, the states are rounded at every eviction). Default: 'float32'
+	args['store_prefetch']: the number of participants read ahead from the arena in the background, the next ones in the schedule
+		(all the participants in order, or the sampled ones, see Federated_Learner.sample_participants). Default: 1
+
+	A participant not written to the arena yet has the state of a new participant, kept once for all of them.
+	The rows grow, all at once, the first time a state is larger than them, e.g. with the optimizer state after the first local training.
+	The free riders are one participant for all of them, and stay live.
+	"""
+
+	def __init__(self, args, federated_model, train_loaders, profiler):
+		directory = args['participant_store']
+		self.temporary = directory is True
+		self.directory = tempfile.mkdtemp() if self.temporary else directory
+		os.makedirs(self.directory, exist_ok=True)
+		self.path = os.path.join(self.directory, 'participants.arena')
+		self.store_dtype = args.get('store_dtype', 'float32')
+		assert self.store_dtype in STORE_DTYPES, "Unknown store_dtype {}, only {} are available.".format(self.store_dtype, list(STORE_DTYPES))
+		self.n_live = max(1, args.get('live_participants', 2))
+		self.n_prefetch = args.get('store_prefetch', 1)
+		self.args = args
+		self.federated_model = federated_model
+		self.train_loaders = train_loaders
+		self.profiler = profiler
+
+		# the live participants, by index, the least recently called first, and the participants that changed since they were materialized
+		self.live = OrderedDict()
+		self.dirty = set()
+		# the structure of the state of each participant in the arena, and the size of its row in use, see strip_state
+		self.layouts = {}
+		self.sizes = {}
+		participant = make_participant(args, federated_model, train_loaders[0], id=0)
+		self.template = self.strip(participant)
+		# the participants to materialize the first ones in, before the evictions
+		self.spares = [participant]
+
+		# the order the participants are called in, to prefetch the next ones, None for all of them in order
+		self.schedule = None
+		self.executor = ThreadPoolExecutor(1) if self.n_prefetch > 0 else None
+		self.prefetched = OrderedDict()
+		self.row_numel = 0
+		self.arena = None
+		self.grow(len(self.template[1]))
+		self.materializations, self.evictions, self.writes, self.prefetch_hits = 0, 0, 0, 0
+		self.read_seconds, self.write_seconds = 0., 0.
+
+		param_count = sum([p.numel() for p in federated_model.parameters()])
+		self.participants = [Stored_Participant(self, i, i, args['theta'], param_count) for i in range(len(train_loaders))]
+
+	def strip(self, participant):
+		# the layout and the flat float32 values of the state of a participant
+		tensors = []
+		layout = strip_state(participant.state_dict(), tensors)
+		flat = torch.cat([tensor.detach().reshape(-1).cpu().float() for tensor in tensors]) if tensors else torch.zeros(0)
+		return layout, flat
+
+	def grow(self, numel):
+		# rows of at least <numel> values, with the rows written so far
+		if numel <= self.row_numel:
+			return
+		self.wait_prefetched()
+		path = self.path + '.grow'
+		arena = np.memmap(path, dtype=STORE_DTYPES[self.store_dtype], mode='w+', shape=(len(self.train_loaders), numel))
+		if self.arena is not None:
+			for index, size in self.sizes.items():
+				arena[index, :size] = self.arena[index, :size]
+			del self.arena
+		os.replace(path, self.path)
+		self.arena = arena
+		self.row_numel = numel
+
+	def read(self, index):
+		# the row of a participant, as a float32 tensor of its own
+		return torch.from_numpy(decode(np.array(self.arena[index, :self.sizes[index]]), self.store_dtype))
+
+	def write(self, index, participant):
+		layout, flat = self.strip(participant)
+		self.grow(len(flat))
+		self.arena[index, :len(flat)] = encode(flat.numpy(), self.store_dtype)
+		self.layouts[index] = layout
+		self.sizes[index] = len(flat)
+		self.writes += 1
+
+	def materialize(self, index, dirty=False):
+		"""
+		The live participant of <index>, with its state from the arena if it is not live, in place of the least recently called one.
+		dirty: the call changes the state, so that it is written back to the arena on eviction
+		"""
+		if index not in self.live:
+			start = time.time()
+			if len(self.live) >= self.n_live:
+				participant = self.evict()
+			else:
+				participant = self.spares.pop() if self.spares else make_participant(self.args, self.federated_model, self.train_loaders[index], id=index)
+			if index in self.layouts:
+				if index in self.prefetched:
+					flat = self.prefetched.pop(index).result()
+					self.prefetch_hits += 1
+				else:
+					flat = self.read(index)
+				participant.load_state_dict(fill_state(self.layouts[index], flat))
+			else:
+				layout, flat = self.template
+				participant.load_state_dict(fill_state(layout, flat.clone()))
+			participant.train_loader = self.train_loaders[index]
+			participant.id = index
+			self.live[index] = participant
+			self.materializations += 1
+			seconds = time.time() - start
+			self.read_seconds += seconds
+			self.profiler.add('participant store', seconds)
+			self.prefetch(index)
+		self.live.move_to_end(index)
+		if dirty:
+			self.dirty.add(index)
+		return self.live[index]
+
+	def evict(self):
+		# the least recently called participant, written to the arena if it changed, to take the state of another one
+		index, participant = self.live.popitem(last=False)
+		self.evictions += 1
+		if index in self.dirty:
+			start = time.time()
+			self.dirty.discard(index)
+			self.write(index, participant)
+			self.write_seconds += time.time() - start
+		return participant
+
+	def prefetch(self, index):
+		# read the rows of the next participants in the schedule in the background
+		if self.executor is None:
+			return
+		schedule = self.schedule if self.schedule is not None else range(len(self.train_loaders))
+		following = [i for i in schedule if i > index] + [i for i in schedule if i < index]
+		for i in following[:self.n_prefetch]:
+			if i in self.layouts and i not in self.live and i not in self.prefetched:
+				self.prefetched[i] = self.executor.submit(self.read, i)
+		while len(self.prefetched) > self.n_prefetch:
+			self.prefetched.popitem(last=False)[1].result()
+
+	def wait_prefetched(self):
+		for future in self.prefetched.values():
+			future.result()
+
+	def live_participants(self):
+		return list(self.live.values())
+
+	def summary(self):
+		"""
+		The size of the arena, the materializations of the participants and the evictions, of which written back to the arena,
+		the reads ahead that were used, and the seconds of the reads (with the loading of the states) and of the writes.
+		"""
+		itemsize = np.dtype(STORE_DTYPES[self.store_dtype]).itemsize
+		return OrderedDict([('store dtype', self.store_dtype), ('live participants', self.n_live),
+			('arena MB', round(len(self.train_loaders) * self.row_numel * itemsize / 1024 / 1024, 3)),
+			('materializations', self.materializations), ('evictions', self.evictions), ('writes', self.writes), ('prefetch hits', self.prefetch_hits),
+			('read seconds', round(self.read_seconds, 3)), ('write seconds', round(self.write_seconds, 3))])
+
+	def close(self):
+		if self.executor is not None:
+			self.wait_prefetched()
+			self.executor.shutdown()
+			self.executor = None
+		self.prefetched = OrderedDict()
+		if self.temporary:
+			del self.arena
+			self.arena = None
+			shutil.rmtree(self.directory, ignore_errors=True)
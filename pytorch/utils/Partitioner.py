@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+
+class Partitioner():
+	"""
+	Computes the participant shards for all the splits in one pass, as index arrays.
+
+	The result of a partition is a single int32 array of all the selected sample indices, ordered by participant,
+	and the int32 shard sizes. If <manifest_dir> is given, both are saved as a manifest under a hash of the
+	partition config, and are loaded back (memory-mapped) for any later partition with the same config.
+
+	Supported splits:
+	'powerlaw': contiguous shards of powerlaw distributed sizes
+	'balanced'/'equal': contiguous shards of equal sizes
+	'random': contiguous shards split at random points
+	'classimbalance': participant i has samples from the first class_sizes[i] classes, sampled with replacement
+	'dirichlet': label skew, the samples of each class are divided according to Dirichlet(beta) proportions
+	"""
+
+	def __init__(self, manifest_dir=None, seed=1234):
+		self.manifest_dir = manifest_dir
+		self.seed = seed
+
+	def partition(self, n_samples, n_participants, split='powerlaw', targets=None, n_classes=10, sample_size_cap=None, alpha=1.65911332899, beta=0.5, shuffle=False, name=''):
+		config = {'name': name, 'n_samples': int(n_samples), 'n_participants': int(n_participants), 'split': split, 'shuffle': shuffle, 'seed': self.seed}
+		if split == 'powerlaw':
+			config['alpha'] = alpha
+		elif split in ['classimbalance', 'dirichlet']:
+			assert targets is not None, "The {} split requires the targets of the samples.".format(split)
+			targets = np.asarray(targets)
+			config['n_classes'] = int(n_classes)
+			config['targets'] = hashlib.sha1(np.ascontiguousarray(targets, dtype=np.int64).tobytes()).hexdigest()
+			if split == 'classimbalance':
+				config['sample_size_cap'] = int(sample_size_cap if sample_size_cap is not None else n_samples)
+			else:
+				config['beta'] = beta
+
+		key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+		loaded = self.load_manifest(key)
+		if loaded is not None:
+			return loaded
+
+		rng = np.random.RandomState(self.seed)
+		if split == 'powerlaw':
+			indices, shard_sizes = powerlaw_split(n_samples, n_participants, alpha)
+		elif split in ['balanced', 'equal']:
+			indices, shard_sizes = equal_split(n_samples, n_participants)
+		elif split == 'random':
+			indices, shard_sizes = random_points_split(n_samples, n_participants, rng)
+		elif split == 'classimbalance':
+			indices, shard_sizes = class_imbalance_split(targets, n_participants, n_classes, config['sample_size_cap'] // n_participants, rng)
+		elif split == 'dirichlet':
+			indices, shard_sizes = dirichlet_split(targets, n_participants, n_classes, beta, rng)
+		else:
+			raise NotImplementedError("The split {} is not implemented.".format(split))
+
+		if shuffle and split in ['powerlaw', 'balanced', 'equal', 'random']:
+			# the contiguous splits are over a permutation of all the samples instead
+			indices = rng.permutation(n_samples).astype(np.int32)[indices]
+
+		self.save_manifest(key, config, indices, shard_sizes)
+		return indices, shard_sizes
+
+	def partition_list(self, *args, **kwargs):
+		indices, shard_sizes = self.partition(*args, **kwargs)
+		return split_by_shard_sizes(indices, shard_sizes)
+
+	def load_manifest(self, key):
+		if not self.manifest_dir:
+			return None
+		directory = os.path.join(self.manifest_dir, key)
+		try:
+			indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode='r')
+			shard_sizes = np.load(os.path.join(directory, 'shard_sizes.npy'))
+		except (IOError, ValueError):
+			return None
+		return indices, shard_sizes
+
+	def save_manifest(self, key, config, indices, shard_sizes):
+		if not self.manifest_dir:
+			return
+		directory = os.path.join(self.manifest_dir, key)
+		os.makedirs(directory, exist_ok=True)
+		save_atomically(os.path.join(directory, 'config.json'), lambda file: file.write(json.dumps(config).encode()))
+		# the arrays are written last, so that an interrupted save is not loaded
+		save_atomically(os.path.join(directory, 'shard_sizes.npy'), lambda file: np.save(file, shard_sizes))
+		save_atomically(os.path.join(directory, 'indices.npy'), lambda file: np.save(file, indices))
+
+
+def save_atomically(path, write):
+	# to a temporary file of this process renamed to <path>, so that a reader or a concurrent save (e.g. the workers of a sweep) never sees a partial file
+	temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+	with open(temporary_path, 'wb') as file:
+		write(file)
+	os.replace(temporary_path, path)
+
+
+def split_by_shard_sizes(indices, shard_sizes):
+	# views into <indices>, one per participant
+	return np.split(indices, np.cumsum(shard_sizes)[:-1])
+
+
+def contiguous_split(n_samples, shard_sizes):
+	# clip the shards to the available samples, as the list slicing did
+	offsets = np.minimum(np.concatenate([[0], np.cumsum(shard_sizes)]), n_samples)
+	shard_sizes = np.diff(offsets).astype(np.int32)
+	return np.arange(offsets[-1], dtype=np.int32), shard_sizes
+
+
+def powerlaw_split(n_samples, n_participants, alpha=1.65911332899):
+	# the smaller the alpha, the more extreme the division
+	from scipy.stats import powerlaw
+	party_size = int(n_samples / n_participants)
+	b = np.linspace(powerlaw.ppf(0.01, alpha), powerlaw.ppf(0.99, alpha), n_participants)
+	shard_sizes = np.ceil(b / b.sum() * party_size * n_participants).astype(np.int64)
+	return contiguous_split(n_samples, shard_sizes)
+
+
+def equal_split(n_samples, n_participants):
+	shard_sizes = np.full(n_participants, n_samples // n_participants, dtype=np.int64)
+	shard_sizes[:n_samples % n_participants] += 1
+	return contiguous_split(n_samples, shard_sizes)
+
+
+def random_points_split(n_samples, n_participants, rng):
+	split_points = np.sort(rng.choice(n_samples - 2, n_participants - 1, replace=False) + 1)
+	shard_sizes = np.diff(np.concatenate([[0], split_points, [n_samples]]))
+	return contiguous_split(n_samples, shard_sizes)
+
+
+def group_by_participant(participant_ids, sample_indices, n_participants):
+	# stable, so the samples of each participant keep the order they were drawn in
+	order = np.argsort(participant_ids, kind='stable')
+	shard_sizes = np.bincount(participant_ids, minlength=n_participants).astype(np.int32)
+	return sample_indices[order].astype(np.int32), shard_sizes
+
+
+def class_imbalance_split(targets, n_participants, n_classes, party_mean, rng):
+	class_sizes = np.linspace(1, n_classes, n_participants, dtype='int')
+	print("class_sizes for each party", class_sizes)
+	each_class_sizes = party_mean // class_sizes
+
+	participant_ids, sample_indices = [], []
+	for class_id in range(n_classes):
+		class_indices = np.flatnonzero(targets == class_id)
+		parties = np.flatnonzero(class_sizes > class_id)
+		if len(parties) == 0 or len(class_indices) == 0:
+			continue
+
+		# randomly pick from each class a certain number of samples, with replacement, for all the parties at once
+		counts = each_class_sizes[parties]
+		participant_ids.append(np.repeat(parties, counts))
+		sample_indices.append(class_indices[rng.randint(0, len(class_indices), size=counts.sum())])
+
+		# top up from the last class of each party to make sure all parties have the same number of samples
+		last = parties[class_sizes[parties] == class_id + 1]
+		extra_needed = party_mean - each_class_sizes[last] * class_sizes[last]
+		last, extra_needed = last[extra_needed > 0], extra_needed[extra_needed > 0]
+		if len(last):
+			participant_ids.append(np.repeat(last, extra_needed))
+			sample_indices.append(np.resize(class_indices, extra_needed.sum()))
+
+	return group_by_participant(np.concatenate(participant_ids), np.concatenate(sample_indices), n_participants)
+
+
+def dirichlet_split(targets, n_participants, n_classes, beta, rng):
+	participant_ids, sample_indices = [], []
+	for class_id in range(n_classes):
+		class_indices = rng.permutation(np.flatnonzero(targets == class_id))
+		proportions = rng.dirichlet(np.full(n_participants, beta))
+		counts = np.diff(np.concatenate([[0], np.round(np.cumsum(proportions) * len(class_indices)).astype(np.int64)]))
+		participant_ids.append(np.repeat(np.arange(n_participants), counts))
+		sample_indices.append(class_indices)
+
+	return group_by_participant(np.concatenate(participant_ids), np.concatenate(sample_indices), n_participants)
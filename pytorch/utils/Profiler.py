@@ -0,0 +1,118 @@
+import os
+import json
+import time
+
+import pandas as pd
+import torch
+
+
+def make_operator_profiler():
+	# torch.profiler from torch 1.8, the autograd profiler before
+	if hasattr(torch, 'profiler') and hasattr(torch.profiler, 'profile'):
+		return torch.profiler.profile()
+	return torch.autograd.profiler.profile()
+
+
+class Profiler():
+	"""
+	Span profiler of the learner, in place of the flat clock() buckets.
+
+	clock(name, key) ends the current phase, i.e., the time since the last clock() or mark(), as in the previous clock():
+	the time is always added to totals[key] (the time_dict of the learner), which costs the same as before.
+	If enabled, the phase is also recorded as a span with its args (e.g. participant and track),
+	nested under the spans opened by begin() and closed by end() (e.g. round -> participant -> track).
+
+	operator_rounds: the rounds (from 1) to also capture operator-level detail for, with torch.profiler (or the autograd profiler), if enabled.
+	memory: a Memory_Tracker to sample at every clock(), i.e., the memory of the same phases as the totals.
+
+	export(directory) writes the spans as a Chrome trace (chrome://tracing or Perfetto), the operator traces of
+	the captured rounds, and summary() as csv: the time of each phase by track, or by participant / round.
+	"""
+
+	def __init__(self, totals, enabled=False, operator_rounds=(), memory=None):
+		self.totals = totals
+		self.memory = memory
+		self.enabled = enabled
+		self.operator_rounds = set(operator_rounds)
+		self.last = time.time()
+		self.start = self.last
+		self.stack = []
+		self.events = []
+		self.operator_profiles = {}
+		self.operator_profile = None
+
+	def mark(self):
+		self.last = time.time()
+
+	def clock(self, name, key=None, **args):
+		now = time.time()
+		self.totals[key or name] += now - self.last
+		if self.enabled:
+			self.record(name, self.last, now, dict(self.get_context(), **args))
+		self.last = now
+		if self.memory is not None:
+			self.memory.sample(key or name)
+			# the sampling is not part of the next phase
+			self.last = time.time()
+
+	def add(self, key, seconds):
+		# time spent within the current phase on something else, e.g. in a remote participant or in the communication:
+		# added to totals[key] and excluded from the current phase
+		self.totals[key] += seconds
+		self.last += seconds
+
+	def begin(self, name, **args):
+		if self.enabled:
+			self.stack.append((name, time.time(), args))
+
+	def end(self):
+		if self.enabled:
+			name, start, args = self.stack.pop()
+			self.record(name, start, time.time(), dict(self.get_context(), **args))
+
+	def get_context(self):
+		# the args of the enclosing spans, e.g. the round and participant of a phase
+		context = {}
+		for _, _, args in self.stack:
+			context.update(args)
+		return context
+
+	def record(self, name, start, end, args):
+		self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+			'ts': round((start - self.start) * 1e6, 3), 'dur': round((end - start) * 1e6, 3), 'args': args})
+
+	def begin_round(self, epoch):
+		self.begin('round', round=epoch + 1)
+		if self.enabled and epoch + 1 in self.operator_rounds:
+			self.operator_profile = make_operator_profiler()
+			self.operator_profile.__enter__()
+
+	def end_round(self, epoch):
+		if self.operator_profile is not None:
+			self.operator_profile.__exit__(None, None, None)
+			self.operator_profiles[epoch + 1] = self.operator_profile
+			self.operator_profile = None
+		self.end()
+
+	def summary(self, by='track'):
+		"""
+		The time of each phase (the spans recorded by clock()) in seconds, by 'track', 'participant' or 'round'.
+		"""
+		phases = [event for event in self.events if event['name'] not in ['round', 'participant', 'track']]
+		if not phases:
+			return pd.DataFrame()
+		df = pd.DataFrame([{'phase': event['name'], by: event['args'].get(by, ''), 'seconds': event['dur'] / 1e6} for event in phases])
+		summary = df.groupby(['phase', by])['seconds'].agg(['count', 'sum', 'mean', 'max'])
+		return summary.sort_values('sum', ascending=False)
+
+	def operator_table(self, round_number, row_limit=20):
+		return self.operator_profiles[round_number].key_averages().table(sort_by='self_cpu_time_total', row_limit=row_limit)
+
+	def export(self, directory, prefix=''):
+		os.makedirs(directory, exist_ok=True)
+		with open(os.path.join(directory, prefix + 'trace.json'), 'w') as file:
+			file.write(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}))
+		for by in ['track', 'participant', 'round']:
+			self.summary(by).to_csv(os.path.join(directory, '{}summary_by_{}.csv'.format(prefix, by)))
+		for round_number, operator_profile in self.operator_profiles.items():
+			operator_profile.export_chrome_trace(os.path.join(directory, '{}operators_round{}.json'.format(prefix, round_number)))
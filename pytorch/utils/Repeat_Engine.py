@@ -0,0 +1,155 @@
+import os
+import sys
+import random
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.Federated_Learner import Federated_Learner
+from utils.Metrics_Store import get_metrics_dir
+from utils.utils import evaluate_models, get_rng_state, set_rng_state
+
+
+def seed_repeat(repeat_index, seed=1234):
+	"""
+	Give each repeat its own random stream (args['seed_repeats'], and the co-scheduled repeats), so that a repeat does not depend
+	on how the other repeats consumed the random numbers, and runs the same in any order, process or group of repeats.
+	Without it, the sequential repeats continue from the random state of the previous one.
+	"""
+	torch.manual_seed(seed + repeat_index)
+	np.random.seed(seed + repeat_index)
+	random.seed(seed + repeat_index)
+
+
+def get_available_cpus():
+	if hasattr(os, 'sched_getaffinity'):
+		return len(os.sched_getaffinity(0))
+	return os.cpu_count()
+
+
+def export_diagnostics(federated_learner, logdir, i):
+	# the profile and the memory of repeat <i>, see Profiler and Memory_Tracker
+	if logdir is None:
+		return
+	if federated_learner.profiler.enabled:
+		federated_learner.profiler.export(os.path.join(logdir, 'profile'), prefix='repeat{}_'.format(i))
+	if federated_learner.memory_tracker is not None:
+		federated_learner.memory_tracker.export(os.path.join(logdir, 'memory_repeat{}.json'.format(i)))
+
+
+class Finished_Repeat():
+	# the results of a repeat that ran in a worker process of the Repeat_Engine
+	def __init__(self, federated_learner):
+		self.performance_dict = federated_learner.performance_dict
+		self.performance_dict_pretrain = federated_learner.performance_dict_pretrain
+
+
+def co_schedule(args, data_prepper, indices, logdir=None):
+	"""
+	Run the repeats <indices> together, round by round: each repeat keeps its own random stream, swapped in whenever the repeat
+	is stepped, and the test set evaluation of each round is done in a single pass over the test batches for all of them.
+	Returns their learners, in order.
+	"""
+	device = args['device']
+	learners, rng_states = [], []
+
+	def step(k, fn, *fn_args):
+		set_rng_state(rng_states[k])
+		result = fn(*fn_args)
+		rng_states[k] = get_rng_state()
+		return result
+
+	for i in indices:
+		seed_repeat(i)
+		print()
+		print("Experiment : No.{}".format(str(i+1)))
+		federated_learner = Federated_Learner(args, data_prepper, metrics_dir=get_metrics_dir(logdir, i) if logdir else None)
+		federated_learner.start_training()
+		learners.append(federated_learner)
+		rng_states.append(get_rng_state())
+
+	for epoch in range(args['fl_epochs']):
+		for k, federated_learner in enumerate(learners):
+			step(k, federated_learner.run_round, epoch)
+
+		for federated_learner, test_accs in zip(learners, evaluate_learners(learners, data_prepper.get_test_loader(), device)):
+			federated_learner.record_round(epoch, test_accs=test_accs)
+
+	for k, (i, federated_learner) in enumerate(zip(indices, learners)):
+		step(k, federated_learner.finish_training)
+		federated_learner.get_fairness_analysis()
+		export_diagnostics(federated_learner, logdir, i)
+	return learners
+
+
+def evaluate_learners(learners, test_loader, device):
+	"""
+	Evaluate the evaluation_models() of all the <learners> in one pass over the test batches, in the fast math mode of the learners
+	as in their own evaluation, see Participant.evaluate.
+	"""
+	models, slices = [], []
+	for federated_learner in learners:
+		learner_slices = {}
+		for mode, mode_models in federated_learner.evaluation_models().items():
+			learner_slices[mode] = (len(models), len(models) + len(mode_models))
+			models.extend(mode_models)
+		slices.append(learner_slices)
+
+	accs = evaluate_models(models, test_loader, device, fast_math=learners[0].args.get('fast_math', False))
+	return [{mode: accs[start:end] for mode, (start, end) in learner_slices.items()} for learner_slices in slices]
+
+
+def run_group(job):
+	# a group of the repeats in a worker process, with its share of the cores, logging to the log of the experiment
+	args, data_prepper, indices, logdir, threads = job
+	torch.set_num_threads(threads)
+	if logdir is not None:
+		sys.stdout = open(os.path.join(logdir, 'log'), 'a', buffering=1)
+	try:
+		return [Finished_Repeat(federated_learner) for federated_learner in co_schedule(args, data_prepper, indices, logdir)]
+	finally:
+		if logdir is not None:
+			sys.stdout.close()
+			sys.stdout = sys.__stdout__
+
+
+class Repeat_Engine():
+	"""
+	Runs all the repeats of an experiment at once (args['co_schedule_repeats']), in groups that progress round by round together,
+	see co_schedule(): a group shares the Data_Prepper, i.e., the resident dataset tensors and the evaluation batches, and evaluates
+	the models of all its repeats in one pass over the test batches.
+
+	args['repeat_workers']: the number of groups, each in a worker process with its share of the cores, the dataset tensors are shared
+		with the workers in shared memory. 1 runs all the repeats in this process, as do the workers of a sweep.
+		Default: the available cores, up to the repeats
+
+	Each repeat is seeded with seed_repeat(), so the results are the same in any grouping, and as running the repeats
+	sequentially with args['seed_repeats'].
+	"""
+
+	def __init__(self, args, data_prepper, repeat, logdir=None):
+		self.args = args
+		self.data_prepper = data_prepper
+		self.repeat = repeat
+		self.logdir = logdir
+		cpus = get_available_cpus()
+		self.n_workers = max(1, min(repeat, args.get('repeat_workers', cpus)))
+		if mp.current_process().daemon:
+			# e.g. a worker of a sweep, which cannot have worker processes of its own, runs the repeats in itself on its cores
+			self.n_workers = 1
+		self.threads = max(1, cpus // self.n_workers)
+
+	def train(self):
+		"""
+		Returns the learners of the repeats in this process, or their Finished_Repeats from the workers, in order.
+		"""
+		if self.n_workers == 1:
+			return co_schedule(self.args, self.data_prepper, list(range(self.repeat)), self.logdir)
+
+		groups = [indices.tolist() for indices in np.array_split(np.arange(self.repeat), self.n_workers)]
+		jobs = [(self.args, self.data_prepper, indices, self.logdir, self.threads) for indices in groups]
+		sys.stdout.flush()
+		with mp.get_context('spawn').Pool(self.n_workers) as pool:
+			finished = pool.map(run_group, jobs)
+		return [finished_repeat for group in finished for finished_repeat in group]
@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import glob
+import hashlib
+import inspect
+
+import torch
+from torch import nn
+
+
+# args that do not affect the results: where/how the code runs, and names for display
+NON_RESULT_KEYS = ['gpu', 'device', 'device_ids', 'save_gpu', 'prefetch', 'partitions_dir', 'result_store', 'results_catalog', 'profile', 'profile_operator_rounds', 'track_memory', 'co_schedule_repeats', 'repeat_workers',
+				'runtime', 'runtime_workers', 'runtime_address', 'runtime_spawn',
+				'participant_store', 'live_participants', 'store_prefetch', 'participant_arena', 'fused_step', 'name', 'display_name']
+
+# source files under utils/ that cannot affect the stored results: the plots and readers of the results, the observers of a run
+# (CFFL_Session runs are not stored), and the args whose values are hashed themselves. Not Federated_Runtime.py, whose
+# Participant_Worker and framing run the participants of Distributed_Runtime
+NON_RESULT_SOURCES = ['__init__.py', 'arguments.py', 'plot.py', 'read_convergence.py', 'Result_Store.py', 'CFFL_Session.py', 'Results_Catalog.py', 'Profiler.py', 'Memory_Tracker.py']
+
+
+def canonical_value(value):
+	if isinstance(value, nn.Module):
+		# e.g. a loss_fn, its class and its settings
+		return '{}.{}:{}'.format(value.__class__.__module__, value.__class__.__qualname__, repr(value))
+	if inspect.isclass(value) or inspect.isfunction(value):
+		return '{}.{}'.format(value.__module__, value.__qualname__)
+	if isinstance(value, torch.device):
+		return str(value)
+	if isinstance(value, float) and value in [float('inf'), float('-inf')]:
+		return str(value)
+	if isinstance(value, (list, tuple)):
+		return [canonical_value(v) for v in value]
+	if isinstance(value, dict):
+		return {str(k): canonical_value(v) for k, v in value.items()}
+	if isinstance(value, (str, int, float, bool)) or value is None:
+		return value
+	return repr(value)
+
+
+# source files outside utils/ that affect the results: main.py seeds the runs and runs the repeats
+RESULT_SOURCES = ['main.py']
+
+
+def code_version(utils_dir=os.path.dirname(os.path.abspath(__file__))):
+	sha = hashlib.sha1()
+	paths = [path for path in sorted(glob.glob(os.path.join(utils_dir, '*.py'))) if os.path.basename(path) not in NON_RESULT_SOURCES]
+	paths += [os.path.join(os.path.dirname(utils_dir), filename) for filename in RESULT_SOURCES]
+	for path in paths:
+		with open(path, 'rb') as file:
+			sha.update(os.path.basename(path).encode())
+			sha.update(file.read())
+	return sha.hexdigest()
+
+
+def canonical_args(args, repeat):
+	# the args that affect the results, without the code version
+	config = {key: canonical_value(value) for key, value in args.items() if key not in NON_RESULT_KEYS}
+	config['repeat'] = repeat
+	if args.get('co_schedule_repeats', False):
+		# the co-scheduled repeats are seeded, the same results as the seeded sequential repeats, see Repeat_Engine
+		config['seed_repeats'] = True
+	if args.get('runtime', None) == 'gloo' and args.get('runtime_workers', 1) > 1:
+		# the participant ranks have their own random streams, see Distributed_Runtime
+		config['participant_ranks'] = args['runtime_workers']
+	return config
+
+
+def canonical_config(args, repeat):
+	config = canonical_args(args, repeat)
+	config['code_version'] = code_version()
+	return config
+
+
+def get_hash(config):
+	return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def config_hash(args, repeat):
+	return get_hash(canonical_config(args, repeat))
+
+
+def args_hash(args, repeat):
+	# the same for every code version, e.g. to name the log directory of a config, see main.get_logdir
+	return get_hash(canonical_args(args, repeat))
+
+
+class Result_Store():
+	"""
+	Stores the performance_dicts of the completed experiments, keyed by a canonical hash of
+	every argument that affects the results (including the model class, optimizer, loss and the code version),
+	so that a config that was computed before, under any experiment directory, is served from the store.
+	"""
+
+	def __init__(self, root='result_store'):
+		self.root = root
+
+	def get_dir(self, args, repeat):
+		return os.path.join(self.root, config_hash(args, repeat))
+
+	def contains(self, args, repeat):
+		return os.path.isfile(os.path.join(self.get_dir(args, repeat), 'complete.txt'))
+
+	def get(self, args, repeat):
+		"""
+		Returns the (performance_dicts, performance_dicts_pretrain) stored for this config, or None.
+		"""
+		directory = self.get_dir(args, repeat)
+		if not os.path.isfile(os.path.join(directory, 'complete.txt')):
+			return None
+		with open(os.path.join(directory, 'performance_dicts.json')) as file:
+			performance_dicts = json.loads(file.read())
+		with open(os.path.join(directory, 'performance_dicts_pretrain.json')) as file:
+			performance_dicts_pretrain = json.loads(file.read())
+		return performance_dicts, performance_dicts_pretrain
+
+	def put(self, args, repeat, performance_dicts, performance_dicts_pretrain, logdir=None):
+		"""
+		logdir: the log directory of the experiment, to store its per-round metrics as well
+		"""
+		directory = self.get_dir(args, repeat)
+		os.makedirs(directory, exist_ok=True)
+		if logdir and os.path.isdir(os.path.join(logdir, 'metrics')):
+			shutil.rmtree(os.path.join(directory, 'metrics'), ignore_errors=True)
+			shutil.copytree(os.path.join(logdir, 'metrics'), os.path.join(directory, 'metrics'))
+		with open(os.path.join(directory, 'config.json'), 'w') as file:
+			file.write(json.dumps(canonical_config(args, repeat), sort_keys=True, indent=1))
+		with open(os.path.join(directory, 'performance_dicts.json'), 'w') as file:
+			file.write(json.dumps(performance_dicts))
+		with open(os.path.join(directory, 'performance_dicts_pretrain.json'), 'w') as file:
+			file.write(json.dumps(performance_dicts_pretrain))
+		with open(os.path.join(directory, 'complete.txt'), 'w') as file:
+			file.write('complete')
+
+	def copy_metrics(self, args, repeat, logdir):
+		metrics_dir = os.path.join(self.get_dir(args, repeat), 'metrics')
+		if os.path.isdir(metrics_dir):
+			shutil.rmtree(os.path.join(logdir, 'metrics'), ignore_errors=True)
+			shutil.copytree(metrics_dir, os.path.join(logdir, 'metrics'))
+
+	def pending(self, experiment_args, repeat):
+		"""
+		Returns the indices of the configs in experiment_args that still need to be computed.
+		"""
+		return [i for i, args in enumerate(experiment_args) if not self.contains(args, repeat)]
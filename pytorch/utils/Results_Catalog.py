@@ -0,0 +1,133 @@
+import os
+import json
+import sqlite3
+
+from .read_convergence import parse
+
+
+# the settings of a run that can be filtered on in query(), as parsed by read_convergence.parse
+CATALOG_COLUMNS = [('dataset', 'TEXT'), ('split', 'TEXT'), ('model', 'TEXT'), ('P', 'INTEGER'), ('theta', 'REAL'),
+				('lr', 'REAL'), ('alpha', 'REAL'), ('E', 'INTEGER'), ('B', 'INTEGER'), ('size', 'INTEGER'),
+				('Communication Rounds', 'INTEGER'), ('n_freeriders', 'INTEGER'), ('pretrain_epochs', 'INTEGER')]
+
+
+def quote(column):
+	return '"{}"'.format(column)
+
+
+def is_complete(logdir):
+	return os.path.isfile(os.path.join(logdir, 'complete.txt'))
+
+
+class Results_Catalog():
+	"""
+	SQLite catalog of the completed runs: their settings, aggregate dicts and artifact paths.
+
+	A run is ingested once, when it completes (see main.run_experiments) or the first time its experiment
+	directory is ingested, and only ingested again if its complete.txt is newer than the catalog entry.
+	Ingesting an experiment directory also drops its runs that were deleted since.
+	query() selects the runs by experiment directory and by any of the CATALOG_COLUMNS,
+	e.g. query(dataset='adult', theta=0.1, P=20) or query(experiment_dir, P=[10, 20]).
+	"""
+
+	def __init__(self, path='results_catalog.sqlite'):
+		self.path = path
+		directory = os.path.dirname(os.path.abspath(path))
+		os.makedirs(directory, exist_ok=True)
+		# the sweep workers ingest their runs concurrently
+		self.connection = sqlite3.connect(path, timeout=60)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS runs (logdir TEXT PRIMARY KEY, experiment_dir TEXT, folder TEXT, mtime REAL, {}, '
+			'setup TEXT, aggregate_dict TEXT, aggregate_dict_pretrain TEXT, artifacts TEXT)'.format(
+				', '.join('{} {}'.format(quote(column), column_type) for column, column_type in CATALOG_COLUMNS)))
+		for column in ['experiment_dir', 'dataset', 'P', 'theta']:
+			self.connection.execute('CREATE INDEX IF NOT EXISTS runs_{0} ON runs ({1})'.format(column, quote(column)))
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+	def get_mtimes(self, experiment_dir):
+		rows = self.connection.execute('SELECT logdir, mtime FROM runs WHERE experiment_dir = ?', (experiment_dir,))
+		return dict(rows.fetchall())
+
+	def ingest(self, dirname):
+		"""
+		Ingest the completed runs in the experiment directory <dirname> that are new or updated since the last ingest,
+		and drop the runs of <dirname> that are no longer on disk or no longer complete.
+		Returns the number of runs ingested.
+		"""
+		experiment_dir = os.path.abspath(dirname)
+		mtimes = self.get_mtimes(experiment_dir)
+		n_ingested = 0
+		complete = set()
+		for entry in os.scandir(experiment_dir):
+			if not entry.is_dir():
+				continue
+			try:
+				mtime = os.stat(os.path.join(entry.path, 'complete.txt')).st_mtime
+			except OSError:
+				continue
+			complete.add(entry.path)
+			if mtimes.get(entry.path) == mtime:
+				continue
+			self.ingest_run(entry.path, mtime=mtime, commit=False)
+			n_ingested += 1
+		removed = [(logdir,) for logdir in mtimes if logdir not in complete]
+		self.connection.executemany('DELETE FROM runs WHERE logdir = ?', removed)
+		self.connection.commit()
+		return n_ingested
+
+	def ingest_run(self, logdir, mtime=None, commit=True):
+		logdir = os.path.abspath(logdir)
+		if not is_complete(logdir):
+			return
+		if mtime is None:
+			mtime = os.stat(os.path.join(logdir, 'complete.txt')).st_mtime
+		experiment_dir, folder = os.path.split(logdir)
+
+		setup = parse(experiment_dir, folder)
+		aggregate_dicts = []
+		for filename in ['aggregate_dict.txt', 'aggregate_dict_pretrain.txt']:
+			try:
+				with open(os.path.join(logdir, filename)) as dict_log:
+					aggregate_dicts.append(dict_log.read())
+			except IOError:
+				aggregate_dicts.append(None)
+		artifacts = {name: os.path.join(logdir, name) for name in sorted(os.listdir(logdir))}
+
+		columns = ['logdir', 'experiment_dir', 'folder', 'mtime'] + [column for column, _ in CATALOG_COLUMNS] + ['setup', 'aggregate_dict', 'aggregate_dict_pretrain', 'artifacts']
+		values = [logdir, experiment_dir, folder, mtime] + [setup.get(column) for column, _ in CATALOG_COLUMNS] + \
+			[json.dumps(setup)] + aggregate_dicts + [json.dumps(artifacts)]
+		self.connection.execute('INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(
+			', '.join(quote(column) for column in columns), ', '.join('?' * len(columns))), values)
+		if commit:
+			self.connection.commit()
+
+	def query(self, experiment_dir=None, **filters):
+		"""
+		The runs that match all the filters, a list of values matches any of them.
+		Each run is a dict of its logdir, folder, setup, aggregate dicts and artifacts.
+		"""
+		conditions, values = [], []
+		if experiment_dir is not None:
+			conditions.append('experiment_dir = ?')
+			values.append(os.path.abspath(experiment_dir))
+		catalog_columns = [column for column, _ in CATALOG_COLUMNS]
+		for column, value in filters.items():
+			assert column in catalog_columns, "Cannot filter on {}, only on {}.".format(column, catalog_columns)
+			value = value if isinstance(value, (list, tuple)) else [value]
+			conditions.append('{} IN ({})'.format(quote(column), ', '.join('?' * len(value))))
+			values.extend(value)
+
+		statement = 'SELECT logdir, folder, setup, aggregate_dict, aggregate_dict_pretrain, artifacts FROM runs'
+		if conditions:
+			statement += ' WHERE ' + ' AND '.join(conditions)
+		statement += ' ORDER BY logdir'
+
+		runs = []
+		for logdir, folder, setup, aggregate_dict, aggregate_dict_pretrain, artifacts in self.connection.execute(statement, values):
+			runs.append({'logdir': logdir, 'folder': folder, 'setup': json.loads(setup),
+				'aggregate_dict': json.loads(aggregate_dict) if aggregate_dict else None,
+				'aggregate_dict_pretrain': json.loads(aggregate_dict_pretrain) if aggregate_dict_pretrain else None,
+				'artifacts': json.loads(artifacts)})
+		return runs
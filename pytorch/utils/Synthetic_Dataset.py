@@ -0,0 +1,206 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from utils.Custom_Dataset import Custom_Dataset
+
+
+# the synthetic datasets, shaped like the real ones, any of the settings can be overridden by args['synthetic']
+SYNTHETIC_DATASETS = {
+	'synthetic_adult': {'kind': 'tabular', 'shape': (86,), 'n_classes': 2},
+	'synthetic_mnist': {'kind': 'image', 'shape': (1, 32, 32), 'n_classes': 10},
+	'synthetic_cifar10': {'kind': 'image', 'shape': (3, 32, 32), 'n_classes': 10},
+	'synthetic_text': {'kind': 'text', 'vocab_size': 20000, 'min_length': 8, 'max_length': 50, 'n_classes': 5},
+}
+
+DEFAULTS = {
+	'n_valid': 2000,
+	'n_test': 2000,
+	'seed': 1234,
+	'chunk_size': 256,
+	# the distance between the class centers in units of the noise, the larger the easier
+	'class_sep': 3.0,
+	# the fraction of the labels that are replaced by a random class
+	'label_noise': 0.0,
+	# image: the resolution of the class patterns, upsampled to the image shape
+	'pattern_size': 8,
+	# text: the number of topic tokens of each class and the probability of a token to be one of them
+	'topic_size': 50,
+	'topic_prob': 0.2,
+}
+
+# the streams of samples, each with its own random numbers
+TRAIN, VALID, TEST = 0, 1, 2
+
+PAD_INDEX = 1
+
+
+def get_config(name, overrides=None):
+	assert name in SYNTHETIC_DATASETS, "Unknown synthetic dataset {}, only {} are available.".format(name, sorted(SYNTHETIC_DATASETS))
+	config = dict(DEFAULTS, **SYNTHETIC_DATASETS[name])
+	config.update(overrides or {})
+	return config
+
+
+def get_generator(seed, *keys):
+	# a generator for each (seed, stream, chunk), so that any chunk can be generated on its own
+	for key in keys:
+		seed = (seed * 1000003 + key + 1) % (2 ** 62)
+	return torch.Generator().manual_seed(seed)
+
+
+class Synthetic_Dataset(Dataset):
+	"""
+	A synthetic classification dataset of <n_samples> samples, generated lazily and deterministically from the seed, in chunks.
+
+	Any chunk of <chunk_size> samples is generated on its own from (seed, stream, chunk), so the dataset is never held in memory:
+	get_chunk() generates the samples of a chunk, and Synthetic_Loader streams a participant's shard chunk by chunk.
+	The classes have their own structure, shared by the streams (train, validation and test) of the same seed:
+		tabular: a Gaussian cluster around a center for each class
+		image: a low resolution pattern for each class, upsampled to the image shape, with Gaussian noise on every pixel
+		text: token sequences of random lengths, drawn from a Zipf distribution over the vocabulary,
+			each token is one of the topic tokens of the class with probability topic_prob
+	class_sep sets how far apart the classes are relative to the noise, and label_noise the fraction of random labels,
+	so the accuracies are meaningful and can be made as hard as needed.
+	"""
+
+	def __init__(self, config, n_samples, stream=TRAIN):
+		self.config = config
+		self.kind = config['kind']
+		self.n_samples = n_samples
+		self.stream = stream
+		self.seed = config['seed']
+		self.n_classes = config['n_classes']
+		self.chunk_size = config['chunk_size']
+		self.n_chunks = int(math.ceil(n_samples / self.chunk_size))
+		self.init_classes()
+		self.cached_chunk = (None, None)
+
+	def init_classes(self):
+		generator = get_generator(self.seed)
+		config = self.config
+		if self.kind == 'tabular':
+			centers = torch.randn((self.n_classes,) + tuple(config['shape']), generator=generator)
+			self.centers = centers / centers[0].numel() ** 0.5 * config['class_sep']
+		elif self.kind == 'image':
+			channels, height, width = config['shape']
+			patterns = torch.randn(self.n_classes, channels, config['pattern_size'], config['pattern_size'], generator=generator)
+			patterns = F.interpolate(patterns, size=(height, width), mode='bilinear', align_corners=False)
+			patterns = patterns - patterns.mean(dim=(1, 2, 3), keepdim=True)
+			# the same distance between the classes as the tabular centers, in the larger number of dimensions
+			self.centers = patterns / patterns[0].norm() * config['class_sep']
+		elif self.kind == 'text':
+			# the tokens 0 and 1 are reserved for <unk> and <pad>, as in torchtext
+			ranks = torch.arange(1, config['vocab_size'] - 1).float()
+			self.token_probs = 1. / ranks
+			self.topics = torch.stack([torch.randperm(config['vocab_size'] - 2, generator=generator)[:config['topic_size']] + 2
+				for _ in range(self.n_classes)])
+		else:
+			raise NotImplementedError("The synthetic data kind {} is not implemented.".format(self.kind))
+
+	def __len__(self):
+		return self.n_samples
+
+	def get_chunk_range(self, chunk):
+		start = chunk * self.chunk_size
+		return start, min(start + self.chunk_size, self.n_samples)
+
+	def get_chunk_labels(self, chunk):
+		# the true classes of the samples of the chunk, and their targets: the classes with the label noise
+		start, end = self.get_chunk_range(chunk)
+		generator = get_generator(self.seed, self.stream, chunk, 0)
+		classes = torch.randint(self.n_classes, (end - start,), generator=generator)
+		targets = classes
+		if self.config['label_noise'] > 0:
+			targets = classes.clone()
+			noisy = torch.rand(end - start, generator=generator) < self.config['label_noise']
+			targets[noisy] = torch.randint(self.n_classes, (int(noisy.sum()),), generator=generator)
+		return classes, targets
+
+	def get_chunk(self, chunk):
+		"""
+		The data and targets of the samples [chunk * chunk_size, (chunk + 1) * chunk_size).
+		"""
+		if self.cached_chunk[0] == chunk:
+			return self.cached_chunk[1]
+		classes, targets = self.get_chunk_labels(chunk)
+		generator = get_generator(self.seed, self.stream, chunk, 1)
+		n = len(targets)
+		if self.kind in ['tabular', 'image']:
+			data = self.centers[classes] + torch.randn((n,) + tuple(self.config['shape']), generator=generator)
+		else:
+			max_length = self.config['max_length']
+			data = torch.multinomial(self.token_probs, n * max_length, replacement=True, generator=generator).view(n, max_length) + 2
+			is_topic = torch.rand(n, max_length, generator=generator) < self.config['topic_prob']
+			topic_tokens = self.topics[classes.unsqueeze(1).expand(n, max_length), torch.randint(self.config['topic_size'], (n, max_length), generator=generator)]
+			data = torch.where(is_topic, topic_tokens, data)
+			lengths = torch.randint(self.config['min_length'], max_length + 1, (n, 1), generator=generator)
+			data[torch.arange(max_length).unsqueeze(0) >= lengths] = PAD_INDEX
+		self.cached_chunk = (chunk, (data, targets))
+		return data, targets
+
+	def __getitem__(self, index):
+		chunk = index // self.chunk_size
+		data, targets = self.get_chunk(chunk)
+		return data[index - chunk * self.chunk_size], targets[index - chunk * self.chunk_size]
+
+	@property
+	def targets(self):
+		# all the targets, without generating the data, e.g. for the class imbalance and dirichlet splits
+		return torch.cat([self.get_chunk_labels(chunk)[1] for chunk in range(self.n_chunks)])
+
+	def materialize(self, device=None):
+		"""
+		The whole dataset in memory, for the validation and test sets.
+		"""
+		chunks = [self.get_chunk(chunk) for chunk in range(self.n_chunks)]
+		return Custom_Dataset(torch.cat([data for data, _ in chunks]), torch.cat([targets for _, targets in chunks]), device=device)
+
+
+class Synthetic_Loader():
+	"""
+	The batches of the samples <indices> of a Synthetic_Dataset, streamed chunk by chunk, so that only one chunk is in memory.
+
+	With shuffle, the chunks are visited in a random order and the samples within each chunk are shuffled,
+	with the torch random state, as the SubsetRandomSampler of the DataLoaders of the real datasets.
+	"""
+
+	def __init__(self, dataset, indices, batch_size, shuffle=True):
+		self.dataset = dataset
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		indices = np.sort(np.asarray(indices, dtype=np.int64))
+		chunks = indices // dataset.chunk_size
+		boundaries = np.flatnonzero(np.diff(chunks)) + 1
+		# the offsets of the samples within their chunk, by chunk
+		self.chunk_offsets = OrderedDict((int(chunk_indices[0] // dataset.chunk_size), torch.from_numpy(chunk_indices % dataset.chunk_size))
+			for chunk_indices in np.split(indices, boundaries) if len(chunk_indices))
+		self.n_samples = len(indices)
+
+	def __len__(self):
+		return int(math.ceil(self.n_samples / self.batch_size))
+
+	def __iter__(self):
+		chunks = list(self.chunk_offsets)
+		if self.shuffle:
+			chunks = [chunks[i] for i in torch.randperm(len(chunks)).tolist()]
+		remainder = None
+		for chunk in chunks:
+			offsets = self.chunk_offsets[chunk]
+			if self.shuffle:
+				offsets = offsets[torch.randperm(len(offsets))]
+			data, targets = self.dataset.get_chunk(chunk)
+			data, targets = data[offsets], targets[offsets]
+			if remainder is not None:
+				# the samples left over from the previous chunk, less than a batch
+				data, targets = torch.cat([remainder[0], data]), torch.cat([remainder[1], targets])
+			n_full = len(targets) // self.batch_size * self.batch_size
+			for start in range(0, n_full, self.batch_size):
+				yield data[start:start + self.batch_size], targets[start:start + self.batch_size]
+			remainder = (data[n_full:], targets[n_full:]) if n_full < len(targets) else None
+		if remainder is not None:
+			yield remainder
@@ -20,7 +20,7 @@ class CNN_Net(nn.Module):
 		x = F.max_pool2d(x, 2, 2)
 		x = F.tanh(self.conv2(x))
 		x = F.max_pool2d(x, 2, 2)
-		x = x.view(-1, 4 * 4 * 16)
+		x = x.reshape(-1, 4 * 4 * 16)
 		x = F.tanh(self.fc1(x))
 		x = self.fc2(x)
 		return F.log_softmax(x, dim=1)
@@ -117,7 +117,7 @@ class CNNCifar(nn.Module):
 	def forward(self, x):
 		x = self.pool(F.relu(self.conv1(x)))
 		x = self.pool(F.relu(self.conv2(x)))
-		x = x.view(-1, 16 * 5 * 5)
+		x = x.reshape(-1, 16 * 5 * 5)
 		x = F.relu(self.fc1(x))
 		x = F.relu(self.fc2(x))
 		x = self.fc3(x)
@@ -140,7 +140,7 @@ class CNNCifar_TF(nn.Module):
 		x = self.pool(F.relu(self.conv1(x)))
 		x = self.pool(F.relu(self.conv2(x)))
 		x = F.relu(self.conv3(x))
-		x = x.view(-1, 64 * 4 * 4)
+		x = x.reshape(-1, 64 * 4 * 4)
 		x = F.relu(self.fc1(x))
 		x = self.fc2(x)
 		return F.log_softmax(x, dim=1)
@@ -192,7 +192,7 @@ class ResNet18(nn.Module):
 		out = self.layer3(out)
 		out = self.layer4(out)
 		out = F.avg_pool2d(out, 4)
-		out = out.view(out.size(0), -1)
+		out = out.reshape(out.size(0), -1)
 		out = self.linear(out)
 		# return out
 		return F.log_softmax(out, dim=1)
@@ -248,7 +248,7 @@ class AlexNet(nn.Module):
 
 	def forward(self, x):
 		x = self.features(x)
-		x = x.view(x.size(0), 256 * 2 * 2)
+		x = x.reshape(x.size(0), 256 * 2 * 2)
 		x = self.classifier(x)
 		return x
 
@@ -271,7 +271,7 @@ class VGG(nn.Module):
 
 	def forward(self, x):
 		out = self.features(x)
-		out = out.view(out.size(0), -1)
+		out = out.reshape(out.size(0), -1)
 		out = self.classifier(out)
 		return out
 
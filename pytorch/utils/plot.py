@@ -26,7 +26,8 @@ def plot(df, save_dir=None, name='adult', plot_type=1, show=False, **kwargs):
 	# pass in other use info using kwargs
 	
 	# Data
-	index = np.arange(1, len(df)+1)
+	# the round of each row, every round unless <rounds> are given, e.g. of a CFFL_Session that evaluated only some of the rounds
+	index = np.arange(1, len(df)+1) if kwargs.get('rounds') is None else np.asarray(kwargs['rounds'])
 
 	fmt_styles = best_participant_fmt_styles if plot_type == 2 else all_party_fmt_styles
 
@@ -1,5 +1,8 @@
 import os
 import json
+import glob
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import ast
 import numpy as np
@@ -10,6 +13,7 @@ from collections import defaultdict
 
 
 from .plot import plot
+from .Metrics_Store import Metrics_Store, get_metrics_dir
 
 
 key_map = {'DSSGD_model_test_accs': 'DSSGD',
@@ -125,103 +129,153 @@ def get_performance_dicts(dirname, folder):
 			performance_dict[key] = [temp_dict[key] for temp_dict in loaded_temp_dicts]
 
 		performance_dicts.append(performance_dict)
+
+	# the per-round metrics, memory-mapped from the metrics store of each repeat
+	# the logs written before the metrics store have them in the performance dicts instead
+	if os.path.isdir(os.path.join(dirname, folder, 'metrics')):
+		n_repeats = len(performance_dicts[0]['shard_sizes'])
+		metrics_dicts = [Metrics_Store.load(get_metrics_dir(os.path.join(dirname, folder), i)).to_performance_dicts() for i in range(n_repeats)]
+		for performance_dict, repeat_dicts in zip(performance_dicts, zip(*metrics_dicts)):
+			for key in repeat_dicts[0]:
+				performance_dict[key] = [repeat_dict[key] for repeat_dict in repeat_dicts]
 	return performance_dicts
 
-def plot_convergence(dirname):
-	dfs = []
-	setups = []
-	experiment_results = []
+def get_evaluated_rounds(performance_dict):
+	"""
+	The rounds of the rows of the test accuracies, None if they are of every round.
+	A CFFL_Session that evaluated only some of the rounds records them in performance_dict['evaluated_rounds'].
+	"""
+	if 'evaluated_rounds' not in performance_dict:
+		return None
+	evaluated_rounds = performance_dict['evaluated_rounds']
+	assert all(rounds == evaluated_rounds[0] for rounds in evaluated_rounds), "The repeats are evaluated in different rounds."
+	return evaluated_rounds[0]
 
-	for folder in os.listdir(dirname):
-		if os.path.isfile(os.path.join(dirname, folder)) or not 'complete.txt' in os.listdir(os.path.join(dirname, folder)):
-			continue
+# the figures of each experiment folder, see plot_folder
+FIGURES = ['figure.png', 'figure_pretrain.png', 'reputations.png', 'reputations_pretrain.png', 'standlone.png', 'convergence_for_one.png']
 
-		performance_dicts = get_performance_dicts(dirname, folder)
-		performance_dict = performance_dicts[0]
-		performance_dict_pretrain = performance_dicts[1]
 
-		setup = parse(dirname, folder)
-		n_participants = setup['P']
-		columns = ['party' + str(i + 1) for i in range(n_participants)]
+def get_source_mtime(logdir):
+	# the latest change to the results the figures are plotted from
+	sources = [os.path.join(logdir, filename) for filename in ['settings_dict.txt', 'performance_dict.log', 'performance_dict_pretrain.log']]
+	sources += glob.glob(os.path.join(logdir, 'metrics', '*', '*'))
+	return max(os.path.getmtime(source) for source in sources if os.path.exists(source))
 
-		n_freeriders = 0
-		free_riders = []
-		avg_dfs = {}
-		for key in key_map:
-			avg_accs = np.asarray(performance_dict[key]).mean(axis=0)
-			if key != 'reputations':
-				avg_accs = avg_accs[:-1]  # exclude the last repeated line
 
-			n_freeriders = avg_accs.shape[1] - n_participants
-			if n_freeriders > 0:
-				free_riders  =  ['free' + str(i + 1) for i in range(n_freeriders)]
+def get_stale_figures(logdir):
+	"""
+	The figures that do not exist, or are older than the results they are plotted from.
+	"""
+	source_mtime = get_source_mtime(logdir)
+	return [figure for figure in FIGURES if not os.path.exists(os.path.join(logdir, figure)) or os.path.getmtime(os.path.join(logdir, figure)) < source_mtime]
 
 
-			avg_dfs[key_map[key]] = pd.DataFrame(data=avg_accs, columns=free_riders + columns)
+def init_plot_worker():
+	# headless, the workers only save the figures
+	plt.switch_backend('Agg')
 
-		reputation_threshold = np.asarray(performance_dict['reputation_threshold']).mean(axis=0)
-		reputation_threshold_pretrain = np.asarray(performance_dict_pretrain['reputation_threshold']).mean(axis=0)
 
-		reputations_df = avg_dfs['reputations']
-		reputations_df['threshold'] = reputation_threshold
+def plot_folder(job):
+	"""
+	Plot the <figures> of an experiment folder, from a single parse of its results.
+	"""
+	dirname, folder, figures = job
 
-		cffl_df = avg_dfs['CFFL']
-		standalone_df = avg_dfs['Standalone']
-		dssgd_df = avg_dfs['DSSGD']
-		fedavg_df = avg_dfs['Fedavg']
+	performance_dicts = get_performance_dicts(dirname, folder)
+	performance_dict = performance_dicts[0]
+	performance_dict_pretrain = performance_dicts[1]
 
-		best_participant_ind = cffl_df.iloc[-1].argmax()
+	setup = parse(dirname, folder)
+	n_participants = setup['P']
+	columns = ['party' + str(i + 1) for i in range(n_participants)]
 
-		reputations_avg_pretrain = np.nanmean(np.asarray(performance_dict_pretrain['reputations']), axis=0)
+	n_freeriders = 0
+	free_riders = []
+	avg_dfs = {}
+	for key in key_map:
+		avg_accs = np.asarray(performance_dict[key]).mean(axis=0)
+		if key != 'reputations':
+			avg_accs = avg_accs[:-1]  # exclude the last repeated line
 
-		reputations_df_pretrain = pd.DataFrame(data=reputations_avg_pretrain, columns = free_riders + columns)
-		reputations_df_pretrain['threshold'] = reputation_threshold_pretrain
+		n_freeriders = avg_accs.shape[1] - n_participants
+		if n_freeriders > 0:
+			free_riders  =  ['free' + str(i + 1) for i in range(n_freeriders)]
 
 
-		cffl_avg_acc_pretrain = np.asarray(performance_dict_pretrain['cffl_test_accs']).mean(axis=0)[:-1]
-		cffl_df_pretrain = pd.DataFrame(data=cffl_avg_acc_pretrain, columns=free_riders + columns)
+		avg_dfs[key_map[key]] = pd.DataFrame(data=avg_accs, columns=free_riders + columns)
 
-		participant_df = pd.DataFrame(data={'Standlone': standalone_df.iloc[:, best_participant_ind],
-									   'DSSGD': dssgd_df.iloc[:, best_participant_ind],
-									   'FedAvg':fedavg_df.iloc[:, best_participant_ind],
-									   'CFFL (w pretrain)': cffl_df_pretrain.iloc[:, best_participant_ind],
-									   'CFFL (w/o pretrain)': cffl_df.iloc[:, best_participant_ind],
-									   })
+	# the rounds of the test accuracies, less the last repeated line
+	evaluated_rounds = get_evaluated_rounds(performance_dict)
+	test_rounds = evaluated_rounds[:-1] if evaluated_rounds is not None else None
 
-		reputations_figure_dir = os.path.join(dirname, folder, 'reputations.png')
-		reputations_pretrain_figure_dir = os.path.join(dirname, folder, 'reputations_pretrain.png')
-		cffl_figure_dir = os.path.join(dirname, folder, 'figure.png')
-		cffl_pretrain_figure_dir = os.path.join(dirname, folder, 'figure_pretrain.png')
+	reputation_threshold = np.asarray(performance_dict['reputation_threshold']).mean(axis=0)
+	reputation_threshold_pretrain = np.asarray(performance_dict_pretrain['reputation_threshold']).mean(axis=0)
 
-		standlone_figure_dir = os.path.join(dirname, folder, 'standlone.png')
-		participant_figure_dir = os.path.join(dirname, folder, 'convergence_for_one.png')
+	reputations_df = avg_dfs['reputations']
+	reputations_df['threshold'] = reputation_threshold
 
+	cffl_df = avg_dfs['CFFL']
+	standalone_df = avg_dfs['Standalone']
+	dssgd_df = avg_dfs['DSSGD']
+	fedavg_df = avg_dfs['Fedavg']
 
-		if os.path.exists(cffl_figure_dir):
-			os.remove(cffl_figure_dir)
+	best_participant_ind = cffl_df.iloc[-1].argmax()
 
-		plot(cffl_df, cffl_figure_dir, name=setup['dataset'], plot_type=0, split=setup['split'])
-		plot(cffl_df_pretrain, cffl_pretrain_figure_dir, name=setup['dataset'], plot_type=0, split=setup['split'])
+	reputations_avg_pretrain = np.nanmean(np.asarray(performance_dict_pretrain['reputations']), axis=0)
 
+	reputations_df_pretrain = pd.DataFrame(data=reputations_avg_pretrain, columns = free_riders + columns)
+	reputations_df_pretrain['threshold'] = reputation_threshold_pretrain
 
 
-		if os.path.exists(reputations_figure_dir):
-			os.remove(reputations_figure_dir)
+	cffl_avg_acc_pretrain = np.asarray(performance_dict_pretrain['cffl_test_accs']).mean(axis=0)[:-1]
+	cffl_df_pretrain = pd.DataFrame(data=cffl_avg_acc_pretrain, columns=free_riders + columns)
 
-		reputation_top = 1. / n_participants * 1.5
-		reputation_bottom = -0.01
+	participant_df = pd.DataFrame(data={'Standlone': standalone_df.iloc[:, best_participant_ind],
+								   'DSSGD': dssgd_df.iloc[:, best_participant_ind],
+								   'FedAvg':fedavg_df.iloc[:, best_participant_ind],
+								   'CFFL (w pretrain)': cffl_df_pretrain.iloc[:, best_participant_ind],
+								   'CFFL (w/o pretrain)': cffl_df.iloc[:, best_participant_ind],
+								   })
 
-		plot(reputations_df, reputations_figure_dir, name=setup['dataset'].capitalize(), plot_type=0, ylabel='Reputations', top=reputation_top, bottom=reputation_bottom)
-		plot(reputations_df_pretrain, reputations_pretrain_figure_dir, name=setup['dataset'].capitalize() + ' pretrain', plot_type=0, ylabel='Reputations',top=reputation_top, bottom=reputation_bottom)
+	reputation_top = 1. / n_participants * 1.5
+	reputation_bottom = -0.01
+
+	plots = {
+		'figure.png': lambda path: plot(cffl_df, path, name=setup['dataset'], plot_type=0, split=setup['split'], rounds=test_rounds),
+		'figure_pretrain.png': lambda path: plot(cffl_df_pretrain, path, name=setup['dataset'], plot_type=0, split=setup['split'], rounds=test_rounds),
+		'reputations.png': lambda path: plot(reputations_df, path, name=setup['dataset'].capitalize(), plot_type=0, ylabel='Reputations', top=reputation_top, bottom=reputation_bottom),
+		'reputations_pretrain.png': lambda path: plot(reputations_df_pretrain, path, name=setup['dataset'].capitalize() + ' pretrain', plot_type=0, ylabel='Reputations',top=reputation_top, bottom=reputation_bottom),
+		'standlone.png': lambda path: plot(standalone_df, path, name=setup['dataset'], plot_type=1, rounds=test_rounds),
+		'convergence_for_one.png': lambda path: plot(participant_df, path, name=setup['dataset'], plot_type=2, rounds=test_rounds),
+	}
+	for figure in figures:
+		plots[figure](os.path.join(dirname, folder, figure))
+	return
+
+
+def plot_convergence(dirname, n_workers=None):
+	"""
+	Plot the figures of the completed experiments in <dirname> that are missing or older than their results.
+	n_workers: the number of processes to plot the experiment folders in, None for one per cpu, 1 for in this process
+	"""
+	jobs = []
+	for folder in sorted(os.listdir(dirname)):
+		if os.path.isfile(os.path.join(dirname, folder)) or not 'complete.txt' in os.listdir(os.path.join(dirname, folder)):
+			continue
 
-		# plot(reputations_df, reputations_figure_dir, name=setup['dataset'], plot_type=0)
+		figures = get_stale_figures(os.path.join(dirname, folder))
+		if figures:
+			jobs.append((dirname, folder, figures))
 
-		if os.path.exists(standlone_figure_dir):
-			os.remove(standlone_figure_dir)
-		plot(standalone_df, standlone_figure_dir, name=setup['dataset'], plot_type=1)
+	if not jobs:
+		return
 
-		if os.path.exists(participant_figure_dir):
-			os.remove(participant_figure_dir)
-		plot(participant_df, participant_figure_dir, name=setup['dataset'], plot_type=2)
+	n_workers = min(n_workers or os.cpu_count(), len(jobs))
+	if n_workers == 1:
+		for job in jobs:
+			plot_folder(job)
+		return
 
+	with ProcessPoolExecutor(n_workers, mp_context=mp.get_context('spawn'), initializer=init_plot_worker) as pool:
+		list(pool.map(plot_folder, jobs))
 	return
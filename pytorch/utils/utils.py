@@ -1,8 +1,8 @@
 import copy
+import contextlib
 import torch
 from torch import nn
 from torch.utils.data import DataLoader
-from torchtext.data import Batch
 
 def averge_models(models, device=None):
 	final_model = copy.deepcopy(models[0])
@@ -106,23 +106,44 @@ def unflatten(flattened, normal_shape):
 
 	return grad_update
 
-def evaluate(model, eval_loader, device, loss_fn=None, verbose=True):
+def cpu_bf16_supported():
+	# bfloat16 autocast on the CPU (torch >= 1.10) and a CPU with bfloat16 instructions for oneDNN (e.g. AVX512-BF16 or AMX)
+	if not hasattr(torch, 'autocast'):
+		return False
+	try:
+		return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+	except (AttributeError, RuntimeError):
+		return False
+
+def fast_math_context(device, fast_math=False):
+	"""
+	The context of the forwards of the fast math mode (args['fast_math']) on the CPU: bfloat16 autocast where the CPU supports it,
+	see cpu_bf16_supported(). The parameters and their gradients stay float32, so the updates, their clipping and masking are exact.
+	Otherwise a context that does nothing.
+	"""
+	if fast_math and torch.device(device).type == 'cpu' and cpu_bf16_supported():
+		return torch.autocast('cpu', dtype=torch.bfloat16)
+	return contextlib.nullcontext()
+
+def fast_math_batch(batch_data, device, fast_math=False):
+	# the images of the fast math mode on the CPU in channels last, the layout of the oneDNN convolutions (torch >= 1.5), the parameters keep theirs
+	if fast_math and torch.device(device).type == 'cpu' and batch_data.dim() == 4 and hasattr(torch, 'channels_last'):
+		return batch_data.contiguous(memory_format=torch.channels_last)
+	return batch_data
+
+def evaluate(model, eval_loader, device, loss_fn=None, verbose=True, fast_math=False):
 	model.eval()
 	model = model.to(device)
 	correct = 0
 	total = 0
 
-	with torch.no_grad():
+	with torch.no_grad(), fast_math_context(device, fast_math):
 		for i, batch in enumerate(eval_loader):
 
-			if isinstance(batch, Batch):
-				batch_data, batch_target = batch.text, batch.label
-				# batch_data.data.t_(), batch_target.data.sub_(1)  # batch first, index align
-				batch_data = batch_data.permute(1, 0)
-			else:
-				batch_data, batch_target = batch[0], batch[1]
+			# text batches come batch first from Bucket_Loader, no permute needed
+			batch_data, batch_target = batch[0], batch[1]
 
-			batch_data, batch_target = batch_data.to(device), batch_target.to(device)
+			batch_data, batch_target = fast_math_batch(batch_data.to(device), device, fast_math), batch_target.to(device)
 
 			outputs = model(batch_data)
 
@@ -138,6 +159,35 @@ def evaluate(model, eval_loader, device, loss_fn=None, verbose=True):
 		print("Loss: {:.6f}. Accuracy: {:.4%}.".format(loss, accuracy))
 	return loss, accuracy
 
+def evaluate_models(models, eval_loader, device, fast_math=False):
+	"""
+	Evaluate the accuracies of many models in a single pass over the eval_loader,
+	so the batches are loaded and moved to the device once for all the models.
+	Returns the same accuracies as evaluate() on each model, with the same <fast_math>.
+	"""
+	for model in models:
+		model.eval()
+		model.to(device)
+	correct = [0 for model in models]
+	total = 0
+
+	with torch.no_grad(), fast_math_context(device, fast_math):
+		for i, batch in enumerate(eval_loader):
+			batch_data, batch_target = fast_math_batch(batch[0].to(device), device, fast_math), batch[1].to(device)
+			for j, model in enumerate(models):
+				outputs = model(batch_data)
+				correct[j] += (torch.max(outputs, 1)[1].view(batch_target.size()).data == batch_target.data).sum()
+			total += len(batch_target)
+	return [correct_.float() / total for correct_ in correct]
+
+def seeded_repeats(args):
+	# each repeat has its own random stream, see Repeat_Engine.seed_repeat
+	return bool(args) and (args.get('seed_repeats', False) or args.get('co_schedule_repeats', False))
+
+def tensor_batches(dataset, batch_size):
+	# the fixed evaluation batches of a tensor dataset, same as a DataLoader without shuffle
+	return list(zip(dataset.data.split(batch_size), dataset.targets.split(batch_size)))
+
 '''
 def one_on_one_evaluate(participants, federated_model, grad_updates, unfiltererd_grad_updates, eval_loader, device):
 	val_accs = []
@@ -174,19 +224,6 @@ import numpy as np
 np.random.seed(1111)
 
 
-def random_split(sample_indices, m_bins, equal=True):
-	sample_indices = np.asarray(sample_indices)
-	if equal:
-		indices_list = np.array_split(sample_indices, m_bins)
-	else:
-		split_points = np.random.choice(
-			n_samples - 2, m_bins - 1, replace=False) + 1
-		split_points.sort()
-		indices_list = np.split(sample_indices, split_points)
-
-	return indices_list
-
-
 import random
 from itertools import permutations
 
@@ -216,4 +253,21 @@ def compute_shapley(grad_updates, federated_model, test_loader, device, Max_num_
 
 			curr_contributions.append(contribution)
 
-	return marginal_contributions / len(all_sequences)
\ No newline at end of file
+	return marginal_contributions / len(all_sequences)
+
+
+def get_rng_state():
+	# the numpy state as plain python values, so that it can be saved in a checkpoint
+	name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+	state = {'torch': torch.get_rng_state(), 'numpy': (name, keys.tolist(), position, has_gauss, cached_gaussian), 'random': random.getstate()}
+	if torch.cuda.is_available():
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+
+def set_rng_state(state):
+	torch.set_rng_state(state['torch'])
+	np.random.set_state(state['numpy'])
+	random.setstate(state['random'])
+	if 'cuda' in state:
+		torch.cuda.set_rng_state_all(state['cuda'])